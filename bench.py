@@ -0,0 +1,675 @@
+"""Бенчмарки бота. Запуск: python bench.py <сценарий> [параметры]"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict, Counter
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+import botver2
+
+BENCH_BOT_ID = 123456
+BENCH_TOKEN = f"{BENCH_BOT_ID}:BENCH"
+
+
+# Методы, на которые локальный Bot API может ответить 429 (как настоящий при превышении лимитов)
+RATE_LIMITED_METHODS = ("sendMessage", "editMessageText", "createForumTopic", "editForumTopic",
+                        "pinChatMessage", "sendDocument")
+
+
+class FakeBotApi(BaseRequest):
+    """Локальная замена Bot API: отвечает без сети, имитируя задержку ответа и ответы 429."""
+
+    def __init__(self, latency=0.05, retry_after_rate=0.0, retry_after=1, seed=1):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate  # Доля запросов, получающих 429 Too Many Requests
+        self.retry_after = retry_after
+        self.retry_after_count = 0
+        self._random = random.Random(seed)
+        self.calls = []  # (метод, время вызова)
+        self._message_ids = itertools.count(1000)
+        self._thread_ids = itertools.count(100)
+        self.updates = []  # Обновления, ожидающие выдачи через getUpdates
+        self._updates_event = None
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls.append((api_method, time.perf_counter()))
+        if api_method == "getUpdates":
+            result = await self.get_updates(params)
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if (self.retry_after_rate and api_method in RATE_LIMITED_METHODS
+                and self._random.random() < self.retry_after_rate):
+            self.retry_after_count += 1
+            return 429, json.dumps({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }).encode()
+        result = self.handle(api_method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def push_update(self, data):
+        """Добавляет обновление, которое получит следующий (или ожидающий) getUpdates."""
+        self.updates.append(data)
+        if self._updates_event is not None:
+            self._updates_event.set()
+
+    async def get_updates(self, params):
+        """Длинный опрос: ждет обновлений до timeout, затем ответ идет к клиенту latency секунд."""
+        offset = int(params.get("offset") or 0)
+        self.updates = [data for data in self.updates if data["update_id"] >= offset]
+        if not self.updates:
+            self._updates_event = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+            self._updates_event = None
+        result = list(self.updates)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return result
+
+    def message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "text": params.get("text", ""),
+        }
+        if params.get("message_thread_id"):
+            message["message_thread_id"] = params["message_thread_id"]
+        return message
+
+    def handle(self, api_method, params):
+        if api_method == "getMe":
+            return {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if api_method == "getChat":
+            return {"id": int(params["chat_id"]), "type": "supergroup", "title": "Bench", "is_forum": True,
+                    "accent_color_id": 0, "max_reaction_count": 0,
+                    "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                            "unique_gifts": False, "premium_subscription": False,
+                                            "gifts_from_channels": False}}
+        if api_method == "getChatMember":
+            user_id = int(params["user_id"])
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}}
+        if api_method == "createForumTopic":
+            return {"message_thread_id": next(self._thread_ids), "name": params["name"], "icon_color": 0}
+        if api_method in ("sendMessage", "editMessageText"):
+            return self.message(params)
+        return True
+
+
+async def make_bot(api):
+    bot = Bot(BENCH_TOKEN, request=api)
+    await bot.initialize()
+    return bot
+
+
+def command_update(bot, chat_id, text, user_id=1):
+    """Собирает Update с командой от пользователя в группе-форуме."""
+    data = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Bench", "is_forum": True},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Admin"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+def measure_memory(build):
+    """Возвращает объем памяти (байт), занятый структурой, которую строит build()."""
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    structure = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del structure
+    return current - start
+
+
+def synthetic_stats_events(users, chats, seed=1):
+    """Генерирует события (chat_id, user_id, content_type): по два типа контента на пользователя."""
+    rnd = random.Random(seed)
+    for i in range(users):
+        chat_id = -1000000000000 - (i % chats)
+        user_id = 100000000 + i
+        yield chat_id, user_id, "text"
+        yield chat_id, user_id, rnd.choice(botver2.CONTENT_TYPES[1:])
+
+
+def build_legacy_stats(users, chats):
+    """Прежнее представление: строковые ключи и Counter на каждого пользователя."""
+    stats = defaultdict(lambda: defaultdict(Counter))
+    for chat_id, user_id, content_type in synthetic_stats_events(users, chats):
+        stats[str(chat_id)][str(user_id)][content_type] += 1
+    return stats
+
+
+def build_compact_stats(users, chats):
+    """Текущее представление: ChatStats с целочисленными ключами и массивом счетчиков."""
+    stats = defaultdict(botver2.ChatStats)
+    for chat_id, user_id, content_type in synthetic_stats_events(users, chats):
+        stats[chat_id].increment(user_id, botver2.CONTENT_TYPE_INDEX[content_type])
+    return stats
+
+
+def bench_memory(args):
+    """Сравнивает расход памяти на одного отслеживаемого пользователя."""
+    print(f"Пользователей: {args.users}, чатов: {args.chats}")
+    builders = [("ChatStats (array)", build_compact_stats)]
+    if not args.skip_legacy:
+        builders.append(("defaultdict + Counter", build_legacy_stats))
+    for name, builder in builders:
+        started = time.perf_counter()
+        size = measure_memory(lambda: builder(args.users, args.chats))
+        elapsed = time.perf_counter() - started
+        print(f"{name:24} {size / args.users:8.1f} байт/пользователь, "
+              f"всего {size / 2**20:8.1f} МБ, построение {elapsed:.1f} с")
+
+
+async def legacy_create_loop(bot, chat_id, themes, hello_messages, status_message_id, speedup):
+    """Цикл создания тем в том виде, в каком он был до конвейера: последовательно и с паузами."""
+    successful_topics = 0
+    for i, theme_name in enumerate(themes, 1):
+        new_topic = await bot.create_forum_topic(chat_id=chat_id, name=theme_name)
+        await asyncio.sleep(1 / speedup)
+        sent_message = await bot.send_message(chat_id=chat_id, message_thread_id=new_topic.message_thread_id,
+                                              text=hello_messages[i - 1])
+        await asyncio.sleep(1 / speedup)
+        await bot.pin_chat_message(chat_id=chat_id, message_id=sent_message.message_id, disable_notification=True)
+        successful_topics += 1
+        await bot.edit_message_text(chat_id=chat_id, message_id=status_message_id,
+                                    text=f"Создаю темы обсуждения... ({successful_topics}/{len(themes)})")
+        await asyncio.sleep(3 / speedup)
+    return successful_topics
+
+
+async def run_create_bench(args):
+    speedup = args.speedup
+    themes = [f"Тема {i}" for i in range(1, args.themes + 1)]
+    hello_messages = [f"Это тема {i}" for i in range(1, args.themes + 1)]
+    botver2.DEFAULT_TEMPLATE = botver2.ThemeTemplate(botver2.MAIN_NAME, themes, hello_messages, [])
+    # Лимиты и паузы масштабируются одинаково, результат пересчитывается в реальное время
+    botver2.API_SCHEDULER.configure(
+        botver2.RATE_LIMIT_GLOBAL_PER_SEC * speedup,
+        botver2.RATE_LIMIT_GROUP_PER_MIN * speedup,
+        botver2.RATE_LIMIT_GROUP_BURST,
+        botver2.RATE_LIMIT_PRIVATE_PER_SEC * speedup,
+    )
+    botver2.PROGRESS_EDIT_INTERVAL /= speedup
+    chat_id = -1001234567890
+
+    api = FakeBotApi(args.latency / speedup)
+    bot = await make_bot(api)
+    started = time.perf_counter()
+    await legacy_create_loop(bot, chat_id, themes, hello_messages, 1, speedup)
+    legacy_seconds = (time.perf_counter() - started) * speedup
+    legacy_calls = len(api.calls)
+
+    api = FakeBotApi(args.latency / speedup)
+    bot = await make_bot(api)
+    update = command_update(bot, chat_id, "/create")
+    started = time.perf_counter()
+    await botver2.create_command(update, SimpleNamespace(bot=bot, args=[]))
+    pipeline_seconds = (time.perf_counter() - started) * speedup
+    pipeline_calls = len(api.calls)
+
+    print(f"Тем: {args.themes}, задержка API: {args.latency * 1000:.0f} мс, ускорение прогона: x{speedup}")
+    print(f"Прежний цикл:  {legacy_seconds:7.1f} с, запросов {legacy_calls}")
+    print(f"Конвейер:      {pipeline_seconds:7.1f} с, запросов {pipeline_calls} "
+          f"(с учетом лимита {botver2.RATE_LIMIT_GROUP_PER_MIN} сообщений/мин в группу)")
+    print(f"Ускорение:     x{legacy_seconds / pipeline_seconds:.2f}")
+
+
+def bench_create(args):
+    """Сравнивает время /create с прежним последовательным циклом на локальном Bot API."""
+    # Иначе /create продолжит задание, сохраненное прошлым прогоном, и почти ничего не сделает
+    with use_temp_data_dir():
+        asyncio.run(run_create_bench(args))
+
+
+@contextlib.contextmanager
+def use_temp_data_dir():
+    """Переносит файлы данных бота во временную директорию, чтобы прогон не трогал рабочие данные."""
+    previous = botver2.DATA_DIR
+    with tempfile.TemporaryDirectory(prefix="topicbot-bench-", ignore_cleanup_errors=True) as data_dir:
+        botver2.set_data_dir(data_dir)
+        try:
+            yield data_dir
+        finally:
+            botver2.set_data_dir(previous)
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированному списку (ближайший ранг)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def synthetic_message_updates(count, chats, seed=1):
+    """Генерирует обновления с текстовыми сообщениями пользователей в группах-форумах."""
+    rnd = random.Random(seed)
+    for update_id in range(1, count + 1):
+        chat_id = -1000000000000 - rnd.randrange(chats)
+        user_id = 100000000 + rnd.randrange(chats * 50)
+        yield {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "Bench", "is_forum": True},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+                "text": "сообщение",
+            },
+        }
+
+
+def load_recorded_updates(path):
+    """Читает записанные обновления (по JSON-объекту Update на строку) и нумерует их заново."""
+    with open(path, "r", encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    for update_id, data in enumerate(updates, 1):
+        data["update_id"] = update_id
+    return updates
+
+
+async def start_bench_application(api):
+    """Собирает приложение с обработчиками бота поверх FakeBotApi и отметкой завершения обработки."""
+    finished = {}
+    
+    async def mark_finished(update, context):
+        finished[update.update_id] = time.perf_counter()
+    
+    application = Application.builder().token(BENCH_TOKEN).request(api).get_updates_request(api).build()
+    botver2.register_handlers(application)
+    application.add_handler(TypeHandler(Update, mark_finished), group=100)
+    await application.initialize()
+    await application.start()
+    return application, finished
+
+
+async def deliver_by_polling(api, application, updates, rate):
+    sent = {}
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    for data in updates:
+        sent[data["update_id"]] = time.perf_counter()
+        api.push_update(data)
+        await asyncio.sleep(1 / rate)
+    return sent
+
+
+async def deliver_by_webhook(api, application, updates, rate, connections):
+    sent = {}
+    
+    async def queue_update(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    
+    server = botver2.WebhookServer(queue_update, secret_token="bench", max_connections=connections)
+    port = await server.start("127.0.0.1", 0)
+    pool = asyncio.Queue()
+    for _ in range(connections):
+        pool.put_nowait(await asyncio.open_connection("127.0.0.1", port))
+    
+    async def post(data):
+        sent[data["update_id"]] = time.perf_counter()
+        # Доставка от серверов Telegram занимает ту же задержку сети, что и ответ на getUpdates
+        if api.latency:
+            await asyncio.sleep(api.latency)
+        reader, writer = await pool.get()
+        body = json.dumps(data).encode()
+        writer.write(
+            f"POST {botver2.WEBHOOK_PATH} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: bench\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        status_line = await reader.readuntil(b"\r\n\r\n")
+        pool.put_nowait((reader, writer))
+        if b" 200 " not in status_line.split(b"\r\n", 1)[0]:
+            raise RuntimeError(f"webhook ответил: {status_line!r}")
+    
+    tasks = []
+    for data in updates:
+        tasks.append(asyncio.create_task(post(data)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    while not pool.empty():
+        pool.get_nowait()[1].close()
+    # Принятые обновления уже в очереди приложения и будут обработаны после остановки сервера
+    await server.stop()
+    return sent
+
+
+async def run_ingest_bench(args):
+    updates = load_recorded_updates(args.updates) if args.updates else list(synthetic_message_updates(args.count, args.chats))
+    print(f"Обновлений: {len(updates)}, темп: {args.rate}/с, задержка сети: {args.latency * 1000:.0f} мс")
+    for mode in ("polling", "webhook"):
+        api = FakeBotApi(args.latency)
+        application, finished = await start_bench_application(api)
+        started = time.perf_counter()
+        if mode == "polling":
+            sent = await deliver_by_polling(api, application, updates, args.rate)
+        else:
+            sent = await deliver_by_webhook(api, application, updates, args.rate, args.connections)
+        while len(finished) < len(updates):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        
+        latencies = sorted(finished[update_id] - sent[update_id] for update_id in sent)
+        print(f"{mode:8} p50 {percentile(latencies, 0.5) * 1000:7.1f} мс, p99 {percentile(latencies, 0.99) * 1000:7.1f} мс, "
+              f"макс {latencies[-1] * 1000:7.1f} мс, пропускная способность {len(updates) / elapsed:7.0f} обновл./с")
+
+
+def bench_ingest(args):
+    """Сравнивает задержку от поступления обновления до конца обработки: polling против webhook."""
+    with use_temp_data_dir():
+        asyncio.run(run_ingest_bench(args))
+
+
+# ==================== НАБОР СЦЕНАРИЕВ ДЛЯ ОТСЛЕЖИВАНИЯ РЕГРЕССИЙ ====================
+
+
+class HandlerTimings:
+    """Длительности вызовов обработчиков и число завершившихся ошибкой, по именам обработчиков."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = Counter()
+
+    async def call(self, handler, update, context):
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        except Exception:
+            # Как в Application: ошибка обработчика не останавливает обработку остальных обновлений
+            self.errors[handler.__name__] += 1
+        self.durations[handler.__name__].append(time.perf_counter() - started)
+
+
+def join_burst_updates(bot, chats, joins_per_chat, seed=1):
+    """Сообщения о вступлении: в каждый чат вступают joins_per_chat участников подряд."""
+    rnd = random.Random(seed)
+    updates = []
+    for i in range(joins_per_chat):
+        for chat_index in range(chats):
+            user_id = 200000000 + chat_index * joins_per_chat + i
+            member = {"id": user_id, "is_bot": False, "first_name": f"Гость {user_id}"}
+            if rnd.random() < 0.5:
+                member["username"] = f"guest{user_id}"
+            updates.append(Update.de_json({
+                "update_id": len(updates) + 1,
+                "message": {
+                    "message_id": len(updates) + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": -1002000000000 - chat_index, "type": "supergroup", "title": "Bench"},
+                    "from": member,
+                    "new_chat_members": [member],
+                },
+            }, bot))
+    return updates
+
+
+def fill_huge_chat(chat_id, users, named_share=0.5, seed=1):
+    """Наполняет статистику чата множеством пользователей; часть имен уже известна боту."""
+    rnd = random.Random(seed)
+    chat_stats = botver2.USER_STATS[chat_id]
+    for i in range(users):
+        user_id = 300000000 + i
+        for _ in range(rnd.randint(1, 5)):
+            chat_stats.increment(user_id, rnd.randrange(botver2.NUM_CONTENT_TYPES))
+        if rnd.random() < named_share:
+            botver2.remember_user_name(user_id, f"Участник {user_id}")
+
+
+async def workload_flood(bot, args, timings):
+    """Поток сообщений по многим чатам и пользователям."""
+    updates = [Update.de_json(data, bot) for data in synthetic_message_updates(args.messages, args.chats)]
+    context = SimpleNamespace(bot=bot, args=[])
+    yield len(updates)
+    for update in updates:
+        await timings.call(botver2.handle_message, update, context)
+
+
+async def workload_joins(bot, args, timings):
+    """Массовые вступления в чаты (рейд): приветствия объединяются и отправляются по окну."""
+    updates = join_burst_updates(bot, args.join_chats, args.joins)
+    context = SimpleNamespace(bot=bot, args=[])
+    yield len(updates)
+    for update in updates:
+        await timings.call(botver2.handle_new_user_welcome, update, context)
+    # Дожидаемся отправки объединенных приветствий
+    while any(batch.task is not None for batch in botver2.WELCOME_BATCHES.values()):
+        await asyncio.sleep(0.01)
+
+
+async def workload_stats(bot, args, timings):
+    """/stats в чате с огромным числом пользователей, с изменениями между запросами."""
+    chat_id = -1003000000000
+    fill_huge_chat(chat_id, args.stats_users)
+    updates = [command_update(bot, chat_id, "/stats") for _ in range(args.stats_calls)]
+    flood = [Update.de_json(data, bot) for data in synthetic_message_updates(args.stats_calls * 10, 1, seed=2)]
+    for update in flood:
+        # Сообщения идут в тот же огромный чат
+        update.message.chat._unfreeze()
+        update.message.chat.id = chat_id
+    context = SimpleNamespace(bot=bot, args=[])
+    yield len(updates)
+    for i, update in enumerate(updates):
+        await timings.call(botver2.stats_command, update, context)
+        for message_update in flood[i * 10:(i + 1) * 10]:
+            await botver2.handle_message(message_update, context)
+
+
+async def workload_create(bot, args, timings):
+    """/create с большим шаблоном тем в нескольких группах по очереди."""
+    themes = [f"Тема {i}" for i in range(1, args.themes + 1)]
+    botver2.DEFAULT_TEMPLATE = botver2.ThemeTemplate(
+        botver2.MAIN_NAME, themes, [f"Это тема {i}" for i in range(1, args.themes + 1)], [])
+    updates = [command_update(bot, -1004000000000 - i, "/create") for i in range(args.create_runs)]
+    context = SimpleNamespace(bot=bot, args=[])
+    yield len(updates)
+    for update in updates:
+        await timings.call(botver2.create_command, update, context)
+
+
+SUITE_WORKLOADS = {
+    "flood": workload_flood,
+    "joins": workload_joins,
+    "stats": workload_stats,
+    "create": workload_create,
+}
+
+
+async def run_workload(name, args):
+    """Выполняет сценарий и возвращает его метрики: по обработчикам и в целом."""
+    api = FakeBotApi(args.latency, args.retry_after_rate, args.retry_after)
+    bot = await make_bot(api)
+    timings = HandlerTimings()
+    workload = SUITE_WORKLOADS[name](bot, args, timings)
+    # Подготовка данных (до первого yield) не входит в замеры
+    updates = await workload.__anext__()
+    calls_before = len(api.calls)
+    if args.memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    async for _ in workload:
+        pass
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if args.memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    
+    result = {"updates": updates, "seconds": elapsed, "throughput": updates / elapsed,
+              "api_calls": len(api.calls) - calls_before, "retry_after": api.retry_after_count,
+              "peak_mb": peak / 2**20, "handlers": {}}
+    for handler, durations in timings.durations.items():
+        durations.sort()
+        result["handlers"][handler] = {
+            "calls": len(durations),
+            "errors": timings.errors[handler],
+            "p50_ms": percentile(durations, 0.5) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+            "max_ms": durations[-1] * 1000,
+        }
+    return result
+
+
+def print_suite_results(results):
+    print(f"{'Сценарий':8} {'Обработчик':26} {'Вызовов':>8} {'Обн./с':>9} {'p50, мс':>9} {'p99, мс':>9} "
+          f"{'макс, мс':>9} {'Пик, МБ':>8} {'API':>7} {'429':>5} {'Ошибок':>7}")
+    for name, result in results.items():
+        for handler, stats in result["handlers"].items():
+            print(f"{name:8} {handler:26} {stats['calls']:8} {result['throughput']:9.1f} {stats['p50_ms']:9.2f} "
+                  f"{stats['p99_ms']:9.2f} {stats['max_ms']:9.2f} {result['peak_mb']:8.1f} "
+                  f"{result['api_calls']:7} {result['retry_after']:5} {stats['errors']:7}")
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Сравнивает с сохраненным прогоном; возвращает список ухудшений сверх допуска."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: пропускная способность {base['throughput']:.0f} -> {result['throughput']:.0f} обн./с")
+        if base["peak_mb"] and result["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: пик памяти {base['peak_mb']:.1f} -> {result['peak_mb']:.1f} МБ")
+        for handler, stats in result["handlers"].items():
+            base_stats = base["handlers"].get(handler)
+            if base_stats and stats["p99_ms"] > base_stats["p99_ms"] * (1 + tolerance):
+                regressions.append(f"{name}/{handler}: p99 {base_stats['p99_ms']:.2f} -> {stats['p99_ms']:.2f} мс")
+    return regressions
+
+
+async def run_suite(args):
+    # Лимиты Telegram здесь не нужны: измеряется работа самого бота
+    unlimited = 1e9
+    results = {}
+    for name in args.workloads:
+        botver2.API_SCHEDULER.configure(unlimited, unlimited, unlimited, unlimited)
+        results[name] = await run_workload(name, args)
+    return results
+
+
+def bench_suite(args):
+    """Прогоняет сценарии нагрузки на локальном Bot API и сравнивает с базовым прогоном."""
+    unknown = [name for name in args.workloads if name not in SUITE_WORKLOADS]
+    if unknown:
+        sys.exit(f"Неизвестные сценарии: {', '.join(unknown)}")
+    args.workloads = args.workloads or list(SUITE_WORKLOADS)
+    with use_temp_data_dir():
+        botver2.init_config()
+        botver2.WELCOME_DEBOUNCE_SECONDS = args.welcome_window
+        results = asyncio.run(run_suite(args))
+    print(f"Задержка API: {args.latency * 1000:.0f} мс, доля ответов 429: {args.retry_after_rate}, "
+          f"замер памяти: {'да' if args.memory else 'нет'}")
+    print_suite_results(results)
+    
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Ухудшения относительно базового прогона:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("Ухудшений относительно базового прогона нет")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    memory_parser = subparsers.add_parser("memory", help="память на пользователя в USER_STATS")
+    memory_parser.add_argument("--users", type=int, default=1_000_000)
+    memory_parser.add_argument("--chats", type=int, default=1000)
+    memory_parser.add_argument("--skip-legacy", action="store_true", help="не строить прежнюю структуру")
+    memory_parser.set_defaults(func=bench_memory)
+
+    create_parser = subparsers.add_parser("create", help="время /create против прежнего цикла")
+    create_parser.add_argument("--themes", type=int, default=30)
+    create_parser.add_argument("--latency", type=float, default=0.1, help="задержка ответа API, сек")
+    create_parser.add_argument("--speedup", type=float, default=10,
+                               help="во сколько раз ускорить прогон (паузы, лимиты и задержки масштабируются)")
+    create_parser.set_defaults(func=bench_create)
+    
+    ingest_parser = subparsers.add_parser("ingest", help="задержка обработки обновлений: polling против webhook")
+    ingest_parser.add_argument("--updates", help="файл с записанными обновлениями (JSON на строку)")
+    ingest_parser.add_argument("--count", type=int, default=2000, help="сколько обновлений сгенерировать")
+    ingest_parser.add_argument("--chats", type=int, default=50)
+    ingest_parser.add_argument("--rate", type=float, default=200, help="обновлений в секунду")
+    ingest_parser.add_argument("--latency", type=float, default=0.05, help="задержка сети до Telegram, сек")
+    ingest_parser.add_argument("--connections", type=int, default=botver2.WEBHOOK_MAX_CONNECTIONS,
+                               help="соединений webhook")
+    ingest_parser.set_defaults(func=bench_ingest)
+    
+    suite_parser = subparsers.add_parser("suite", help="сценарии нагрузки на обработчики и сравнение с базовым прогоном")
+    suite_parser.add_argument("workloads", nargs="*", metavar="сценарий",
+                              help=f"какие сценарии выполнить: {', '.join(SUITE_WORKLOADS)} (по умолчанию все)")
+    suite_parser.add_argument("--latency", type=float, default=0.005, help="задержка ответа API, сек")
+    suite_parser.add_argument("--retry-after-rate", type=float, default=0.01, help="доля ответов 429")
+    suite_parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, сек")
+    suite_parser.add_argument("--messages", type=int, default=20000, help="сообщений в сценарии flood")
+    suite_parser.add_argument("--chats", type=int, default=500, help="чатов в сценарии flood")
+    suite_parser.add_argument("--join-chats", type=int, default=20, help="чатов в сценарии joins")
+    suite_parser.add_argument("--joins", type=int, default=200, help="вступлений в каждый чат")
+    suite_parser.add_argument("--welcome-window", type=float, default=0.2, help="окно объединения приветствий, сек")
+    suite_parser.add_argument("--stats-users", type=int, default=100000, help="пользователей в чате для /stats")
+    suite_parser.add_argument("--stats-calls", type=int, default=200, help="запросов /stats")
+    suite_parser.add_argument("--themes", type=int, default=100, help="тем в шаблоне для /create")
+    suite_parser.add_argument("--create-runs", type=int, default=3, help="сколько групп создают темы")
+    suite_parser.add_argument("--no-memory", dest="memory", action="store_false",
+                              help="не замерять пик памяти (tracemalloc замедляет обработчики)")
+    suite_parser.add_argument("--save", help="сохранить результаты в JSON (базовый прогон)")
+    suite_parser.add_argument("--compare", help="сравнить с сохраненным прогоном")
+    suite_parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля")
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
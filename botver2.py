@@ -1,12 +1,37 @@
 import logging
 import asyncio
+import argparse
+import sys
 import json
 import os
 import datetime
-from collections import defaultdict, Counter
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-from telegram.error import TimedOut, RetryAfter, NetworkError
+import sqlite3
+import time
+import heapq
+import functools
+import itertools
+import random
+import csv
+import io
+import hmac
+import secrets
+import multiprocessing
+import queue
+import shutil
+import struct
+import mmap
+import threading
+import traceback
+import contextvars
+import concurrent.futures
+import copy
+import operator
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict, deque, Counter, OrderedDict
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.error import TimedOut, RetryAfter, NetworkError, BadRequest, Forbidden
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -18,10 +43,24 @@ logger = logging.getLogger(__name__)
 # Файлы для хранения настроек и статистики
 DATA_DIR = r"C:\Users\VybornovOA1\Desktop\py\bot_topic"  # Абсолютный путь к директории
 CONFIG_FILE = os.path.join(DATA_DIR, "bot_config.json")
-STATS_FILE = os.path.join(DATA_DIR, "user_stats.json")
+STATS_FILE = os.path.join(DATA_DIR, "user_stats.json")  # Прежний формат снимка; читается для перехода на бинарный
+STATS_SNAPSHOT_FILE = os.path.join(DATA_DIR, "user_stats.bin")
+STATS_JOURNAL_FILE = os.path.join(DATA_DIR, "user_stats.journal")
+DATABASE_FILE = os.path.join(DATA_DIR, "bot_data.sqlite3")
+ACTIVITY_FILE = os.path.join(DATA_DIR, "activity_stats.json")
+USER_NAMES_FILE = os.path.join(DATA_DIR, "user_names.json")
+CREATE_JOBS_DIR = os.path.join(DATA_DIR, "create_jobs")  # Записи о создании тем, по файлу на чат
+TRACE_FILE = os.path.join(DATA_DIR, "trace.json")  # Трассировка в режиме профилирования
+
+# Хранилище статистики и настроек: "json" (файлы) или "sqlite" (встроенная БД).
+# Выбирается ключом "storage" в bot_config.json
+STORAGE_BACKEND = "json"
+# Ключи, которые всегда остаются в bot_config.json, т.к. нужны до открытия хранилища
+BOOTSTRAP_CONFIG_KEYS = ("storage", "database_file")
 
 # Глобальные переменные для хранения конфигурации
 BOT_TOKEN = ""
+# Встроенный шаблон тем; используется, пока шаблон не задан в настройках
 MAIN_NAME = "Главная комната"
 THEMES = ["Доска", "Класс", "Новости", "Команда 1", "Команда2"]
 HELLO_MESSAGES = [
@@ -37,8 +76,693 @@ TEMPLATE_MESSAGES = [
     "💡 Чтобы начать, представьтесь в чате!"
 ]
 
-# Словарь для хранения статистики пользователей
-USER_STATS = defaultdict(lambda: defaultdict(Counter))
+class ThemeTemplate:
+    """Шаблон тем: названия, приветствия и индекс название -> позиция для поиска за O(1)."""
+    __slots__ = ("main_name", "themes", "hello_messages", "template_messages", "positions")
+
+    def __init__(self, main_name, themes, hello_messages, template_messages):
+        self.main_name = main_name
+        self.themes = list(themes)
+        self.hello_messages = list(hello_messages)
+        self.template_messages = list(template_messages)
+        self.sync_hello_messages()
+        self.reindex()
+
+    def __len__(self):
+        return len(self.themes)
+
+    def __contains__(self, theme_name):
+        return theme_name in self.positions
+
+    def sync_hello_messages(self):
+        """Синхронизирует количество приветственных сообщений с количеством тем."""
+        while len(self.hello_messages) < len(self.themes):
+            self.hello_messages.append(f"Добро пожаловать в тему {len(self.hello_messages) + 1}")
+        del self.hello_messages[len(self.themes):]
+
+    def reindex(self):
+        """Перестраивает индекс позиций (при повторах названий - первая позиция)."""
+        positions = {}
+        for i, theme_name in enumerate(self.themes):
+            positions.setdefault(theme_name, i)
+        self.positions = positions
+
+    def index(self, theme_name):
+        """Позиция темы по названию или None."""
+        return self.positions.get(theme_name)
+
+    def add(self, theme_name, hello_message):
+        self.positions.setdefault(theme_name, len(self.themes))
+        self.themes.append(theme_name)
+        self.hello_messages.append(hello_message)
+
+    def pop(self, index):
+        """Удаляет тему по позиции и возвращает (название, приветствие)."""
+        theme_name = self.themes.pop(index)
+        hello_message = self.hello_messages.pop(index)
+        self.reindex()
+        return theme_name, hello_message
+
+    def rename(self, index, new_name):
+        """Переименовывает тему по позиции и возвращает прежнее название."""
+        old_name = self.themes[index]
+        self.themes[index] = new_name
+        self.reindex()
+        return old_name
+
+    def replace_themes(self, themes, hello_messages):
+        """Заменяет весь список тем и приветствий."""
+        self.themes = list(themes)
+        self.hello_messages = list(hello_messages)
+        self.sync_hello_messages()
+        self.reindex()
+
+    def copy(self):
+        return ThemeTemplate(self.main_name, self.themes, self.hello_messages, self.template_messages)
+
+    def to_dict(self):
+        return {
+            "main_name": self.main_name,
+            "themes": self.themes,
+            "hello_messages": self.hello_messages,
+            "template_messages": self.template_messages
+        }
+
+    @classmethod
+    def from_dict(cls, data, default):
+        """Создает шаблон из настроек; отсутствующие поля берутся из шаблона default."""
+        return cls(
+            data.get("main_name", default.main_name),
+            data.get("themes", default.themes),
+            data.get("hello_messages", default.hello_messages),
+            data.get("template_messages", default.template_messages)
+        )
+
+# Шаблон по умолчанию (из main_name/themes/... в настройках) и собственные шаблоны групп
+# (ключ "chat_templates"). Группа получает свою копию шаблона при первом изменении тем из нее
+DEFAULT_TEMPLATE = ThemeTemplate(MAIN_NAME, THEMES, HELLO_MESSAGES, TEMPLATE_MESSAGES)
+CHAT_TEMPLATES = {}  # chat_id -> ThemeTemplate
+
+# Типы контента, по которым ведется статистика; индекс типа - номер столбца в строке счетчиков
+CONTENT_TYPES = ("text", "photo", "sticker", "video", "animation", "document", "voice", "audio")
+CONTENT_TYPE_INDEX = {content_type: i for i, content_type in enumerate(CONTENT_TYPES)}
+NUM_CONTENT_TYPES = len(CONTENT_TYPES)
+_EMPTY_STATS_ROW = array("I", [0] * NUM_CONTENT_TYPES)
+
+LEADERBOARD_SIZE = 10  # Сколько пользователей показывает /stats
+
+class Leaderboard:
+    """Топ-K пользователей чата по общему числу сообщений, упорядоченный по убыванию."""
+    __slots__ = ("size", "entries", "members")
+    
+    def __init__(self, size, totals):
+        self.size = size
+        # Элементы (-total, user_id): по возрастанию кортежа = по убыванию total, при равенстве - по user_id
+        self.entries = heapq.nsmallest(size, ((-total, user_id) for total, user_id in totals))
+        self.members = {user_id: -neg_total for neg_total, user_id in self.entries}
+    
+    def update(self, user_id, total):
+        """Учитывает новый общий счет пользователя (счетчики только растут).
+        
+        Возвращает True, если состав или порядок топа изменился.
+        """
+        old_total = self.members.get(user_id)
+        if old_total is not None:
+            del self.entries[bisect_left(self.entries, (-old_total, user_id))]
+        elif len(self.entries) >= self.size:
+            if (-total, user_id) >= self.entries[-1]:
+                return False
+            _, evicted = self.entries.pop()
+            del self.members[evicted]
+        insort(self.entries, (-total, user_id))
+        self.members[user_id] = total
+        return True
+    
+    def top(self):
+        return [(user_id, -neg_total) for neg_total, user_id in self.entries]
+
+class ChatStats:
+    """Статистика одного чата: строки счетчиков пользователей в одном плоском массиве."""
+    __slots__ = ("user_slots", "counts", "totals", "leaderboard", "version", "rendered")
+    
+    def __init__(self):
+        self.user_slots = {}  # user_id (int) -> номер строки
+        self.counts = array("I")  # NUM_CONTENT_TYPES счетчиков на каждую строку
+        self.totals = array("I")  # Общее число сообщений на каждую строку
+        self.leaderboard = None  # Строится при первом запросе /stats, затем обновляется инкрементально
+        self.version = 0  # Увеличивается, когда меняется то, что показывает /stats
+        self.rendered = None  # Кэш готового ответа /stats: (version, текст)
+    
+    def __len__(self):
+        return len(self.user_slots)
+    
+    def __contains__(self, user_id):
+        return user_id in self.user_slots
+    
+    def slot(self, user_id):
+        """Возвращает смещение строки пользователя, создавая ее при необходимости."""
+        slot = self.user_slots.get(user_id)
+        if slot is None:
+            slot = len(self.user_slots)
+            self.user_slots[user_id] = slot
+            self.counts.extend(_EMPTY_STATS_ROW)
+            self.totals.append(0)
+            # Изменилось число пользователей, которое показывает /stats
+            self.version += 1
+        return slot * NUM_CONTENT_TYPES
+    
+    def increment(self, user_id, type_index):
+        """Увеличивает счетчик и возвращает его новое значение."""
+        offset = self.slot(user_id) + type_index
+        self.counts[offset] += 1
+        slot = offset // NUM_CONTENT_TYPES
+        self.totals[slot] += 1
+        if self.leaderboard is not None and self.leaderboard.update(user_id, self.totals[slot]):
+            self.version += 1
+        return self.counts[offset]
+    
+    def set_max(self, user_id, type_index, value):
+        """Устанавливает счетчик не меньше value (для загрузки и повтора журнала)."""
+        offset = self.slot(user_id) + type_index
+        if value > self.counts[offset]:
+            self.totals[offset // NUM_CONTENT_TYPES] += value - self.counts[offset]
+            self.counts[offset] = value
+            self.leaderboard = None
+            self.version += 1
+    
+    def row(self, user_id):
+        """Возвращает строку счетчиков пользователя."""
+        offset = self.user_slots[user_id] * NUM_CONTENT_TYPES
+        return self.counts[offset:offset + NUM_CONTENT_TYPES]
+    
+    def total(self, user_id):
+        return self.totals[self.user_slots[user_id]]
+    
+    def top(self, limit):
+        """Возвращает [(user_id, total)] для limit самых активных пользователей."""
+        if limit > LEADERBOARD_SIZE:
+            # Тот же порядок, что и в Leaderboard: при равном total выше меньший user_id
+            return [(user_id, -neg_total) for neg_total, user_id in
+                    heapq.nsmallest(limit, ((-self.totals[slot], user_id) for user_id, slot in self.user_slots.items()))]
+        if self.leaderboard is None:
+            self.leaderboard = Leaderboard(
+                LEADERBOARD_SIZE,
+                ((self.totals[slot], user_id) for user_id, slot in self.user_slots.items())
+            )
+        return self.leaderboard.top()[:limit]
+    
+    def get(self, user_id):
+        """Возвращает счетчики пользователя в виде {тип контента: количество}."""
+        return {CONTENT_TYPES[i]: count for i, count in enumerate(self.row(user_id)) if count}
+    
+    def items(self):
+        for user_id in self.user_slots:
+            yield user_id, self.get(user_id)
+    
+    def copy(self):
+        """Копия счетчиков для записи в другом потоке (массивы копируются целиком, без обхода)."""
+        stats = ChatStats()
+        stats.user_slots = dict(self.user_slots)
+        stats.counts = self.counts[:]
+        stats.totals = self.totals[:]
+        return stats
+    
+    def to_dict(self):
+        """Экспортирует статистику в прежнем формате JSON: {"user_id": {"text": N, ...}}."""
+        return {str(user_id): stats for user_id, stats in self.items()}
+    
+    def to_block(self):
+        """Блок чата для бинарного снимка: user_id (int64), строки счетчиков и итоги (uint32)."""
+        # Порядок ключей user_slots совпадает с порядком строк
+        arrays = [array("q", self.user_slots), self.counts, self.totals]
+        if sys.byteorder != "little":
+            arrays = [values[:] for values in arrays]
+            for values in arrays:
+                values.byteswap()
+        return b"".join(values.tobytes() for values in arrays)
+    
+    @classmethod
+    def from_block(cls, data, users, content_types=CONTENT_TYPES):
+        """Восстанавливает статистику чата из блока бинарного снимка."""
+        type_count = len(content_types)
+        counts_start = 8 * users
+        totals_start = counts_start + 4 * users * type_count
+        user_ids, counts, totals = array("q"), array("I"), array("I")
+        user_ids.frombytes(data[:counts_start])
+        counts.frombytes(data[counts_start:totals_start])
+        totals.frombytes(data[totals_start:])
+        if sys.byteorder != "little":
+            for values in (user_ids, counts, totals):
+                values.byteswap()
+        stats = cls()
+        if content_types == CONTENT_TYPES:
+            stats.user_slots = dict(zip(user_ids, range(users)))
+            stats.counts = counts
+            stats.totals = totals
+            return stats
+        # Снимок записан с другим набором типов контента - переносим известные столбцы
+        for slot, user_id in enumerate(user_ids):
+            for column, content_type in enumerate(content_types):
+                type_index = CONTENT_TYPE_INDEX.get(content_type)
+                count = counts[slot * type_count + column]
+                if type_index is not None and count:
+                    stats.set_max(user_id, type_index, count)
+        return stats
+
+# Бинарный снимок статистики: заголовок, список типов контента, индекс чатов и блоки чатов
+# (см. ChatStats.to_block). Все числа - little-endian
+STATS_SNAPSHOT_MAGIC = b"TBST"
+STATS_SNAPSHOT_VERSION = 1
+STATS_SNAPSHOT_HEADER = struct.Struct("<4sHHII")  # сигнатура, версия, число типов, число чатов, длина списка типов
+STATS_SNAPSHOT_INDEX_ENTRY = struct.Struct("<qQI")  # chat_id, смещение блока, число пользователей
+
+def stats_block_size(users, type_count=NUM_CONTENT_TYPES):
+    return users * (8 + 4 * type_count + 4)
+
+class StatsSnapshot:
+    """Бинарный снимок, открытый через mmap: при открытии читается только индекс чатов."""
+    __slots__ = ("path", "file", "map", "content_types", "index", "lock")
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.content_types = CONTENT_TYPES
+        self.index = {}  # chat_id -> (смещение блока, число пользователей)
+        # Чтение чатов (цикл событий) и подмена файла (поток записи) не должны пересекаться
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.file, self.map, self.content_types, self.index = self.map_file(self.path)
+
+    @staticmethod
+    def map_file(path):
+        """Открывает файл снимка; возвращает (файл, mmap, типы контента, индекс чатов)."""
+        file = open(path, "rb")
+        data = None
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, type_count, chat_count, types_length = STATS_SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != STATS_SNAPSHOT_MAGIC or version != STATS_SNAPSHOT_VERSION:
+                raise ValueError(f"неизвестный формат снимка статистики {path}")
+            position = STATS_SNAPSHOT_HEADER.size
+            content_types = tuple(data[position:position + types_length].decode("ascii").split(","))
+            if len(content_types) != type_count:
+                raise ValueError(f"поврежден список типов контента в {path}")
+            position += types_length
+            index_data = data[position:position + chat_count * STATS_SNAPSHOT_INDEX_ENTRY.size]
+            index = {chat_id: (offset, users)
+                     for chat_id, offset, users in STATS_SNAPSHOT_INDEX_ENTRY.iter_unpack(index_data)}
+        except Exception:
+            if data is not None:
+                data.close()
+            file.close()
+            raise
+        return file, data, content_types, index
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+        self.file = self.map = None
+        self.index = {}
+
+    def block(self, chat_id):
+        """Байты блока чата (поток записи копирует неизмененные чаты в новый снимок без разбора)."""
+        offset, users = self.index[chat_id]
+        return self.map[offset:offset + stats_block_size(users, len(self.content_types))]
+
+    def read_chat(self, chat_id):
+        with self.lock:
+            users = self.index[chat_id][1]
+            data = self.block(chat_id)
+        return ChatStats.from_block(data, users, self.content_types)
+
+    def replace(self, tmp_path):
+        """Подменяет файл снимка записанным новым (в потоке записи).
+        
+        Новый файл открывается до подмены, а ссылки меняются разом: цикл событий, читающий index
+        без блокировки, видит либо прежний, либо новый индекс целиком. Если открыть или переименовать
+        новый файл не удалось, остается прежний снимок (под Windows отображенный в память файл
+        заменить нельзя, и запись снимка завершится ошибкой).
+        """
+        file, data, content_types, index = self.map_file(tmp_path)
+        try:
+            os.replace(tmp_path, self.path)
+        except Exception:
+            data.close()
+            file.close()
+            raise
+        with self.lock:
+            old_file, old_map = self.file, self.map
+            self.file, self.map, self.content_types, self.index = file, data, content_types, index
+        if old_map is not None:
+            old_map.close()
+        if old_file is not None:
+            old_file.close()
+
+class StatsStore(dict):
+    """chat_id -> ChatStats; чаты из бинарного снимка материализуются при первом обращении."""
+    __slots__ = ("snapshot", "lazy")
+
+    def __init__(self, snapshot):
+        super().__init__()
+        self.snapshot = snapshot
+        self.lazy = set(snapshot.index)  # Чаты снимка, еще не прочитанные в память
+
+    def __missing__(self, chat_id):
+        if chat_id in self.lazy:
+            stats = self.snapshot.read_chat(chat_id)
+            self.lazy.discard(chat_id)
+        else:
+            stats = ChatStats()
+        self[chat_id] = stats
+        return stats
+
+    def __contains__(self, chat_id):
+        return dict.__contains__(self, chat_id) or chat_id in self.lazy
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.lazy)
+
+    def get(self, chat_id, default=None):
+        return self[chat_id] if chat_id in self else default
+
+    def load_all(self):
+        for chat_id in list(self.lazy):
+            self[chat_id]
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def loaded_items(self):
+        """Только уже прочитанные в память чаты."""
+        return dict.items(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.lazy.clear()
+
+    def user_count(self):
+        index = self.snapshot.index
+        return sum(map(len, dict.values(self))) + sum(index.get(chat_id, (0, 0))[1] for chat_id in self.lazy)
+
+# Статистика пользователей: chat_id (int) -> ChatStats
+USER_STATS = StatsStore(StatsSnapshot(STATS_SNAPSHOT_FILE))
+
+# Глубина хранения активности по периодам (время в UTC)
+ACTIVITY_HOURS = 24  # Часовые корзины - для /stats day
+ACTIVITY_DAYS = 7  # Дневные итоги - для /stats week
+ACTIVITY_MONTHS = 12  # Месячные итоги - для /stats month
+ACTIVITY_SAVE_INTERVAL = 300  # Как часто сохранять активность на диск, сек
+ACTIVITY_PERIODS = {
+    "day": "day", "день": "day",
+    "week": "week", "неделя": "week",
+    "month": "month", "месяц": "month",
+}
+ACTIVITY_PERIOD_TITLES = {"day": "за последние 24 часа", "week": "за последние 7 дней", "month": "за текущий месяц"}
+
+def _month_of_hour(hour):
+    """Номер месяца (год * 12 + месяц) для номера часа от начала эпохи."""
+    date = datetime.datetime.fromtimestamp(hour * 3600, datetime.timezone.utc)
+    return date.year * 12 + date.month - 1
+
+class ChatActivity:
+    """Активность чата по периодам: кольцо часовых корзин, свернутое в дневные и месячные итоги."""
+    __slots__ = ("hours", "days", "months", "current_hour")
+    
+    def __init__(self):
+        # Каждая корзина - пара [номер периода, Counter(user_id -> количество)]
+        self.hours = [None] * ACTIVITY_HOURS
+        self.days = [None] * ACTIVITY_DAYS
+        self.months = [None] * ACTIVITY_MONTHS
+        self.current_hour = None  # Открытый час, еще не свернутый в итоги
+    
+    @staticmethod
+    def _bucket(ring, number):
+        """Возвращает счетчик корзины для периода number, вытесняя устаревшую корзину."""
+        slot = number % len(ring)
+        bucket = ring[slot]
+        if bucket is None or bucket[0] != number:
+            bucket = ring[slot] = [number, Counter()]
+        return bucket[1]
+    
+    def advance(self, hour):
+        """Закрывает открытый час (сворачивая его в итоги дня и месяца) и открывает час hour."""
+        if self.current_hour == hour:
+            return
+        if self.current_hour is not None:
+            closed = self.hours[self.current_hour % ACTIVITY_HOURS]
+            if closed is not None and closed[0] == self.current_hour and closed[1]:
+                self._bucket(self.days, self.current_hour // 24).update(closed[1])
+                self._bucket(self.months, _month_of_hour(self.current_hour)).update(closed[1])
+        self.current_hour = hour
+        self._bucket(self.hours, hour)
+    
+    def increment(self, user_id, hour):
+        self.advance(hour)
+        self.hours[hour % ACTIVITY_HOURS][1][user_id] += 1
+    
+    def totals(self, period, hour):
+        """Возвращает Counter(user_id -> количество) за период, не просматривая сырые данные."""
+        self.advance(hour)
+        open_hour = self.hours[hour % ACTIVITY_HOURS][1]
+        result = Counter()
+        if period == "day":
+            for bucket in self.hours:
+                if bucket is not None and bucket[0] > hour - ACTIVITY_HOURS:
+                    result.update(bucket[1])
+        elif period == "week":
+            today = hour // 24
+            for bucket in self.days:
+                if bucket is not None and bucket[0] > today - ACTIVITY_DAYS:
+                    result.update(bucket[1])
+            result.update(open_hour)
+        elif period == "month":
+            month = _month_of_hour(hour)
+            bucket = self.months[month % ACTIVITY_MONTHS]
+            if bucket is not None and bucket[0] == month:
+                result.update(bucket[1])
+            result.update(open_hour)
+        return result
+    
+    def to_dict(self):
+        def ring_to_list(ring):
+            return [[bucket[0], {str(user_id): count for user_id, count in bucket[1].items()}]
+                    for bucket in ring if bucket is not None]
+        return {
+            "current_hour": self.current_hour,
+            "hours": ring_to_list(self.hours),
+            "days": ring_to_list(self.days),
+            "months": ring_to_list(self.months),
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        activity = cls()
+        for ring, key in ((activity.hours, "hours"), (activity.days, "days"), (activity.months, "months")):
+            for number, counts in data.get(key, []):
+                ring[number % len(ring)] = [number, Counter({int(user_id): count for user_id, count in counts.items()})]
+        activity.current_hour = data.get("current_hour")
+        return activity
+
+# Активность пользователей по периодам: chat_id (int) -> ChatActivity
+CHAT_ACTIVITY = defaultdict(ChatActivity)
+_activity_dirty = False
+_activity_saved_at = 0.0
+
+# Справочник имен пользователей: user_id (int) -> (имя, время обновления), в порядке LRU
+USER_NAMES = OrderedDict()
+USER_NAMES_MAX = 100000  # Максимальное число имен в справочнике
+USER_NAME_TTL = 7 * 24 * 3600  # Через сколько секунд имя считается устаревшим
+USER_NAME_FETCH_CONCURRENCY = 5  # Одновременных запросов get_chat_member при разрешении имен
+_user_names_dirty = False
+
+# Параметры записи статистики: каждое изменение дописывается в журнал,
+# журнал периодически сворачивается в снимок STATS_FILE
+STATS_FLUSH_INTERVAL = 30  # Максимальный интервал сброса журнала на диск, сек
+STATS_FLUSH_THRESHOLD = 500  # Количество записей в буфере, после которого сбрасываем досрочно
+STATS_COMPACT_THRESHOLD = 20000  # Количество записей в журнале, после которого делаем снимок
+DIRTY_STATS_CHATS = set()  # Чаты, статистика которых изменилась с последнего снимка
+_pending_stats_updates = 0  # Записи журнала, еще не сброшенные на диск
+_journal_records = 0  # Записи журнала, еще не свернутые в снимок
+_journal_lines = []  # Записи журнала, еще не переданные потоку записи
+_journal_file = None  # Файл журнала принадлежит потоку записи
+_journal_backlog = []  # Записи, которые не удалось записать в журнал (повторяются при следующем сбросе)
+_stats_flush_event = None
+_background_tasks = []
+
+# Настройки в памяти - единственный источник истины во время работы бота.
+# Запись на диск отложенная (config_writer), внешние правки подхватывает config_watcher
+CONFIG = {}
+CONFIG_SAVE_DELAY = 1.0  # Сколько секунд копить изменения настроек перед записью
+CONFIG_WATCH_INTERVAL = 2.0  # Как часто проверять, не изменен ли файл настроек извне, сек
+_config_dirty = False
+_config_save_event = None
+_config_stamp = None  # Отметка версии файла (или БД) после нашей последней записи или чтения
+_config_changes = 0  # Счетчик изменений настроек из бота (см. reload_config)
+
+# Состояние SQLite-хранилища
+_db_local = threading.local()  # Соединение каждого потока: основного (запуск, остановка) и потока записи
+_sqlite_pending_stats = Counter()  # Накопленные приращения (chat_id, user_id, content_type) -> count
+_sqlite_backlog = Counter()  # Приращения, которые поток записи не смог сохранить
+
+# ==================== ФОНОВАЯ ЗАПИСЬ НА ДИСК ====================
+
+# Вся запись на диск идет через один поток: цикл событий только снимает неизменяемую копию данных
+# и ставит задание в очередь, сериализация и запись выполняются в потоке в порядке постановки.
+# До post_init и после post_shutdown поток не запущен, и задания выполняются сразу
+PERSIST_QUEUE_MAX = 64  # Заданий в очереди и столько же отложенных; дальше run() и ready() ждут места
+
+class PersistenceExecutor:
+    """Единственный поток записи: задания выполняются по одному в порядке постановки.
+    
+    submit() не блокирует цикл событий: при заполненной очереди задание откладывается в overflow
+    и переносится в очередь по мере ее освобождения, сохраняя порядок. Отложенные задания
+    объединяются (см. submit), а run() и ready() ждут, пока в overflow не освободится место,
+    поэтому задания без объединения не копятся без ограничения.
+    """
+    __slots__ = ("jobs", "thread", "overflow", "lock", "waiters")
+
+    def __init__(self, max_jobs=PERSIST_QUEUE_MAX):
+        self.jobs = queue.Queue(max_jobs)
+        self.thread = None
+        self.overflow = OrderedDict()  # ключ -> [func, args, future, merge], ожидающее места в очереди
+        self.lock = threading.Lock()
+        self.waiters = []  # concurrent.futures.Future ожидающих места в overflow
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, name="persistence", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Дожидается выполнения поставленных заданий и останавливает поток."""
+        if self.thread is None:
+            return
+        with self.lock:
+            try:
+                if self.overflow:
+                    raise queue.Full
+                self.jobs.put_nowait(None)
+            except queue.Full:
+                self.overflow[object()] = None  # Поток записи перенесет его в очередь после остальных
+        self.thread.join()
+        self.thread = None
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            self.refill()
+            if job is None:
+                return
+            self.execute(*job[:3])
+
+    def refill(self):
+        """Переносит отложенные задания в освободившуюся очередь и будит ждущих места (в потоке записи)."""
+        with self.lock:
+            while self.overflow and not self.jobs.full():
+                self.jobs.put_nowait(self.overflow.popitem(last=False)[1])
+            if len(self.overflow) < self.jobs.maxsize:
+                waiters, self.waiters = self.waiters, []
+            else:
+                waiters = ()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def ready(self):
+        """Ждет, пока в отложенных заданиях есть место (обратное давление для сопрограмм)."""
+        while True:
+            with self.lock:
+                if len(self.overflow) < self.jobs.maxsize:
+                    return
+                waiter = concurrent.futures.Future()
+                self.waiters.append(waiter)
+            await asyncio.wrap_future(waiter)
+
+    @staticmethod
+    def execute(func, args, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            logger.error(f"Ошибка в задании записи {func.__name__}: {e}")
+            future.set_exception(e)
+
+    def submit(self, func, *args, key=None, merge=None):
+        """Ставит задание в очередь и возвращает concurrent.futures.Future с его результатом.
+        
+        key указывают задания, записывающие состояние целиком: отложенное задание с теми же func и key
+        получает новые аргументы, оставаясь на своем месте в порядке выполнения, а Future обоих
+        заданий - один результат. merge(старый, новый) указывают задания-приращения с одним аргументом:
+        задание, отложенное последним, с той же func и merge дополняется новым аргументом.
+        """
+        future = concurrent.futures.Future()
+        if self.thread is None:
+            self.execute(func, args, future)
+            return future
+        with self.lock:
+            if not self.overflow:
+                try:
+                    self.jobs.put_nowait([func, args, future, merge])
+                    return future
+                except queue.Full:
+                    logger.warning("Очередь записи на диск переполнена, задания откладываются и объединяются")
+            pending = self.overflow.get((func, key)) if key is not None else None
+            if pending is None and merge is not None:
+                last = self.overflow[next(reversed(self.overflow))]
+                if last is not None and last[0] is func and last[3] is merge:
+                    pending = last
+                    args = (merge(last[1][0], args[0]),)
+            if pending is None:
+                self.overflow[(func, key) if key is not None else object()] = [func, args, future, merge]
+                return future
+            # Объединение на месте: порядок относительно остальных заданий не меняется
+            replaced = pending[2]
+            pending[1] = args
+            pending[2] = future
+        future.add_done_callback(functools.partial(self.copy_result, replaced))
+        return future
+
+    @staticmethod
+    def copy_result(target, future):
+        if future.cancelled():
+            target.cancel()
+        elif target.set_running_or_notify_cancel():
+            if future.exception() is not None:
+                target.set_exception(future.exception())
+            else:
+                target.set_result(future.result())
+
+    async def run(self, func, *args):
+        """Выполняет задание в потоке записи и возвращает результат, не блокируя цикл событий."""
+        await self.ready()
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+PERSISTENCE = PersistenceExecutor()
+
+def call_when_done(future, callback):
+    """Вызывает callback(результат задания или None при ошибке) в потоке цикла событий."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None  # Цикл не запущен - задание уже выполнено в этом же потоке
+    
+    def done(future):
+        result = None if future.exception() is not None else future.result()
+        if loop is None:
+            callback(result)
+        else:
+            loop.call_soon_threadsafe(callback, result)
+    
+    future.add_done_callback(done)
 
 def ensure_data_directory():
     """Создает директорию для хранения данных, если она еще не существует."""
@@ -46,12 +770,24 @@ def ensure_data_directory():
         os.makedirs(DATA_DIR)
         logger.info(f"Создана директория для данных: {DATA_DIR}")
 
-# Загрузка конфигурации
-def load_config():
+def load_bootstrap_config():
+    """Читает bot_config.json напрямую, независимо от выбранного хранилища."""
     ensure_data_directory()
     if os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             return json.load(f)
+    return {}
+
+# Загрузка конфигурации
+def load_config():
+    if STORAGE_BACKEND == "sqlite":
+        config = load_sqlite_config()
+        if config:
+            return config
+    else:
+        config = load_bootstrap_config()
+        if config:
+            return config
     return {
         "bot_token": "",
         "main_name": MAIN_NAME,
@@ -60,127 +796,1318 @@ def load_config():
         "template_messages": TEMPLATE_MESSAGES
     }
 
-# Сохранение конфигурации
+def atomic_write_text(path, text):
+    """Атомарно записывает файл: сначала во временный файл, затем переименовывает."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Сохранение конфигурации (в потоке записи - из копии CONFIG)
 def save_config(config):
     ensure_data_directory()
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    if STORAGE_BACKEND == "sqlite":
+        save_sqlite_config(config)
+        return
+    atomic_write_text(CONFIG_FILE, json.dumps(config, ensure_ascii=False, indent=4))
+
+# Загрузка статистики пользователей
+def load_user_stats():
+    global USER_STATS, _journal_records
+    ensure_data_directory()
+    close_stats_journal()
+    USER_STATS.snapshot.close()
+    DIRTY_STATS_CHATS.clear()
+    _journal_records = 0
+    snapshot = StatsSnapshot(STATS_SNAPSHOT_FILE)
+    if os.path.exists(STATS_SNAPSHOT_FILE):
+        try:
+            # Читается только индекс; счетчики чата - при первом обращении к нему
+            snapshot.open()
+            USER_STATS = StatsStore(snapshot)
+            logger.info(f"Снимок статистики {STATS_SNAPSHOT_FILE} открыт: чатов {len(snapshot.index)}")
+            if snapshot.content_types != CONTENT_TYPES:
+                # Блоки в другом формате нельзя переносить в новый снимок как есть
+                USER_STATS.load_all()
+                DIRTY_STATS_CHATS.update(dict.keys(USER_STATS))
+                logger.info("Набор типов контента изменился, снимок статистики будет перезаписан")
+            replay_stats_journal()
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при открытии снимка статистики {STATS_SNAPSHOT_FILE}: {e}")
+    USER_STATS = StatsStore(snapshot)
+    if os.path.exists(STATS_FILE):
+        try:
+            with open(STATS_FILE, "r", encoding="utf-8") as f:
+                # Преобразуем загруженные данные в компактный формат ChatStats
+                data = json.load(f)
+                for chat_id, chat_data in data.items():
+                    chat_stats = USER_STATS[int(chat_id)]
+                    for user_id, user_data in chat_data.items():
+                        for content_type, count in user_data.items():
+                            type_index = CONTENT_TYPE_INDEX.get(content_type)
+                            if type_index is None:
+                                logger.warning(f"Пропущен неизвестный тип контента в статистике: {content_type}")
+                                continue
+                            chat_stats.set_max(int(user_id), type_index, count)
+            # При следующем сохранении статистика будет записана в бинарном формате
+            DIRTY_STATS_CHATS.update(dict.keys(USER_STATS))
+            logger.info(f"Статистика пользователей загружена из {STATS_FILE}, "
+                        f"при сохранении она будет переведена в {STATS_SNAPSHOT_FILE}")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке статистики: {e}")
+            USER_STATS = StatsStore(snapshot)
+    else:
+        logger.info(f"Файл статистики {STATS_SNAPSHOT_FILE} не найден, создан новый словарь статистики")
+    
+    replay_stats_journal()
+
+def replay_stats_journal():
+    """Применяет к загруженному снимку записи журнала, сделанные после него."""
+    global _journal_records
+    if not os.path.exists(STATS_JOURNAL_FILE):
+        return
+    
+    replayed = 0
+    with open(STATS_JOURNAL_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            # Последняя строка может быть оборвана при аварийном завершении
+            if len(parts) != 4 or not parts[3].isdigit() or parts[2] not in CONTENT_TYPE_INDEX:
+                continue
+            chat_id, user_id, content_type, count = parts
+            chat_id = int(chat_id)
+            # В журнале хранится итоговое значение счетчика, поэтому повторное
+            # применение записи (например, уже попавшей в снимок) безопасно
+            USER_STATS[chat_id].set_max(int(user_id), CONTENT_TYPE_INDEX[content_type], int(count))
+            DIRTY_STATS_CHATS.add(chat_id)
+            replayed += 1
+    
+    _journal_records = replayed
+    if replayed:
+        logger.info(f"Из журнала {STATS_JOURNAL_FILE} восстановлено записей: {replayed}")
+
+def append_stats_journal(chat_id, user_id, content_type, count):
+    """Дописывает в журнал новое значение счетчика."""
+    global _journal_records, _pending_stats_updates
+    _journal_lines.append(f"{chat_id}\t{user_id}\t{content_type}\t{count}\n")
+    _journal_records += 1
+    _pending_stats_updates += 1
+
+def close_stats_journal():
+    """Сбрасывает и закрывает файл журнала, дожидаясь записи."""
+    flush_user_stats()
+    PERSISTENCE.submit(close_journal_file).result()
+
+def close_journal_file():
+    global _journal_file
+    if _journal_file is not None:
+        _journal_file.close()
+        _journal_file = None
+
+def stats_snapshot():
+    """Неизменяемая копия статистики для снимка: [(chat_id, копия ChatStats или None)].
+    
+    Копируются только измененные чаты и чаты, которых нет в текущем снимке; остальные (None)
+    поток записи переносит из текущего снимка. Индекс снимка меняет только поток записи, и чаты
+    из него не пропадают, поэтому проверка без блокировки дает в худшем случае лишнюю копию.
+    """
+    index = USER_STATS.snapshot.index
+    snapshot = [
+        (chat_id, chat_data.copy() if chat_id in DIRTY_STATS_CHATS or chat_id not in index else None)
+        for chat_id, chat_data in USER_STATS.loaded_items()
+    ]
+    snapshot.extend((chat_id, None) for chat_id in USER_STATS.lazy)
+    DIRTY_STATS_CHATS.clear()
+    return snapshot
+
+# Сохранение статистики пользователей (в потоке записи)
+def save_user_stats(source, snapshot):
+    global STATS_SNAPSHOT_BYTES
+    try:
+        ensure_data_directory()
+        types_data = ",".join(CONTENT_TYPES).encode("ascii")
+        header = STATS_SNAPSHOT_HEADER.pack(STATS_SNAPSHOT_MAGIC, STATS_SNAPSHOT_VERSION, NUM_CONTENT_TYPES,
+                                            len(snapshot), len(types_data))
+        offset = len(header) + len(types_data) + len(snapshot) * STATS_SNAPSHOT_INDEX_ENTRY.size
+        index = []
+        for chat_id, chat_data in snapshot:
+            users = len(chat_data) if chat_data is not None else source.index[chat_id][1]
+            index.append(STATS_SNAPSHOT_INDEX_ENTRY.pack(chat_id, offset, users))
+            offset += stats_block_size(users)
+        
+        tmp_path = source.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(types_data)
+            f.write(b"".join(index))
+            # Измененные чаты сериализуются из копий, остальные блоки переносятся байт в байт
+            for chat_id, chat_data in snapshot:
+                f.write(chat_data.to_block() if chat_data is not None else source.block(chat_id))
+            f.flush()
+            os.fsync(f.fileno())
+        source.replace(tmp_path)
+        STATS_SNAPSHOT_BYTES = offset
+        changed = sum(chat_data is not None for _, chat_data in snapshot)
+        logger.info(f"Статистика пользователей сохранена в {source.path} (записано заново чатов: {changed})")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении статистики: {e}")
+        return False
+
+def write_stats_journal(lines):
+    """Дописывает записи в журнал и сбрасывает его на диск (в потоке записи)."""
+    global _journal_file
+    _journal_backlog.extend(lines)
+    try:
+        if _journal_file is None:
+            ensure_data_directory()
+            _journal_file = open(STATS_JOURNAL_FILE, "a", encoding="utf-8")
+        _journal_file.writelines(_journal_backlog)
+        _journal_file.flush()
+        os.fsync(_journal_file.fileno())
+        _journal_backlog.clear()
+    except Exception as e:
+        # Повтор записи безопасен: в журнале хранятся итоговые значения счетчиков
+        logger.error(f"Ошибка при записи журнала статистики: {e}")
+
+def write_stats_snapshot(source, snapshot):
+    """Записывает снимок статистики и обнуляет журнал (в потоке записи)."""
+    global _journal_file
+    if not save_user_stats(source, snapshot):
+        return False
+    # Снимок уже содержит все записи журнала, поставленные до него, теперь журнал можно обнулить
+    if _journal_file is not None:
+        _journal_file.close()
+    _journal_file = open(STATS_JOURNAL_FILE, "w", encoding="utf-8")
+    return True
+
+def flush_user_stats():
+    """Передает буфер журнала статистики потоку записи; возвращает Future или None."""
+    global _pending_stats_updates, _journal_lines
+    if STORAGE_BACKEND == "sqlite":
+        return flush_sqlite_stats()
+    if not _journal_lines:
+        return None
+    lines, _journal_lines = _journal_lines, []
+    _pending_stats_updates = 0
+    return PERSISTENCE.submit(write_stats_journal, lines, merge=operator.concat)
+
+def compact_user_stats():
+    """Сворачивает журнал в снимок статистики и очищает журнал; возвращает Future или None."""
+    global _journal_records
+    if not _journal_records and not DIRTY_STATS_CHATS:
+        return None
+    flush_user_stats()
+    records, _journal_records = _journal_records, 0
+    snapshot = stats_snapshot()
+    written = PERSISTENCE.submit(write_stats_snapshot, USER_STATS.snapshot, snapshot)
+    
+    def restore_dirty_chats(saved):
+        # Снимок не записан: измененные чаты должны попасть в следующий снимок из памяти,
+        # а не из старых блоков, иначе после обнуления журнала их изменения пропадут
+        global _journal_records
+        if not saved:
+            DIRTY_STATS_CHATS.update(chat_id for chat_id, chat_data in snapshot if chat_data is not None)
+            _journal_records += records
+    
+    call_when_done(written, restore_dirty_chats)
+    return written
+
+async def stats_flusher():
+    """Фоновая задача: сбрасывает журнал по интервалу или порогу и сворачивает его в снимок."""
+    while True:
+        try:
+            await asyncio.wait_for(_stats_flush_event.wait(), timeout=STATS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _stats_flush_event.clear()
+        # На цикле событий только снимаются копии; ожидание записи не задерживает обработку обновлений
+        started, records = time.perf_counter(), _pending_stats_updates
+        written = flush_user_stats()
+        if written is not None:
+            trace_blocking("flush_user_stats", started)
+            await asyncio.wrap_future(written)
+            observe_stats_flush("sqlite" if STORAGE_BACKEND == "sqlite" else "journal", started, records)
+        if _journal_records >= STATS_COMPACT_THRESHOLD:
+            started, records = time.perf_counter(), _journal_records
+            written = compact_user_stats()
+            if written is not None:
+                trace_blocking("compact_user_stats", started)
+                await asyncio.wrap_future(written)
+                observe_stats_flush("snapshot", started, records)
+        if time.monotonic() - _activity_saved_at >= ACTIVITY_SAVE_INTERVAL:
+            started = time.perf_counter()
+            save_activity_stats()
+            save_user_names()
+            trace_blocking("save_activity_stats", started)
+
+def remember_user_name(user_id, name, updated_at=None):
+    """Запоминает имя пользователя в справочнике, вытесняя давно не использованные."""
+    global _user_names_dirty
+    now = time.time() if updated_at is None else updated_at
+    cached = USER_NAMES.get(user_id)
+    if cached is not None and cached[0] == name and now - cached[1] < USER_NAME_TTL / 2:
+        # Имя не изменилось и еще свежее - только отмечаем использование
+        USER_NAMES.move_to_end(user_id)
+        return
+    USER_NAMES[user_id] = (name, now)
+    USER_NAMES.move_to_end(user_id)
+    while len(USER_NAMES) > USER_NAMES_MAX:
+        USER_NAMES.popitem(last=False)
+    _user_names_dirty = True
+
+async def resolve_user_names(bot, chat_id, user_ids):
+    """Возвращает {user_id: имя}; неизвестные и устаревшие имена запрашивает параллельно."""
+    now = time.time()
+    names = {}
+    to_fetch = []
+    for user_id in user_ids:
+        cached = USER_NAMES.get(user_id)
+        if cached is not None:
+            names[user_id] = cached[0]
+            USER_NAMES.move_to_end(user_id)
+            if now - cached[1] < USER_NAME_TTL:
+                continue
+        to_fetch.append(user_id)
+    
+    semaphore = asyncio.Semaphore(USER_NAME_FETCH_CONCURRENCY)
+    
+    async def fetch(user_id):
+        async with semaphore:
+            try:
+                chat_member = await bot.get_chat_member(chat_id, user_id)
+            except Exception as e:
+                logger.debug(f"Не удалось получить имя пользователя {user_id}: {e}")
+                return
+        remember_user_name(user_id, chat_member.user.full_name)
+        names[user_id] = chat_member.user.full_name
+    
+    await asyncio.gather(*(fetch(user_id) for user_id in to_fetch))
+    # Если не удалось получить имя, используем ID
+    return {user_id: names.get(user_id, f"Пользователь {user_id}") for user_id in user_ids}
+
+def load_user_names():
+    """Загружает справочник имен пользователей."""
+    global _user_names_dirty
+    USER_NAMES.clear()
+    _user_names_dirty = False
+    if not os.path.exists(USER_NAMES_FILE):
+        return
+    try:
+        with open(USER_NAMES_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # Файл хранится в порядке LRU - от давно использованных к недавним
+        for user_id, (name, updated_at) in data:
+            USER_NAMES[int(user_id)] = (name, updated_at)
+        while len(USER_NAMES) > USER_NAMES_MAX:
+            USER_NAMES.popitem(last=False)
+        logger.info(f"Справочник имен загружен из {USER_NAMES_FILE}: {len(USER_NAMES)} пользователей")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке справочника имен: {e}")
+        USER_NAMES.clear()
+
+def save_user_names():
+    """Сохраняет справочник имен пользователей, если он изменился."""
+    global _user_names_dirty
+    if not _user_names_dirty:
+        return None
+    _user_names_dirty = False
+    data = [[user_id, [name, updated_at]] for user_id, (name, updated_at) in USER_NAMES.items()]
+    return PERSISTENCE.submit(write_user_names, data, key=USER_NAMES_FILE)
+
+def write_user_names(data):
+    global _user_names_dirty
+    try:
+        ensure_data_directory()
+        atomic_write_text(USER_NAMES_FILE, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    except Exception as e:
+        _user_names_dirty = True
+        logger.error(f"Ошибка при сохранении справочника имен: {e}")
+
+def current_hour():
+    """Номер текущего часа от начала эпохи (UTC)."""
+    return int(time.time() // 3600)
+
+def record_activity(chat_id, user_id):
+    """Учитывает сообщение пользователя в счетчиках активности по периодам."""
+    global _activity_dirty
+    CHAT_ACTIVITY[chat_id].increment(user_id, current_hour())
+    _activity_dirty = True
+
+def load_activity_stats():
+    """Загружает счетчики активности по периодам."""
+    global _activity_dirty
+    CHAT_ACTIVITY.clear()
+    _activity_dirty = False
+    if not os.path.exists(ACTIVITY_FILE):
+        return
+    try:
+        with open(ACTIVITY_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for chat_id, chat_data in data.items():
+            CHAT_ACTIVITY[int(chat_id)] = ChatActivity.from_dict(chat_data)
+        logger.info(f"Активность по периодам загружена из {ACTIVITY_FILE}")
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке активности по периодам: {e}")
+        CHAT_ACTIVITY.clear()
+
+def save_activity_stats():
+    """Сохраняет счетчики активности по периодам, если они изменились."""
+    global _activity_dirty, _activity_saved_at
+    _activity_saved_at = time.monotonic()
+    if not _activity_dirty:
+        return None
+    _activity_dirty = False
+    hour = current_hour()
+    data = {}
+    for chat_id, activity in CHAT_ACTIVITY.items():
+        activity.advance(hour)
+        data[str(chat_id)] = activity.to_dict()
+    return PERSISTENCE.submit(write_activity_stats, data, key=ACTIVITY_FILE)
+
+def write_activity_stats(data):
+    global _activity_dirty
+    try:
+        ensure_data_directory()
+        atomic_write_text(ACTIVITY_FILE, json.dumps(data, separators=(",", ":")))
+    except Exception as e:
+        _activity_dirty = True
+        logger.error(f"Ошибка при сохранении активности по периодам: {e}")
+
+# ==================== ХРАНИЛИЩЕ SQLITE ====================
+
+def get_db():
+    """Открывает (при необходимости) соединение SQLite текущего потока и создает схему.
+    
+    Соединения не разделяются между потоками: во время работы бота к базе обращается
+    только поток записи, при запуске и остановке - основной поток, каждый через свое соединение.
+    """
+    db = getattr(_db_local, "db", None)
+    if db is None:
+        ensure_data_directory()
+        db = sqlite3.connect(DATABASE_FILE)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS user_stats (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                content_type TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, user_id, content_type)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS user_totals (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, user_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_user_totals_top ON user_totals (chat_id, total DESC);
+            CREATE TABLE IF NOT EXISTS config (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        _db_local.db = db
+        logger.info(f"Открыта база данных {DATABASE_FILE} (поток {threading.current_thread().name})")
+    return db
+
+def close_db():
+    """Сохраняет накопленные изменения и закрывает соединение текущего потока."""
+    if getattr(_db_local, "db", None) is not None:
+        flush_sqlite_stats()
+        close_db_connection()
+
+def close_db_connection():
+    """Закрывает соединение текущего потока (поток записи закрывает свое заданием при остановке)."""
+    db = getattr(_db_local, "db", None)
+    if db is not None:
+        db.close()
+        _db_local.db = None
+
+def load_sqlite_config():
+    """Загружает настройки из таблицы config."""
+    rows = get_db().execute("SELECT key, value FROM config").fetchall()
+    return {key: json.loads(value) for key, value in rows}
+
+def save_sqlite_config(config):
+    """Сохраняет настройки в таблицу config одной транзакцией."""
+    db = get_db()
+    rows = [
+        (key, json.dumps(value, ensure_ascii=False))
+        for key, value in config.items()
+        if key not in BOOTSTRAP_CONFIG_KEYS
+    ]
+    with db:
+        db.execute("DELETE FROM config")
+        db.executemany("INSERT INTO config (key, value) VALUES (?, ?)", rows)
+
+def flush_sqlite_stats():
+    """Передает накопленные приращения статистики потоку записи; возвращает Future или None."""
+    global _pending_stats_updates
+    if not _sqlite_pending_stats:
+        return None
+    pending = list(_sqlite_pending_stats.items())
+    _sqlite_pending_stats.clear()
+    _pending_stats_updates = 0
+    return PERSISTENCE.submit(write_sqlite_stats, pending, merge=merge_sqlite_stats)
+
+def merge_sqlite_stats(pending, more):
+    """Объединяет приращения двух отложенных заданий записи статистики."""
+    merged = Counter(dict(pending))
+    for key, count in more:
+        merged[key] += count
+    return list(merged.items())
+
+def write_sqlite_stats(pending):
+    """Записывает приращения статистики одной транзакцией (в потоке записи)."""
+    if _sqlite_backlog:
+        _sqlite_backlog.update(dict(pending))
+        pending = list(_sqlite_backlog.items())
+        _sqlite_backlog.clear()
+    
+    totals = Counter()
+    for (chat_id, user_id, _), count in pending:
+        totals[(chat_id, user_id)] += count
+    
+    try:
+        db = get_db()
+        with db:
+            db.executemany(
+                "INSERT INTO user_stats (chat_id, user_id, content_type, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, user_id, content_type) DO UPDATE SET count = count + excluded.count",
+                [(chat_id, user_id, content_type, count) for (chat_id, user_id, content_type), count in pending]
+            )
+            db.executemany(
+                "INSERT INTO user_totals (chat_id, user_id, total) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET total = total + excluded.total",
+                [(chat_id, user_id, total) for (chat_id, user_id), total in totals.items()]
+            )
+    except Exception as e:
+        # Сохраняем приращения до следующей записи, чтобы не потерять их
+        for key, count in pending:
+            _sqlite_backlog[key] += count
+        logger.error(f"Ошибка при сохранении статистики в базу данных: {e}")
+
+def query_sqlite_top_users(chat_id, limit):
+    """Возвращает число пользователей чата и топ пользователей по индексу user_totals (в потоке записи)."""
+    db = get_db()
+    total_users = db.execute("SELECT COUNT(*) FROM user_totals WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+    top = db.execute(
+        "SELECT user_id, total FROM user_totals WHERE chat_id = ? ORDER BY total DESC, user_id LIMIT ?",
+        (chat_id, limit)
+    ).fetchall()
+    
+    result = []
+    for user_id, total in top:
+        rows = db.execute(
+            "SELECT content_type, count FROM user_stats WHERE chat_id = ? AND user_id = ?",
+            (chat_id, user_id)
+        ).fetchall()
+        result.append((user_id, total, dict(rows)))
+    return total_users, result
+
+def migrate_json_to_sqlite(bootstrap_config):
+    """Однократно переносит статистику и настройки из JSON-файлов в базу данных."""
+    db = get_db()
+    if db.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    
+    # Статистика: снимок плюс непримененный хвост журнала
+    load_user_stats()
+    close_stats_journal()
+    stats_rows = []
+    totals_rows = []
+    for chat_id, chat_data in USER_STATS.items():
+        for user_id, user_data in chat_data.items():
+            for content_type, count in user_data.items():
+                stats_rows.append((chat_id, user_id, content_type, count))
+            totals_rows.append((chat_id, user_id, sum(user_data.values())))
+    
+    config_rows = [
+        (key, json.dumps(value, ensure_ascii=False))
+        for key, value in bootstrap_config.items()
+        if key not in BOOTSTRAP_CONFIG_KEYS
+    ]
+    
+    with db:
+        db.executemany("INSERT OR REPLACE INTO user_stats VALUES (?, ?, ?, ?)", stats_rows)
+        db.executemany("INSERT OR REPLACE INTO user_totals VALUES (?, ?, ?)", totals_rows)
+        if not db.execute("SELECT 1 FROM config LIMIT 1").fetchone():
+            db.executemany("INSERT INTO config (key, value) VALUES (?, ?)", config_rows)
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+                   (datetime.datetime.now().isoformat(),))
+    
+    USER_STATS.clear()
+    DIRTY_STATS_CHATS.clear()
+    logger.info(
+        f"Данные перенесены в {DATABASE_FILE}: записей статистики {len(stats_rows)}, "
+        f"параметров настроек {len(config_rows)}. Файлы JSON оставлены без изменений, "
+        f"в {CONFIG_FILE} теперь используются только ключи {', '.join(BOOTSTRAP_CONFIG_KEYS)}"
+    )
+
+# Инициализация конфигурации
+def init_config():
+    global BOT_TOKEN
+    global STATS_FLUSH_INTERVAL, STATS_FLUSH_THRESHOLD, STATS_COMPACT_THRESHOLD
+    global STORAGE_BACKEND, DATABASE_FILE, METRICS_LISTEN, METRICS_PORT
+    global PROFILING_ENABLED, TRACE_FILE, PROFILE_BLOCK_THRESHOLD, PROFILE_SLOW_HANDLER, PROFILE_ASYNCIO_DEBUG
+    global CONCURRENT_UPDATES, CONCURRENT_UPDATES_PENDING, _config_stamp
+    
+    # Выбираем хранилище по bot_config.json
+    bootstrap_config = load_bootstrap_config()
+    STORAGE_BACKEND = bootstrap_config.get("storage", STORAGE_BACKEND)
+    DATABASE_FILE = bootstrap_config.get("database_file", DATABASE_FILE)
+    if STORAGE_BACKEND == "sqlite":
+        migrate_json_to_sqlite(bootstrap_config)
+    
+    config = load_config()
+    CONFIG.clear()
+    CONFIG.update(config)
+    _config_stamp = config_stamp()
+    BOT_TOKEN = config.get("bot_token", "")
+    apply_template_config(config)
+    STATS_FLUSH_INTERVAL = config.get("stats_flush_interval", STATS_FLUSH_INTERVAL)
+    STATS_FLUSH_THRESHOLD = config.get("stats_flush_threshold", STATS_FLUSH_THRESHOLD)
+    STATS_COMPACT_THRESHOLD = config.get("stats_compact_threshold", STATS_COMPACT_THRESHOLD)
+    METRICS_LISTEN = config.get("metrics_listen", METRICS_LISTEN)
+    METRICS_PORT = config.get("metrics_port", METRICS_PORT)
+    PROFILING_ENABLED = config.get("profiling", PROFILING_ENABLED)
+    TRACE_FILE = config.get("profile_trace_file", TRACE_FILE)
+    PROFILE_BLOCK_THRESHOLD = config.get("profile_block_threshold", PROFILE_BLOCK_THRESHOLD)
+    PROFILE_SLOW_HANDLER = config.get("profile_slow_handler", PROFILE_SLOW_HANDLER)
+    PROFILE_ASYNCIO_DEBUG = config.get("profile_asyncio_debug", PROFILE_ASYNCIO_DEBUG)
+    CONCURRENT_UPDATES = config.get("concurrent_updates", CONCURRENT_UPDATES)
+    CONCURRENT_UPDATES_PENDING = config.get("concurrent_updates_pending", CONCURRENT_UPDATES_PENDING)
+    API_SCHEDULER.configure(
+        config.get("rate_limit_global_per_sec", RATE_LIMIT_GLOBAL_PER_SEC),
+        config.get("rate_limit_group_per_min", RATE_LIMIT_GROUP_PER_MIN),
+        config.get("rate_limit_group_burst", RATE_LIMIT_GROUP_BURST),
+        config.get("rate_limit_private_per_sec", RATE_LIMIT_PRIVATE_PER_SEC),
+    )
+    
+    # Загружаем статистику пользователей (в SQLite она читается по запросу)
+    if STORAGE_BACKEND != "sqlite":
+        load_user_stats()
+    load_activity_stats()
+    load_user_names()
+    
+    return CONFIG
+
+def apply_template_config(config):
+    """Применяет шаблоны тем из настроек (при запуске и при горячей перезагрузке)."""
+    global DEFAULT_TEMPLATE, _default_template_stamp
+    builtin = ThemeTemplate(MAIN_NAME, THEMES, HELLO_MESSAGES, TEMPLATE_MESSAGES)
+    DEFAULT_TEMPLATE = ThemeTemplate.from_dict(config, builtin)
+    _default_template_stamp = time.time_ns()
+    CHAT_TEMPLATES.clear()
+    for chat_id, data in config.get("chat_templates", {}).items():
+        CHAT_TEMPLATES[int(chat_id)] = ThemeTemplate.from_dict(data, DEFAULT_TEMPLATE)
+
+def config_stamp():
+    """Отметка версии хранилища настроек: меняется, когда настройки изменены извне."""
+    if STORAGE_BACKEND == "sqlite":
+        # data_version не меняется от записей через это же соединение
+        return get_db().execute("PRAGMA data_version").fetchone()[0]
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def schedule_config_save():
+    """Отмечает настройки измененными; запись выполнит config_writer с небольшой задержкой."""
+    global _config_dirty, _config_changes
+    _config_dirty = True
+    _config_changes += 1
+    if _config_save_event is not None:
+        _config_save_event.set()
+    else:
+        # Цикл событий еще не запущен - записываем сразу
+        flush_config()
+
+def flush_config():
+    """Передает копию настроек потоку записи, если они изменились; возвращает Future или None."""
+    global _config_dirty
+    if not _config_dirty:
+        return None
+    _config_dirty = False
+    return PERSISTENCE.submit(write_config, copy.deepcopy(CONFIG), key=CONFIG_FILE)
+
+def write_config(config):
+    """Записывает настройки на диск (в потоке записи)."""
+    global _config_dirty, _config_stamp
+    try:
+        save_config(config)
+        _config_stamp = config_stamp()
+    except Exception as e:
+        _config_dirty = True
+        logger.error(f"Ошибка при сохранении настроек: {e}")
+
+async def config_writer():
+    """Фоновая задача: объединяет частые изменения настроек в одну атомарную запись."""
+    while True:
+        await _config_save_event.wait()
+        await asyncio.sleep(CONFIG_SAVE_DELAY)
+        _config_save_event.clear()
+        started = time.perf_counter()
+        flush_config()
+        trace_blocking("flush_config", started)
+
+def read_config_for_reload():
+    """Отметка версии и настройки (None при ошибке), прочитанные одним заданием потока записи."""
+    stamp = config_stamp()
+    try:
+        return stamp, load_config()
+    except Exception as e:
+        # Например, файл сохранен редактором не полностью - дождемся следующего изменения
+        logger.error(f"Не удалось перечитать настройки: {e}")
+        return stamp, None
+
+async def reload_config():
+    """Перечитывает настройки, измененные извне, и применяет шаблон тем без перезапуска."""
+    global _config_stamp
+    changes = _config_changes
+    stamp, config = await PERSISTENCE.run(read_config_for_reload)
+    if changes != _config_changes or _config_dirty:
+        # Пока файл читался, настройки изменили из бота: их запись перекроет прочитанное,
+        # а замена CONFIG потеряла бы эти изменения
+        logger.warning("Настройки изменены из бота во время перечитывания, внешние правки не применены")
+        return
+    # Дальше до конца функции нет ожиданий: CONFIG заменяется целиком, без промежуточных изменений
+    _config_stamp = stamp
+    if config is None:
+        return
+    
+    if config.get("bot_token", "") != BOT_TOKEN:
+        logger.warning("Токен бота изменен в настройках. Для применения требуется перезапуск бота")
+    CONFIG.clear()
+    CONFIG.update(config)
+    apply_template_config(config)
+    logger.info(f"Настройки перечитаны: тем в шаблоне по умолчанию {len(DEFAULT_TEMPLATE)}, "
+                f"собственных шаблонов групп {len(CHAT_TEMPLATES)}")
+
+async def config_watcher():
+    """Фоновая задача: следит за изменениями настроек извне и перечитывает их."""
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        try:
+            # Проверка идет в потоке записи после уже поставленных записей настроек
+            stamp = await PERSISTENCE.run(config_stamp)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке файла настроек: {e}")
+            continue
+        if stamp == _config_stamp:
+            continue
+        if _config_dirty:
+            # Несохраненные изменения из команд бота будут записаны поверх внешних
+            logger.warning("Настройки изменены извне одновременно с изменениями из бота, внешние правки перезаписаны")
+            continue
+        await reload_config()
+
+def get_chat_template(chat_id):
+    """Шаблон тем чата; чаты без собственного шаблона используют шаблон по умолчанию."""
+    return CHAT_TEMPLATES.get(chat_id, DEFAULT_TEMPLATE)
+
+def get_editable_template(chat):
+    """Шаблон, который изменяют команды из чата.
+    
+    В группе это собственный шаблон группы (копия шаблона по умолчанию создается
+    при первом изменении), в личном чате с ботом - шаблон по умолчанию.
+    """
+    if chat.type == "private":
+        return DEFAULT_TEMPLATE
+    template = CHAT_TEMPLATES.get(chat.id)
+    if template is None:
+        template = CHAT_TEMPLATES[chat.id] = DEFAULT_TEMPLATE.copy()
+    return template
+
+def save_themes_config(chat):
+    """Сохраняет шаблон тем, который изменяют команды из чата (см. get_editable_template)."""
+    global _default_template_stamp
+    if chat.type == "private":
+        CONFIG.update(DEFAULT_TEMPLATE.to_dict())
+        _default_template_stamp = time.time_ns()
+    else:
+        CONFIG.setdefault("chat_templates", {})[str(chat.id)] = CHAT_TEMPLATES[chat.id].to_dict()
+    schedule_config_save()
+
+# ==================== МЕТРИКИ ====================
+
+# Метрики отдаются в текстовом формате Prometheus по адресу http://METRICS_LISTEN:METRICS_PORT/metrics
+# (ключи "metrics_listen" и "metrics_port" в настройках; порт 0 - не запускать; шард N - порт + N)
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 0
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, как histogram в Prometheus."""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля: верхняя граница корзины, в которую он попадает."""
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return 0.0
+
+HANDLER_LATENCY = defaultdict(Histogram)  # имя обработчика -> длительность, сек
+API_CALLS = Counter()  # метод -> попыток вызова
+API_RETRIES = Counter()  # (метод, причина) -> повторных попыток
+API_FAILURES = Counter()  # метод -> вызовов, завершившихся ошибкой после всех попыток
+API_RETRY_AFTER_SECONDS = Counter()  # метод -> секунд ожидания по RetryAfter
+STATS_FLUSH_SECONDS = defaultdict(Histogram)  # вид сброса (journal, snapshot, sqlite) -> длительность
+STATS_FLUSH_RECORDS = Counter()  # вид сброса -> записанных изменений
+STATS_SNAPSHOT_BYTES = 0  # Размер последнего снимка статистики
+_metrics_application = None
+_metrics_server = None
+
+def timed_handler(callback):
+    """Оборачивает обработчик, измеряя длительность каждого вызова."""
+    histogram = HANDLER_LATENCY[callback.__name__]
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            histogram.observe(elapsed)
+            if TRACE is not None:
+                trace_handler(callback.__name__, started, elapsed)
+    
+    return wrapper
+
+def observe_stats_flush(kind, started, records):
+    """Учитывает сброс статистики на диск: длительность и число записанных изменений."""
+    STATS_FLUSH_SECONDS[kind].observe(time.perf_counter() - started)
+    STATS_FLUSH_RECORDS[kind] += records
+
+def render_metrics():
+    """Собирает метрики в текстовом формате Prometheus."""
+    lines = []
+    
+    def metric(name, kind, help_text):
+        lines.append(f"# HELP topicbot_{name} {help_text}")
+        lines.append(f"# TYPE topicbot_{name} {kind}")
+    
+    def histogram(name, label, histograms):
+        for key, hist in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(hist.buckets + ("+Inf",), hist.counts):
+                cumulative += count
+                lines.append(f'topicbot_{name}_bucket{{{label}="{key}",le="{bound}"}} {cumulative}')
+            lines.append(f'topicbot_{name}_sum{{{label}="{key}"}} {hist.sum}')
+            lines.append(f'topicbot_{name}_count{{{label}="{key}"}} {hist.count}')
+    
+    def counter(name, labels, values):
+        for key, value in sorted(values.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            label_text = ",".join(f'{label}="{value_}"' for label, value_ in zip(labels, key))
+            lines.append(f"topicbot_{name}{{{label_text}}} {value}")
+    
+    metric("handler_latency_seconds", "histogram", "Длительность обработчиков обновлений")
+    histogram("handler_latency_seconds", "handler", HANDLER_LATENCY)
+    metric("api_calls_total", "counter", "Попытки вызова методов Bot API через safe_api_call")
+    counter("api_calls_total", ("method",), API_CALLS)
+    metric("api_retries_total", "counter", "Повторные попытки вызова Bot API")
+    counter("api_retries_total", ("method", "reason"), API_RETRIES)
+    metric("api_failures_total", "counter", "Вызовы Bot API, завершившиеся ошибкой после всех попыток")
+    counter("api_failures_total", ("method",), API_FAILURES)
+    metric("api_retry_after_seconds_total", "counter", "Секунды ожидания по RetryAfter")
+    counter("api_retry_after_seconds_total", ("method",), API_RETRY_AFTER_SECONDS)
+    metric("stats_flush_seconds", "histogram", "Длительность сброса статистики на диск")
+    histogram("stats_flush_seconds", "kind", STATS_FLUSH_SECONDS)
+    metric("stats_flush_records_total", "counter", "Изменения статистики, записанные на диск")
+    counter("stats_flush_records_total", ("kind",), STATS_FLUSH_RECORDS)
+    metric("stats_snapshot_bytes", "gauge", "Размер последнего снимка статистики")
+    lines.append(f"topicbot_stats_snapshot_bytes {STATS_SNAPSHOT_BYTES}")
+    metric("metadata_cache_total", "counter", "Обращения к кэшу сведений о чатах")
+    counter("metadata_cache_total", ("result",), METADATA_CACHE_STATS)
+    if PROFILING_ENABLED:
+        metric("loop_lag_seconds", "histogram", "Задержка срабатывания таймеров цикла событий")
+        histogram("loop_lag_seconds", "loop", {"main": LOOP_LAG})
+    if _metrics_application is not None:
+        metric("update_queue_depth", "gauge", "Обновления, ожидающие обработки")
+        lines.append(f"topicbot_update_queue_depth {_metrics_application.update_queue.qsize()}")
+        processor = _metrics_application.update_processor
+        if isinstance(processor, ChatOrderedUpdateProcessor):
+            metric("updates_in_progress", "gauge", "Обновления, обрабатываемые или ждущие очереди своего чата")
+            lines.append(f"topicbot_updates_in_progress {sum(entry[1] for entry in processor.chat_locks.values())}")
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(reader, writer):
+    """Отвечает на GET /metrics текстом метрик."""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        parts = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+            status, body = 200, render_metrics().encode("utf-8")
+        else:
+            status, body = 404, b""
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def metrics_status_text():
+    """Краткая сводка метрик для /status."""
+    lines = []
+    busiest = sorted(HANDLER_LATENCY.items(), key=lambda item: item[1].count, reverse=True)[:5]
+    for name, hist in busiest:
+        if hist.count:
+            lines.append(f"  {name}: {hist.count} вызовов, p50 ≤{hist.quantile(0.5) * 1000:g} мс, "
+                         f"p99 ≤{hist.quantile(0.99) * 1000:g} мс")
+    text = ""
+    if lines:
+        text += "• Обработчики (оценка по гистограмме):\n" + "\n".join(lines) + "\n"
+    text += (
+        f"• Запросы к API: {sum(API_CALLS.values())}, повторов {sum(API_RETRIES.values())}, "
+        f"ошибок {sum(API_FAILURES.values())}, ожидание RetryAfter {sum(API_RETRY_AFTER_SECONDS.values()):g} сек\n"
+    )
+    flushes = sum(hist.count for hist in STATS_FLUSH_SECONDS.values())
+    if flushes:
+        average = sum(hist.sum for hist in STATS_FLUSH_SECONDS.values()) / flushes
+        text += (f"• Сбросов статистики: {flushes}, в среднем {average * 1000:.1f} мс, "
+                 f"записано изменений {sum(STATS_FLUSH_RECORDS.values())}, последний снимок {STATS_SNAPSHOT_BYTES // 1024} КБ\n")
+    if PROFILING_ENABLED and LOOP_LAG.count:
+        text += f"• Задержка цикла событий: p99 ≤{LOOP_LAG.quantile(0.99) * 1000:g} мс\n"
+    if _metrics_application is not None:
+        text += f"• Очередь обновлений: {_metrics_application.update_queue.qsize()}\n"
+    return text
+
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+
+# Включается ключом "profiling" в настройках. Трассировка пишется в формате Chrome Trace Event
+# (открывается в chrome://tracing или ui.perfetto.dev): строка на каждое обновление с интервалами
+# ожидания в очереди, обработчиков и вызовов API; фоновые операции - в строке 0.
+PROFILING_ENABLED = False
+PROFILE_BLOCK_THRESHOLD = 0.1  # Сек; дольше этого цикл событий не должен быть занят одной операцией
+PROFILE_SLOW_HANDLER = 2.0  # Сек; обработчики дольше этого попадают в лог (вместе с ожиданием API)
+# Отладочный режим asyncio: сам называет долгие обратные вызовы, но замедляет каждый из них
+# и искажает замеры, поэтому включается отдельно (блокировки цикла и так ловит loop_watchdog)
+PROFILE_ASYNCIO_DEBUG = False
+LOOP_LAG_INTERVAL = 0.05  # Период проверки задержки цикла событий
+LOOP_LAG = Histogram()  # Задержка срабатывания таймеров цикла событий, сек
+PROFILE_HANDLER_GROUPS = (-2, 1000000)  # Группы обработчиков начала и конца трассировки обновления
+TRACE = None
+CURRENT_TRACE_ROW = contextvars.ContextVar("CURRENT_TRACE_ROW", default=0)
+_loop_heartbeat = 0.0  # time.monotonic() последней проверки задержки
+_watchdog_stop = None
+_update_received = {}  # update_id -> время постановки в очередь
+_update_started = {}  # update_id -> начало обработки
+
+class TraceWriter:
+    """Пишет события трассировки в файл по мере поступления (JSON-массив без закрывающей скобки допустим)."""
+    __slots__ = ("file", "pid")
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write("[\n")
+        self.pid = os.getpid()
+
+    def span(self, name, category, started, duration, row=0, args=None):
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": row,
+                 "ts": round(started * 1e6), "dur": round(duration * 1e6)}
+        if args:
+            event["args"] = args
+        self.file.write(json.dumps(event, ensure_ascii=False) + ",\n")
+
+    def close(self):
+        self.file.write("{}]\n")
+        self.file.close()
+
+def trace_handler(name, started, elapsed):
+    """Записывает интервал обработчика и предупреждает о медленных обработчиках."""
+    row = CURRENT_TRACE_ROW.get()
+    TRACE.span(name, "handler", started, elapsed, row)
+    if elapsed > PROFILE_SLOW_HANDLER:
+        logger.warning(f"Медленный обработчик {name}: {elapsed:.2f} сек (обновление {row})")
+
+async def traced_api_call(method, call):
+    """Выполняет вызов API, записывая его интервал в трассировку текущего обновления."""
+    started = time.perf_counter()
+    try:
+        return await call
+    finally:
+        TRACE.span(method, "api", started, time.perf_counter() - started, CURRENT_TRACE_ROW.get())
+
+def trace_blocking(name, started):
+    """Записывает интервал синхронной операции и предупреждает, если она задержала цикл событий."""
+    elapsed = time.perf_counter() - started
+    if TRACE is not None:
+        TRACE.span(name, "blocking", started, elapsed, CURRENT_TRACE_ROW.get())
+    if PROFILING_ENABLED and elapsed > PROFILE_BLOCK_THRESHOLD:
+        logger.warning(f"Операция {name} заняла цикл событий на {elapsed:.3f} сек")
+
+async def trace_update_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Открывает трассировку обновления: отмечает ожидание в очереди."""
+    CURRENT_TRACE_ROW.set(update.update_id)
+    now = time.perf_counter()
+    received = _update_received.pop(update.update_id, None)
+    if received is not None:
+        TRACE.span("queue", "update", received, now - received, update.update_id)
+    _update_started[update.update_id] = now
+
+async def trace_update_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Закрывает трассировку обновления общим интервалом обработки."""
+    started = _update_started.pop(update.update_id, None)
+    if started is not None:
+        chat = update.effective_chat
+        TRACE.span(f"update {update.update_id}", "update", started, time.perf_counter() - started,
+                   update.update_id, {"chat_id": chat.id if chat else None})
+    CURRENT_TRACE_ROW.set(0)
+
+def trace_update_queue(application):
+    """Отмечает время постановки обновлений в очередь приложения."""
+    update_queue = application.update_queue
+    put, put_nowait = update_queue.put, update_queue.put_nowait
+    
+    def remember(update):
+        if isinstance(update, Update):
+            _update_received[update.update_id] = time.perf_counter()
+    
+    async def traced_put(update):
+        remember(update)
+        await put(update)
+    
+    def traced_put_nowait(update):
+        remember(update)
+        put_nowait(update)
+    
+    update_queue.put, update_queue.put_nowait = traced_put, traced_put_nowait
+
+async def loop_lag_monitor():
+    """Фоновая задача: измеряет, насколько позже срока срабатывают таймеры цикла событий."""
+    global _loop_heartbeat
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - expected)
+        _loop_heartbeat = time.monotonic()
+        LOOP_LAG.observe(lag)
+        if lag > PROFILE_BLOCK_THRESHOLD:
+            TRACE.span("loop lag", "loop", time.perf_counter() - lag, lag)
+            logger.warning(f"Цикл событий был занят {lag:.3f} сек")
+
+def loop_watchdog(loop_thread_id, stop):
+    """Поток-сторож: пока цикл событий занят дольше порога, логирует стек его потока."""
+    reported = 0.0
+    while not stop.wait(PROFILE_BLOCK_THRESHOLD / 2):
+        heartbeat = _loop_heartbeat
+        if heartbeat == reported or time.monotonic() - heartbeat <= PROFILE_BLOCK_THRESHOLD + LOOP_LAG_INTERVAL:
+            continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        reported = heartbeat
+        stack = "".join(traceback.format_stack(frame))
+        logger.warning(f"Цикл событий занят {time.monotonic() - heartbeat:.2f} сек, стек:\n{stack}")
+
+def start_profiling(application):
+    """Включает трассировку, монитор задержки цикла и поток-сторож."""
+    global TRACE, _loop_heartbeat, _watchdog_stop
+    TRACE = TraceWriter(TRACE_FILE)
+    trace_update_queue(application)
+    if PROFILE_ASYNCIO_DEBUG:
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = PROFILE_BLOCK_THRESHOLD
+        loop.set_debug(True)
+    _loop_heartbeat = time.monotonic()
+    _background_tasks.append(asyncio.create_task(loop_lag_monitor()))
+    _watchdog_stop = threading.Event()
+    threading.Thread(target=loop_watchdog, args=(threading.get_ident(), _watchdog_stop),
+                     name="loop-watchdog", daemon=True).start()
+    logger.info(f"Профилирование включено, трассировка: {TRACE_FILE}")
+
+def stop_profiling():
+    """Останавливает поток-сторож и дописывает файл трассировки."""
+    global TRACE
+    if _watchdog_stop is not None:
+        _watchdog_stop.set()
+    if TRACE is not None:
+        TRACE.close()
+        TRACE = None
+
+# ==================== ПЛАНИРОВЩИК ЗАПРОСОВ К API ====================
 
-# Загрузка статистики пользователей
-def load_user_stats():
-    global USER_STATS
-    ensure_data_directory()
-    if os.path.exists(STATS_FILE):
-        try:
-            with open(STATS_FILE, "r", encoding="utf-8") as f:
-                # Преобразуем загруженные данные в формат defaultdict(lambda: defaultdict(Counter))
-                data = json.load(f)
-                for chat_id, chat_data in data.items():
-                    for user_id, user_data in chat_data.items():
-                        for content_type, count in user_data.items():
-                            USER_STATS[chat_id][user_id][content_type] = count
-            logger.info(f"Статистика пользователей загружена из {STATS_FILE}")
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке статистики: {e}")
-            USER_STATS = defaultdict(lambda: defaultdict(Counter))
-    else:
-        logger.info(f"Файл статистики {STATS_FILE} не найден, создан новый словарь статистики")
-        USER_STATS = defaultdict(lambda: defaultdict(Counter))
+# Лимиты Telegram Bot API
+RATE_LIMIT_GLOBAL_PER_SEC = 30  # Всего сообщений в секунду
+RATE_LIMIT_GROUP_PER_MIN = 20  # Сообщений в минуту в одну группу
+RATE_LIMIT_GROUP_BURST = 3  # Сколько запросов в группу можно отправить подряд без ожидания
+RATE_LIMIT_PRIVATE_PER_SEC = 1  # Сообщений в секунду в личный чат
 
-# Сохранение статистики пользователей
-def save_user_stats():
-    try:
-        ensure_data_directory()
-        # Преобразуем defaultdict в обычный dict для сохранения
-        data = {}
-        for chat_id, chat_data in USER_STATS.items():
-            data[chat_id] = {}
-            for user_id, user_data in chat_data.items():
-                data[chat_id][user_id] = dict(user_data)
-        
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        logger.info(f"Статистика пользователей сохранена в {STATS_FILE}")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении статистики: {e}")
+# Методы, создающие сообщения; только они расходуют лимит чата (остальные - только глобальный)
+CHAT_LIMITED_METHOD_PREFIXES = ("send_", "forward_", "copy_", "reply_")
 
-# Инициализация конфигурации
-def init_config():
-    global BOT_TOKEN, MAIN_NAME, THEMES, HELLO_MESSAGES, TEMPLATE_MESSAGES
+# Классы приоритета: меньшее значение обслуживается раньше
+PRIORITY_INTERACTIVE = 0  # Ответы пользователям
+PRIORITY_BULK = 1  # Массовые операции (/create)
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не более capacity накопленных."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
     
-    config = load_config()
-    BOT_TOKEN = config.get("bot_token", "")
-    MAIN_NAME = config.get("main_name", MAIN_NAME)
-    THEMES = config.get("themes", THEMES)
-    HELLO_MESSAGES = config.get("hello_messages", HELLO_MESSAGES)
-    TEMPLATE_MESSAGES = config.get("template_messages", TEMPLATE_MESSAGES)
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
     
-    # Синхронизируем количество приветственных сообщений с количеством тем
-    sync_hello_messages()
+    def blocked_delay(self, now):
+        """Сколько секунд осталось до конца паузы после RetryAfter."""
+        return max(0.0, self.blocked_until - now)
     
-    # Загружаем статистику пользователей
-    load_user_stats()
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
     
-    return config
+    def consume(self):
+        self.tokens -= 1
+    
+    def reconfigure(self, rate, capacity):
+        """Меняет темп и емкость, сохраняя накопленные токены и паузу после RetryAfter."""
+        self.delay(time.monotonic())  # Начисляем токены по прежнему темпу
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+    
+    def block(self, seconds, now):
+        """Запрещает запросы на seconds секунд (ответ RetryAfter от Telegram)."""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        # После паузы разрешаем один запрос, дальше - в обычном темпе
+        self.tokens = min(self.tokens, 1)
+        self.updated = self.blocked_until
 
-def sync_hello_messages():
-    """Синхронизирует количество приветственных сообщений с количеством тем."""
-    global HELLO_MESSAGES, THEMES
+class ApiScheduler:
+    """Общий планировщик запросов к Bot API с глобальным и поканальными лимитами и приоритетами."""
+    
+    def __init__(self):
+        self.global_bucket = None
+        self.chat_buckets = {}
+        self.waiters = []  # Отсортированный список [priority, seq, chat_id, chat_limited, future]
+        self._seq = itertools.count()
+        self._timer = None
+        self.configure(RATE_LIMIT_GLOBAL_PER_SEC, RATE_LIMIT_GROUP_PER_MIN, RATE_LIMIT_GROUP_BURST,
+                       RATE_LIMIT_PRIVATE_PER_SEC)
+    
+    def configure(self, global_per_sec, group_per_min, group_burst, private_per_sec):
+        """Задает лимиты. Ожидающие запросы и паузы после RetryAfter сохраняются и учитывают новые лимиты."""
+        self.group_rate = group_per_min / 60
+        self.group_burst = group_burst
+        self.private_rate = private_per_sec
+        if self.global_bucket is None:
+            self.global_bucket = TokenBucket(global_per_sec, global_per_sec)
+        else:
+            self.global_bucket.reconfigure(global_per_sec, global_per_sec)
+        for chat_id, bucket in self.chat_buckets.items():
+            if chat_id < 0:
+                bucket.reconfigure(self.group_rate, self.group_burst)
+            else:
+                bucket.reconfigure(self.private_rate, 1)
+        if not self.waiters:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Цикл событий, в котором ждали запросы, уже завершен - их некому продолжить
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.waiters = []
+            return
+        self._dispatch()  # Новые лимиты могут разрешить ожидающие запросы раньше
     
-    # Если приветственных сообщений меньше, чем тем - добавляем дефолтные
-    while len(HELLO_MESSAGES) < len(THEMES):
-        HELLO_MESSAGES.append(f"Добро пожаловать в тему {len(HELLO_MESSAGES) + 1}")
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные ID - группы и каналы, положительные - личные чаты
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
     
-    # Если приветственных сообщений больше, чем тем - обрезаем
-    if len(HELLO_MESSAGES) > len(THEMES):
-        HELLO_MESSAGES = HELLO_MESSAGES[:len(THEMES)]
+    async def acquire(self, chat_id=None, priority=PRIORITY_INTERACTIVE, chat_limited=True):
+        """Ждет, пока запрос в чат chat_id можно выполнить, не нарушая лимитов.
+        
+        chat_limited=False - запрос не расходует лимит чата, но соблюдает паузу после RetryAfter.
+        """
+        future = asyncio.get_running_loop().create_future()
+        insort(self.waiters, [priority, next(self._seq), chat_id, chat_limited, future])
+        self._dispatch()
+        await future
+    
+    def penalize(self, chat_id, seconds):
+        """Учитывает RetryAfter: блокирует бакет чата (или глобальный) на seconds секунд."""
+        now = time.monotonic()
+        bucket = self.chat_bucket(chat_id) if isinstance(chat_id, int) else self.global_bucket
+        bucket.block(seconds, now)
+    
+    def _dispatch(self):
+        """Выдает разрешения ожидающим запросам в порядке приоритета и планирует следующий проход."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        now = time.monotonic()
+        next_delay = None
+        remaining = []
+        for waiter in self.waiters:
+            _, _, chat_id, chat_limited, future = waiter
+            if future.done():
+                continue  # Ожидающий запрос был отменен
+            global_delay = self.global_bucket.delay(now)
+            chat_bucket = self.chat_bucket(chat_id) if isinstance(chat_id, int) else None
+            if chat_bucket is None:
+                chat_delay = 0.0
+            elif chat_limited:
+                chat_delay = chat_bucket.delay(now)
+            else:
+                chat_delay = chat_bucket.blocked_delay(now)
+            if global_delay == 0 and chat_delay == 0:
+                self.global_bucket.consume()
+                if chat_bucket is not None and chat_limited:
+                    chat_bucket.consume()
+                future.set_result(None)
+                continue
+            remaining.append(waiter)
+            wait = max(global_delay, chat_delay)
+            next_delay = wait if next_delay is None else min(next_delay, wait)
+        self.waiters = remaining
+        
+        if next_delay is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_delay, self._dispatch)
+    
+    def estimate_seconds(self, chat_id, chat_limited_calls, other_calls=0):
+        """Оценивает, за сколько секунд лимиты позволят выполнить указанные запросы в чат."""
+        global_seconds = (chat_limited_calls + other_calls) / self.global_bucket.rate
+        if chat_id < 0:
+            chat_seconds = max(0, chat_limited_calls - self.group_burst) / self.group_rate
+        else:
+            chat_seconds = max(0, chat_limited_calls - 1) / self.private_rate
+        return max(global_seconds, chat_seconds)
 
-def save_themes_config():
-    """Сохраняет текущую конфигурацию тем."""
-    config = load_config()
-    config["themes"] = THEMES
-    config["hello_messages"] = HELLO_MESSAGES
-    save_config(config)
+API_SCHEDULER = ApiScheduler()
+
+def retry_after_seconds(error):
+    """Возвращает время ожидания из RetryAfter в секундах."""
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
 
 # Функция для безопасного вызова API с повторными попытками при таймаутах
-async def safe_api_call(func, max_retries=3, delay=2, *args, **kwargs):
-    """Безопасный вызов API с повторными попытками при таймаутах."""
+async def safe_api_call(func, max_retries=3, delay=2, *args, api_priority=PRIORITY_INTERACTIVE, api_chat_id=None,
+                        **kwargs):
+    """Безопасный вызов API через планировщик лимитов с повторными попытками.
+    
+    delay - базовая задержка экспоненциальной паузы со случайным разбросом при таймаутах.
+    api_chat_id - чат для лимитов, если func сама знает чат (методы Message и CallbackQuery).
+    """
+    chat_id = api_chat_id if api_chat_id is not None else kwargs.get("chat_id", args[0] if args else None)
+    method = getattr(func, "__name__", "")
+    chat_limited = method.startswith(CHAT_LIMITED_METHOD_PREFIXES)
     retries = 0
-    while retries < max_retries:
+    while True:
+        await API_SCHEDULER.acquire(chat_id, api_priority, chat_limited)
+        API_CALLS[method] += 1
         try:
-            return await func(*args, **kwargs)
-        except (TimedOut, NetworkError) as e:
+            call = func(*args, **kwargs)
+            return await (call if TRACE is None else traced_api_call(method, call))
+        except RetryAfter as e:
+            retry_after = retry_after_seconds(e)
+            # Следующий запрос в этот чат планировщик выпустит не раньше, чем через retry_after
+            API_SCHEDULER.penalize(chat_id, retry_after)
+            API_RETRY_AFTER_SECONDS[method] += retry_after
             retries += 1
             if retries >= max_retries:
+                API_FAILURES[method] += 1
                 raise
-            logger.warning(f"Таймаут при выполнении запроса. Повторная попытка {retries}/{max_retries} через {delay} сек...")
-            await asyncio.sleep(delay)
-        except RetryAfter as e:
-            retry_after = e.retry_after
+            API_RETRIES[(method, "retry_after")] += 1
             logger.warning(f"Превышен лимит запросов. Ожидание {retry_after} сек...")
-            await asyncio.sleep(retry_after)
+        except (TimedOut, NetworkError) as e:
             retries += 1
+            if retries >= max_retries:
+                API_FAILURES[method] += 1
+                raise
+            API_RETRIES[(method, "timeout" if isinstance(e, TimedOut) else "network")] += 1
+            backoff = delay * 2 ** (retries - 1)
+            backoff = backoff / 2 + random.uniform(0, backoff / 2)
+            logger.warning(f"Таймаут при выполнении запроса. Повторная попытка {retries}/{max_retries} через {backoff:.1f} сек...")
+            await asyncio.sleep(backoff)
+
+async def reply_text(message, text, **kwargs):
+    """Отвечает на сообщение через safe_api_call: с лимитами чата и повтором после RetryAfter."""
+    return await safe_api_call(message.reply_text, text=text, api_chat_id=message.chat_id, **kwargs)
 
 # Обновление статистики пользователя
 def update_user_stats(chat_id, user_id, content_type):
     """Обновляет статистику пользователя по типу контента."""
-    chat_id_str = str(chat_id)
-    user_id_str = str(user_id)
-    USER_STATS[chat_id_str][user_id_str][content_type] += 1
+    global _pending_stats_updates
+    if STORAGE_BACKEND == "sqlite":
+        # Приращения накапливаются и записываются пакетной транзакцией в flush_sqlite_stats
+        _sqlite_pending_stats[(chat_id, user_id, content_type)] += 1
+        _pending_stats_updates += 1
+        if _pending_stats_updates >= STATS_FLUSH_THRESHOLD and _stats_flush_event is not None:
+            _stats_flush_event.set()
+        return
     
-    # Сохраняем статистику каждое обновлений (можно настроить)
-    total_updates = sum(USER_STATS[chat_id_str][user_id_str].values())
-    if total_updates % 1 == 0:
-        save_user_stats()
+    count = USER_STATS[chat_id].increment(user_id, CONTENT_TYPE_INDEX[content_type])
+    
+    # Дописываем изменение в журнал; сброс на диск и снимок делает фоновая задача stats_flusher
+    append_stats_journal(chat_id, user_id, content_type, count)
+    DIRTY_STATS_CHATS.add(chat_id)
+    if _pending_stats_updates >= STATS_FLUSH_THRESHOLD and _stats_flush_event is not None:
+        _stats_flush_event.set()
 
 # ==================== НОВЫЕ ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ ТЕМАМИ ====================
 
 async def add_theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Добавляет новую тему в список."""
-    global THEMES, HELLO_MESSAGES
-    
+    """Добавляет новую тему в шаблон чата."""
     if not context.args:
-        await update.message.reply_text(
+        await reply_text(
+            update.message,
             "Укажите название новой темы.\n"
             "Пример: /add Новая тема\n"
             "Или с приветственным сообщением:\n"
@@ -201,29 +2128,29 @@ async def add_theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         hello_message = f"Добро пожаловать в тему '{theme_name}'"
     
     # Проверяем, не существует ли уже такая тема
-    if theme_name in THEMES:
-        await update.message.reply_text(f"⚠️ Тема '{theme_name}' уже существует.")
+    if theme_name in get_chat_template(update.effective_chat.id):
+        await reply_text(update.message, f"⚠️ Тема '{theme_name}' уже существует.")
         return
     
     # Добавляем новую тему
-    THEMES.append(theme_name)
-    HELLO_MESSAGES.append(hello_message)
+    template = get_editable_template(update.effective_chat)
+    template.add(theme_name, hello_message)
     
     # Сохраняем конфигурацию
-    save_themes_config()
+    save_themes_config(update.effective_chat)
     
-    await update.message.reply_text(
+    await reply_text(
+        update.message,
         f"✅ Тема '{theme_name}' добавлена!\n"
         f"📝 Приветственное сообщение: {hello_message}\n"
-        f"📊 Общее количество тем: {len(THEMES)}"
+        f"📊 Общее количество тем: {len(template)}"
     )
 
 async def delete_theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Удаляет тему из списка."""
-    global THEMES, HELLO_MESSAGES
-    
+    """Удаляет тему из шаблона чата."""
     if not context.args:
-        await update.message.reply_text(
+        await reply_text(
+            update.message,
             "Укажите номер или название темы для удаления.\n"
             "Примеры:\n"
             "/delete 3 - удалить тему №3\n"
@@ -233,69 +2160,65 @@ async def delete_theme_command(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     query = " ".join(context.args)
+    template = get_chat_template(update.effective_chat.id)
     
     # Пытаемся определить, что передано - номер или название
     if query.isdigit():
         # Удаление по номеру
         index = int(query) - 1
-        if 0 <= index < len(THEMES):
-            removed_theme = THEMES.pop(index)
-            removed_message = HELLO_MESSAGES.pop(index) if index < len(HELLO_MESSAGES) else "Сообщение не найдено"
-            
-            # Сохраняем конфигурацию
-            save_themes_config()
-            
-            await update.message.reply_text(
-                f"✅ Тема #{query} '{removed_theme}' удалена!\n"
-                f"📊 Осталось тем: {len(THEMES)}"
-            )
-        else:
-            await update.message.reply_text(f"⚠️ Неверный номер темы. Доступные номера: 1-{len(THEMES)}")
+        if not 0 <= index < len(template):
+            await reply_text(update.message, f"⚠️ Неверный номер темы. Доступные номера: 1-{len(template)}")
+            return
+        title = f"#{query} '{template.themes[index]}'"
     else:
         # Удаление по названию
-        if query in THEMES:
-            index = THEMES.index(query)
-            THEMES.remove(query)
-            if index < len(HELLO_MESSAGES):
-                removed_message = HELLO_MESSAGES.pop(index)
-            
-            # Сохраняем конфигурацию
-            save_themes_config()
-            
-            await update.message.reply_text(
-                f"✅ Тема '{query}' удалена!\n"
-                f"📊 Осталось тем: {len(THEMES)}"
-            )
-        else:
-            await update.message.reply_text(f"⚠️ Тема '{query}' не найдена.")
+        index = template.index(query)
+        if index is None:
+            await reply_text(update.message, f"⚠️ Тема '{query}' не найдена.")
+            return
+        title = f"'{query}'"
+    
+    template = get_editable_template(update.effective_chat)
+    template.pop(index)
+    
+    # Сохраняем конфигурацию
+    save_themes_config(update.effective_chat)
+    
+    await reply_text(
+        update.message,
+        f"✅ Тема {title} удалена!\n"
+        f"📊 Осталось тем: {len(template)}"
+    )
 
 async def list_themes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показывает список всех тем."""
-    if not THEMES:
-        await update.message.reply_text("📝 Список тем пуст. Используйте /add для добавления тем.")
+    """Показывает список тем шаблона чата."""
+    template = get_chat_template(update.effective_chat.id)
+    if not template.themes:
+        await reply_text(update.message, "📝 Список тем пуст. Используйте /add для добавления тем.")
         return
     
-    message = f"📋 Список тем ({len(THEMES)}):\n\n"
+    message = f"📋 Список тем ({len(template)}):\n\n"
     
-    for i, theme in enumerate(THEMES, 1):
-        hello_msg = HELLO_MESSAGES[i-1] if i-1 < len(HELLO_MESSAGES) else "Нет сообщения"
+    for i, (theme, hello_msg) in enumerate(zip(template.themes, template.hello_messages), 1):
         message += f"{i}. {theme}\n"
         message += f"   💬 {hello_msg}\n\n"
     
+    if update.effective_chat.type != "private" and update.effective_chat.id not in CHAT_TEMPLATES:
+        message += "ℹ️ Группа использует шаблон по умолчанию; при первом изменении тем у нее появится свой шаблон.\n\n"
+    
     message += "Команды управления:\n"
     message += "/add [название] - добавить тему\n"
     message += "/delete [номер/название] - удалить тему\n"
     message += "/edit_theme [номер] [новое_название] - изменить название\n"
     message += "/edit_hello [номер] [новое_сообщение] - изменить приветствие"
     
-    await update.message.reply_text(message)
+    await reply_text(update.message, message)
 
 async def edit_theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Редактирует название темы."""
-    global THEMES
-    
+    """Редактирует название темы в шаблоне чата."""
     if len(context.args) < 2:
-        await update.message.reply_text(
+        await reply_text(
+            update.message,
             "Укажите номер темы и новое название.\n"
             "Пример: /edit_theme 2 Новое название"
         )
@@ -304,30 +2227,34 @@ async def edit_theme_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         index = int(context.args[0]) - 1
         new_name = " ".join(context.args[1:])
+        await load_affected_create_jobs(update.effective_chat)
         
-        if 0 <= index < len(THEMES):
-            old_name = THEMES[index]
-            THEMES[index] = new_name
+        if 0 <= index < len(get_chat_template(update.effective_chat.id)):
+            old_name = get_editable_template(update.effective_chat).rename(index, new_name)
             
             # Сохраняем конфигурацию
-            save_themes_config()
+            save_themes_config(update.effective_chat)
+            rename_theme_in_jobs(old_name, new_name, update.effective_chat)
             
-            await update.message.reply_text(
+            await reply_text(
+                update.message,
                 f"✅ Тема #{index+1} переименована:\n"
                 f"Было: '{old_name}'\n"
                 f"Стало: '{new_name}'"
             )
         else:
-            await update.message.reply_text(f"⚠️ Неверный номер темы. Доступные номера: 1-{len(THEMES)}")
+            await reply_text(
+                update.message,
+                f"⚠️ Неверный номер темы. Доступные номера: 1-{len(get_chat_template(update.effective_chat.id))}"
+            )
     except ValueError:
-        await update.message.reply_text("⚠️ Первый аргумент должен быть номером темы.")
+        await reply_text(update.message, "⚠️ Первый аргумент должен быть номером темы.")
 
 async def edit_hello_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Редактирует приветственное сообщение темы."""
-    global HELLO_MESSAGES
-    
+    """Редактирует приветственное сообщение темы в шаблоне чата."""
     if len(context.args) < 2:
-        await update.message.reply_text(
+        await reply_text(
+            update.message,
             "Укажите номер темы и новое приветственное сообщение.\n"
             "Пример: /edit_hello 2 Добро пожаловать в обновленную тему!"
         )
@@ -337,32 +2264,202 @@ async def edit_hello_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         index = int(context.args[0]) - 1
         new_message = " ".join(context.args[1:])
         
-        if 0 <= index < len(THEMES):
-            # Синхронизируем массивы, если нужно
-            while len(HELLO_MESSAGES) <= index:
-                HELLO_MESSAGES.append(f"Добро пожаловать в тему {len(HELLO_MESSAGES) + 1}")
-            
-            old_message = HELLO_MESSAGES[index]
-            HELLO_MESSAGES[index] = new_message
+        if 0 <= index < len(get_chat_template(update.effective_chat.id)):
+            template = get_editable_template(update.effective_chat)
+            old_message = template.hello_messages[index]
+            template.hello_messages[index] = new_message
             
             # Сохраняем конфигурацию
-            save_themes_config()
+            save_themes_config(update.effective_chat)
             
-            await update.message.reply_text(
-                f"✅ Приветственное сообщение для темы '{THEMES[index]}' обновлено:\n"
+            await reply_text(
+                update.message,
+                f"✅ Приветственное сообщение для темы '{template.themes[index]}' обновлено:\n"
                 f"Было: {old_message}\n"
                 f"Стало: {new_message}"
             )
         else:
-            await update.message.reply_text(f"⚠️ Неверный номер темы. Доступные номера: 1-{len(THEMES)}")
+            await reply_text(
+                update.message,
+                f"⚠️ Неверный номер темы. Доступные номера: 1-{len(get_chat_template(update.effective_chat.id))}"
+            )
     except ValueError:
-        await update.message.reply_text("⚠️ Первый аргумент должен быть номером темы.")
+        await reply_text(update.message, "⚠️ Первый аргумент должен быть номером темы.")
+
+# ==================== ИМПОРТ И ЭКСПОРТ ТЕМ ====================
+
+THEMES_IMPORT_MAX_BYTES = 1024 * 1024  # Максимальный размер импортируемого файла
+THEME_NAME_MAX_LENGTH = 128  # Ограничение Telegram на название темы
+MESSAGE_MAX_LENGTH = 4096  # Ограничение Telegram на длину сообщения
+IMPORT_ERRORS_SHOWN = 10  # Сколько ошибок проверки показывать в ответе
+
+def parse_themes_document(file_name, data):
+    """Разбирает файл шаблона тем (JSON или CSV) и возвращает (темы, приветствия, прочие поля шаблона).
+    
+    JSON - формат /export_themes (объект с ключами themes, hello_messages, main_name,
+    template_messages) или список тем: строк либо объектов {"name": ..., "hello": ...}.
+    CSV - строки "название,приветствие", первая строка может быть заголовком.
+    """
+    text = data.decode("utf-8-sig")
+    extra = {}
+    if file_name.lower().endswith(".csv"):
+        rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+        if rows and rows[0][0].strip().lower() in ("name", "theme", "название", "тема"):
+            rows = rows[1:]
+        themes = [row[0] for row in rows]
+        hello_messages = [row[1] if len(row) > 1 else None for row in rows]
+        return themes, hello_messages, extra
+    
+    content = json.loads(text)
+    if isinstance(content, dict):
+        themes = content.get("themes")
+        if not isinstance(themes, list):
+            raise ValueError("в объекте нет списка themes")
+        hello_messages = content.get("hello_messages") or []
+        if not isinstance(hello_messages, list):
+            raise ValueError("hello_messages должен быть списком")
+        hello_messages = (hello_messages + [None] * len(themes))[:len(themes)]
+        if isinstance(content.get("main_name"), str):
+            extra["main_name"] = content["main_name"]
+        if isinstance(content.get("template_messages"), list):
+            extra["template_messages"] = content["template_messages"]
+        return themes, hello_messages, extra
+    if not isinstance(content, list):
+        raise ValueError("ожидается объект или список тем")
+    themes, hello_messages = [], []
+    for item in content:
+        if isinstance(item, dict):
+            themes.append(item.get("name"))
+            hello_messages.append(item.get("hello"))
+        else:
+            themes.append(item)
+            hello_messages.append(None)
+    return themes, hello_messages, extra
+
+def validate_themes_batch(themes, hello_messages, existing=()):
+    """Проверяет пакет тем целиком и возвращает (темы, приветствия, список ошибок)."""
+    errors = []
+    seen = set(existing)
+    valid_themes, valid_hello = [], []
+    for i, (theme_name, hello_message) in enumerate(zip(themes, hello_messages), 1):
+        if not isinstance(theme_name, str) or not theme_name.strip():
+            errors.append(f"#{i}: пустое название темы")
+            continue
+        theme_name = theme_name.strip()
+        if len(theme_name) > THEME_NAME_MAX_LENGTH:
+            errors.append(f"#{i}: название длиннее {THEME_NAME_MAX_LENGTH} символов")
+        elif theme_name in seen:
+            errors.append(f"#{i}: тема '{theme_name}' повторяется")
+        seen.add(theme_name)
+        if hello_message is None or (isinstance(hello_message, str) and not hello_message.strip()):
+            hello_message = f"Добро пожаловать в тему '{theme_name}'"
+        elif not isinstance(hello_message, str):
+            errors.append(f"#{i}: приветствие должно быть строкой")
+            continue
+        elif len(hello_message) > MESSAGE_MAX_LENGTH:
+            errors.append(f"#{i}: приветствие длиннее {MESSAGE_MAX_LENGTH} символов")
+        valid_themes.append(theme_name)
+        valid_hello.append(hello_message.strip())
+    return valid_themes, valid_hello, errors
+
+async def import_themes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Импортирует шаблон тем из приложенного JSON/CSV файла одним пакетом."""
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if document is None:
+        await reply_text(
+            message,
+            "Приложите файл JSON или CSV с подписью /import_themes или ответьте этой командой на сообщение с файлом.\n"
+            "/import_themes - заменить темы шаблона\n"
+            "/import_themes add - добавить темы к существующим\n"
+            "Формат файла - как у /export_themes; CSV: строки \"название,приветствие\""
+        )
+        return
+    
+    # В подписи к файлу аргументы команды не разбираются
+    args = context.args if context.args is not None else (message.caption or "").split()[1:]
+    append = bool(args) and args[0].lower() in ("add", "добавить")
+    
+    file_name = document.file_name or ""
+    if not file_name.lower().endswith((".json", ".csv")):
+        await reply_text(message, "⚠️ Поддерживаются файлы .json и .csv")
+        return
+    if document.file_size and document.file_size > THEMES_IMPORT_MAX_BYTES:
+        await reply_text(message, f"⚠️ Файл больше {THEMES_IMPORT_MAX_BYTES // 1024} КБ")
+        return
+    
+    try:
+        telegram_file = await safe_api_call(context.bot.get_file, 3, 2, document.file_id)
+        data = await telegram_file.download_as_bytearray()
+        themes, hello_messages, extra = parse_themes_document(file_name, bytes(data))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        await reply_text(message, f"⚠️ Не удалось разобрать файл: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке файла тем: {e}")
+        await reply_text(message, f"⚠️ Не удалось загрузить файл: {e}")
+        return
+    
+    existing = get_chat_template(update.effective_chat.id).positions if append else ()
+    themes, hello_messages, errors = validate_themes_batch(themes, hello_messages, existing)
+    if not themes and not errors:
+        errors.append("в файле нет тем")
+    if errors:
+        # Пакет применяется только целиком
+        shown = "\n".join(errors[:IMPORT_ERRORS_SHOWN])
+        more = f"\n... и еще {len(errors) - IMPORT_ERRORS_SHOWN}" if len(errors) > IMPORT_ERRORS_SHOWN else ""
+        await reply_text(message, f"⚠️ Импорт отменен, шаблон не изменен. Ошибки:\n{shown}{more}")
+        return
+    
+    template = get_editable_template(update.effective_chat)
+    if append:
+        for theme_name, hello_message in zip(themes, hello_messages):
+            template.add(theme_name, hello_message)
+    else:
+        template.replace_themes(themes, hello_messages)
+        if "main_name" in extra:
+            template.main_name = extra["main_name"]
+        if "template_messages" in extra:
+            template.template_messages = [str(text) for text in extra["template_messages"]]
+    
+    # Одна запись настроек на весь пакет
+    save_themes_config(update.effective_chat)
+    
+    action = "Добавлено" if append else "Импортировано"
+    await reply_text(
+        message,
+        f"✅ {action} тем: {len(themes)}\n"
+        f"📊 Всего тем в шаблоне: {len(template)}\n"
+        "Используйте /sync, чтобы применить изменения к уже созданным темам"
+    )
+
+async def export_themes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправляет шаблон тем чата файлом JSON (или CSV: /export_themes csv)."""
+    template = get_chat_template(update.effective_chat.id)
+    if context.args and context.args[0].lower() == "csv":
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["name", "hello"])
+        writer.writerows(zip(template.themes, template.hello_messages))
+        data, file_name = output.getvalue().encode("utf-8-sig"), "themes.csv"
+    else:
+        data = json.dumps(template.to_dict(), ensure_ascii=False, indent=4).encode("utf-8")
+        file_name = "themes.json"
+    
+    await safe_api_call(
+        update.message.reply_document,
+        api_chat_id=update.message.chat_id,
+        document=data,
+        filename=file_name,
+        caption=f"📋 Шаблон тем ({len(template)}). Для загрузки отправьте файл с подписью /import_themes"
+    )
 
 # ==================== ОСНОВНЫЕ ФУНКЦИИ БОТА ====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет приветственное сообщение при команде /start."""
-    await update.message.reply_text(
+    await reply_text(
+        update.message,
         "Привет! Я бот для Telegram форумов.\n"
         "• Создаю темы обсуждения в форумах\n"
         "• Отслеживаю активность пользователей\n"
@@ -372,21 +2469,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет справочное сообщение при команде /help."""
-    await update.message.reply_text(
+    await reply_text(
+        update.message,
         "📋 Команды бота:\n\n"
         "🎯 ОСНОВНЫЕ КОМАНДЫ:\n"
         "/start - Начать работу с ботом\n"
         "/help - Показать эту справку\n"
-        "/create - Создать темы обсуждения по шаблону\n"
+        "/create - Создать темы обсуждения по шаблону (продолжает прерванное создание)\n"
+        "/create reset - Создать темы заново, забыв созданные ранее\n"
+        "/sync - Применить изменения шаблона к уже созданным темам\n"
         "/settings - Настроить параметры бота\n"
         "/status - Показать текущий статус и настройки\n"
-        "/stats - Показать статистику активности пользователей\n\n"
+        "/stats - Показать статистику активности пользователей\n"
+        "/stats day|week|month - Активность за сутки, неделю или месяц\n\n"
         "📝 УПРАВЛЕНИЕ ТЕМАМИ:\n"
         "/list_themes - Показать все темы\n"
         "/add [название] - Добавить новую тему\n"
         "/delete [номер/название] - Удалить тему\n"
         "/edit_theme [номер] [новое_название] - Изменить название темы\n"
-        "/edit_hello [номер] [новое_сообщение] - Изменить приветствие\n\n"
+        "/edit_hello [номер] [новое_сообщение] - Изменить приветствие\n"
+        "/import_themes - Загрузить темы из файла JSON/CSV (add - добавить к существующим)\n"
+        "/export_themes - Выгрузить темы в файл (csv - в формате CSV)\n"
+        "В группе команды меняют шаблон этой группы, в личном чате с ботом - шаблон по умолчанию\n\n"
         "💡 ПРИМЕРЫ:\n"
         "/add Обсуждения | Здесь мы обсуждаем важные вопросы\n"
         "/delete 3\n"
@@ -397,6 +2501,7 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Показывает и редактирует настройки бота с помощью интерактивного меню."""
     if not context.args:
         # Показываем интерактивное меню настроек
+        template = get_chat_template(update.effective_chat.id)
         keyboard = [
             [InlineKeyboardButton("Изменить токен бота", callback_data="settings_token")],
             [InlineKeyboardButton("Изменить название главной темы", callback_data="settings_main_name")],
@@ -408,9 +2513,9 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         message = (
             "⚙️ Настройки бота\n\n"
             f"• Токен бота: {'настроен' if BOT_TOKEN else 'не настроен'}\n"
-            f"• Название главной темы: {MAIN_NAME}\n"
-            f"• Количество тем: {len(THEMES)}\n"
-            f"• Шаблонных сообщений: {len(TEMPLATE_MESSAGES)}\n\n"
+            f"• Название главной темы: {template.main_name}\n"
+            f"• Количество тем: {len(template)}\n"
+            f"• Шаблонных сообщений: {len(template.template_messages)}\n\n"
             "Выберите параметр для настройки или используйте команду:\n"
             "/settings set [параметр] [значение]\n\n"
             "Примеры:\n"
@@ -418,67 +2523,76 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             "/settings set main_name Название главной темы"
         )
         
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        await reply_text(update.message, message, reply_markup=reply_markup)
     elif len(context.args) >= 3 and context.args[0] == "set":
         param = context.args[1]
         value = " ".join(context.args[2:])
         
         await update_setting(update, param, value)
     else:
-        await update.message.reply_text("⚠️ Некорректный формат команды. Используйте:\n/settings set [параметр] [значение]\nили просто /settings для интерактивного меню")
+        await reply_text(update.message, "⚠️ Некорректный формат команды. Используйте:\n/settings set [параметр] [значение]\nили просто /settings для интерактивного меню")
 
 async def update_setting(update, param, value):
     """Обновляет указанную настройку."""
-    global BOT_TOKEN, MAIN_NAME, THEMES, HELLO_MESSAGES
+    global BOT_TOKEN
     
-    config = load_config()
+    config = CONFIG
+    chat = update.effective_chat
     
     # Обновление параметра
     if param == "bot_token":
         BOT_TOKEN = value
         config["bot_token"] = value
-        await update.message.reply_text(f"✅ Токен бота обновлен\n⚠️ Для применения изменений требуется перезапуск бота")
-    elif param == "main_name":
-        MAIN_NAME = value
-        config["main_name"] = value
-        await update.message.reply_text(f"✅ Название главной темы изменено на: {MAIN_NAME}")
+        await reply_text(update.message, f"✅ Токен бота обновлен\n⚠️ Для применения изменений требуется перезапуск бота")
+        schedule_config_save()
+        return
+    
+    if param.startswith("theme_"):
+        # До чтения шаблона: между проверкой индекса и переименованием не должно быть ожиданий
+        await load_affected_create_jobs(chat)
+    template = get_chat_template(chat.id)
+    if param == "main_name":
+        get_editable_template(chat).main_name = value
+        await reply_text(update.message, f"✅ Название главной темы изменено на: {value}")
     elif param.startswith("theme_") and param[6:].isdigit():
         index = int(param[6:]) - 1
-        if 0 <= index < len(THEMES):
-            THEMES[index] = value
-            config["themes"] = THEMES
-            await update.message.reply_text(f"✅ Тема #{index+1} изменена на: {value}")
-        else:
-            await update.message.reply_text(f"⚠️ Неверный индекс темы. Доступные индексы: 1-{len(THEMES)}")
+        if not 0 <= index < len(template):
+            await reply_text(update.message, f"⚠️ Неверный индекс темы. Доступные индексы: 1-{len(template)}")
+            return
+        old_name = get_editable_template(chat).rename(index, value)
+        rename_theme_in_jobs(old_name, value, chat)
+        await reply_text(update.message, f"✅ Тема #{index+1} изменена на: {value}")
     elif param.startswith("hello_") and param[6:].isdigit():
         index = int(param[6:]) - 1
-        if 0 <= index < len(HELLO_MESSAGES):
-            HELLO_MESSAGES[index] = value
-            config["hello_messages"] = HELLO_MESSAGES
-            await update.message.reply_text(f"✅ Приветственное сообщение #{index+1} изменено")
-        else:
-            await update.message.reply_text(f"⚠️ Неверный индекс сообщения. Доступные индексы: 1-{len(HELLO_MESSAGES)}")
+        if not 0 <= index < len(template):
+            await reply_text(update.message, f"⚠️ Неверный индекс сообщения. Доступные индексы: 1-{len(template)}")
+            return
+        get_editable_template(chat).hello_messages[index] = value
+        await reply_text(update.message, f"✅ Приветственное сообщение #{index+1} изменено")
     else:
-        await update.message.reply_text(f"⚠️ Неизвестный параметр: {param}")
+        await reply_text(update.message, f"⚠️ Неизвестный параметр: {param}")
         return
     
     # Сохраняем изменения
-    save_config(config)
+    save_themes_config(chat)
 
 async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает колбэки от интерактивного меню настроек."""
     query = update.callback_query
-    await query.answer()
+    await safe_api_call(query.answer)
     
     data = query.data
+    template = get_chat_template(update.effective_chat.id)
     
     if data == "settings_token":
-        await query.message.reply_text(
+        await reply_text(
+            query.message,
             "Введите новый токен бота, используя команду:\n"
             "/settings set bot_token YOUR_TOKEN_HERE"
         )
     elif data == "settings_main_name":
-        await query.message.reply_text(
+        await reply_text(
+            query.message,
             "Введите новое название главной темы, используя команду:\n"
             "/settings set main_name Новое название"
         )
@@ -489,218 +2603,825 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         themes_text += "/add [название] - добавить тему\n"
         themes_text += "/delete [номер] - удалить тему\n"
         themes_text += "/edit_theme [номер] [название] - изменить название\n\n"
-        themes_text += f"Текущее количество тем: {len(THEMES)}"
-        await query.message.reply_text(themes_text)
+        themes_text += f"Текущее количество тем: {len(template)}"
+        await reply_text(query.message, themes_text)
     elif data == "settings_hello":
         hello_text = "📋 Управление приветственными сообщениями:\n\n"
         hello_text += "Используйте команды:\n"
         hello_text += "/edit_hello [номер] [текст] - изменить сообщение\n"
         hello_text += "/list_themes - посмотреть все сообщения\n\n"
-        hello_text += f"Текущее количество сообщений: {len(HELLO_MESSAGES)}"
-        await query.message.reply_text(hello_text)
+        hello_text += f"Текущее количество сообщений: {len(template.hello_messages)}"
+        await reply_text(query.message, hello_text)
     else:
-        await query.message.reply_text("⚠️ Неизвестная команда")
+        await reply_text(query.message, "⚠️ Неизвестная команда")
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает текущий статус бота."""
+    template = get_chat_template(update.effective_chat.id)
     message = (
         "📊 Статус бота:\n\n"
         f"• Бот Telegram: активен\n"
         f"• Дата и время: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        f"• Название главной темы: {MAIN_NAME}\n"
-        f"• Количество тем: {len(THEMES)}\n"
-        f"• Количество приветственных сообщений: {len(HELLO_MESSAGES)}\n"
+        f"• Название главной темы: {template.main_name}\n"
+        f"• Количество тем: {len(template)}\n"
+        f"• Количество приветственных сообщений: {len(template.hello_messages)}\n"
+        f"• Шаблон тем: {'собственный шаблон группы' if update.effective_chat.id in CHAT_TEMPLATES else 'по умолчанию'}"
+        f" (групп со своим шаблоном: {len(CHAT_TEMPLATES)})\n"
         f"• Отслеживание активности: включено\n"
+        f"• Кэш сведений о чатах: попаданий {METADATA_CACHE_STATS['hits'] + METADATA_CACHE_STATS['negative_hits']}, "
+        f"промахов {METADATA_CACHE_STATS['misses']}, сбросов {METADATA_CACHE_STATS['invalidations']}, "
+        f"чатов в кэше {len(CHAT_INFO)}\n"
         f"• Директория данных: {DATA_DIR}\n"
     )
+    message += metrics_status_text()
+    if SHARD_STATE is not None:
+        message += await shards_status_text()
+    
+    await reply_text(update.message, message)
+
+async def shards_status_text():
+    """Сводка по всем шардам для /status."""
+    state = await asyncio.to_thread(SHARD_STATE.copy)
+    summaries = {shard_id: summary for shard_id, summary in state.items() if isinstance(shard_id, int)}
+    # Свежая сводка своего шарда вместо опубликованной
+    summaries[SHARD_ID] = await current_shard_summary()
+    now = time.time()
+    lines = [f"\n🧩 Шарды ({len(summaries)}/{SHARD_COUNT}), этот чат - шард {SHARD_ID}:"]
+    for shard_id in range(SHARD_COUNT):
+        summary = summaries.get(shard_id)
+        if summary is None:
+            lines.append(f"• Шард {shard_id}: нет данных")
+            continue
+        age = now - summary["updated_at"]
+        lines.append(
+            f"• Шард {shard_id}: чатов {summary['chats']}, пользователей {summary['users']}, "
+            f"обновлений {summary['updates']}" + (f" (данные {age:.0f} сек назад)" if age > 2 * SHARD_PUBLISH_INTERVAL else "")
+        )
+    lines.append(
+        f"• Всего: чатов {sum(s['chats'] for s in summaries.values())}, "
+        f"пользователей {sum(s['users'] for s in summaries.values())}, "
+        f"обновлений {sum(s['updates'] for s in summaries.values())}, "
+        f"групп со своим шаблоном {sum(s['templates'] for s in summaries.values())}"
+    )
+    return "\n".join(lines) + "\n"
+
+async def get_top_users(chat_id, limit):
+    """Возвращает число пользователей чата и список (user_id, total, stats) для топа."""
+    if STORAGE_BACKEND == "sqlite":
+        # Запрос ставится в очередь после накопленных приращений и видит их
+        await PERSISTENCE.ready()
+        flush_sqlite_stats()
+        return await PERSISTENCE.run(query_sqlite_top_users, chat_id, limit)
+    
+    chat_stats = USER_STATS.get(chat_id)
+    if not chat_stats:
+        return 0, []
+    # Топ берется из инкрементально поддерживаемого индекса, без сортировки всех пользователей
+    return len(chat_stats), [(user_id, total, chat_stats.get(user_id)) for user_id, total in chat_stats.top(limit)]
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает статистику активности пользователей."""
+    if context.args:
+        period = ACTIVITY_PERIODS.get(context.args[0].lower())
+        if period is None:
+            await reply_text(update.message, "⚠️ Используйте: /stats, /stats day, /stats week или /stats month")
+            return
+        await stats_period_command(update, context, period)
+        return
+    
+    # Если статистика чата не менялась с прошлого запроса, отвечаем готовым текстом
+    chat_stats = USER_STATS.get(update.effective_chat.id) if STORAGE_BACKEND != "sqlite" else None
+    if chat_stats is not None and chat_stats.rendered is not None and chat_stats.rendered[0] == chat_stats.version:
+        await reply_text(update.message, chat_stats.rendered[1])
+        return
+    version = chat_stats.version if chat_stats is not None else None
+    
+    total_users, top_users = await get_top_users(update.effective_chat.id, LEADERBOARD_SIZE)
+    
+    if not total_users:
+        await reply_text(update.message, "📊 Статистика пока отсутствует для этого чата.")
+        return
+    
+    message = "📊 Статистика активности пользователей:\n\n"
+    
+    # Получаем имена только для пользователей из топа
+    names = await resolve_user_names(context.bot, update.effective_chat.id, [user_id for user_id, _, _ in top_users])
+    user_stats_list = [(names[user_id], total_messages, stats) for user_id, total_messages, stats in top_users]
+    
+    # Формируем сообщение
+    for i, (user_name, total, stats) in enumerate(user_stats_list, 1):
+        message += f"{i}. {user_name}: {total} сообщений\n"
+        message += f"   📝 Текст: {stats.get('text', 0)}, 🖼 Фото: {stats.get('photo', 0)}, "
+        message += f"🎞 Видео: {stats.get('video', 0)}, 🎭 Стикеры: {stats.get('sticker', 0)}, "
+        message += f"📊 GIF: {stats.get('animation', 0)}\n"
+    
+    if total_users > len(user_stats_list):
+        message += f"\n...и еще {total_users - len(user_stats_list)} пользователей"
+    
+    # Кэшируем ответ, только если статистика не изменилась, пока запрашивались имена
+    if chat_stats is not None and chat_stats.version == version:
+        chat_stats.rendered = (version, message)
+    
+    await reply_text(update.message, message)
+
+async def stats_period_command(update: Update, context: ContextTypes.DEFAULT_TYPE, period) -> None:
+    """Показывает активность пользователей за период по накопленным итогам."""
+    chat_id = update.effective_chat.id
+    activity = CHAT_ACTIVITY.get(chat_id)
+    totals = activity.totals(period, current_hour()) if activity else Counter()
+    
+    if not totals:
+        await reply_text(update.message, f"📊 Нет активности {ACTIVITY_PERIOD_TITLES[period]}.")
+        return
+    
+    top_users = totals.most_common(10)
+    names = await resolve_user_names(context.bot, chat_id, [user_id for user_id, _ in top_users])
+    
+    message = f"📊 Активность пользователей {ACTIVITY_PERIOD_TITLES[period]}:\n\n"
+    for i, (user_id, total) in enumerate(top_users, 1):
+        message += f"{i}. {names[user_id]}: {total} сообщений\n"
+    
+    if len(totals) > 10:
+        message += f"\n...и еще {len(totals) - 10} пользователей"
+    
+    await reply_text(update.message, message)
+
+# Параметры создания тем
+CREATE_PIPELINE_DEPTH = 4  # Сколько тем одновременно проходят этапы приветствия и закрепления
+PROGRESS_EDIT_INTERVAL = 5  # Не чаще одного обновления статуса за столько секунд
+
+def format_duration(seconds):
+    """Форматирует длительность для сообщений пользователю."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} сек"
+    return f"{seconds // 60} мин {seconds % 60} сек"
+
+class CreateProgress:
+    """Статус создания тем, который редактируется не чаще PROGRESS_EDIT_INTERVAL."""
+    
+    def __init__(self, bot, chat_id, message_id, total, expected_seconds):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.total = total
+        self.expected_seconds = expected_seconds
+        self.last_edit = 0.0
+    
+    async def update(self, done, force=False):
+        if self.message_id is None:
+            return  # Массовое создание без сообщения о статусе
+        now = time.monotonic()
+        if not force and now - self.last_edit < PROGRESS_EDIT_INTERVAL:
+            return
+        self.last_edit = now
+        try:
+            await safe_api_call(
+                self.bot.edit_message_text,
+                3, 2,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=f"Создаю темы обсуждения... ({done}/{self.total})\n"
+                     f"⏱ Ожидаемое время: ~{format_duration(self.expected_seconds)}",
+                api_priority=PRIORITY_BULK
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус создания тем: {e}")
+
+# Записи о создании тем: chat_id -> задание (см. new_create_job)
+CREATE_JOBS = {}
+ACTIVE_CREATE_CHATS = set()  # Чаты, в которых сейчас выполняется /create
+
+def new_create_job():
+    """Пустое задание создания тем для чата."""
+    return {
+        "general_renamed": False,
+        "main_name": None,  # Название, которое было присвоено General
+        "completed": False,
+        # Название темы в шаблоне -> {"thread_id", "name", "hello", "hello_message_id", "pinned", "closed"}
+        "topics": {},
+    }
+
+def create_job_path(chat_id):
+    return os.path.join(CREATE_JOBS_DIR, f"{chat_id}.json")
+
+async def load_create_job(chat_id):
+    """Возвращает задание создания тем для чата, загружая его с диска при первом обращении."""
+    job = CREATE_JOBS.get(chat_id)
+    if job is not None:
+        return job
+    # Чтение идет в потоке записи - после уже поставленных в очередь сохранений задания
+    job = await PERSISTENCE.run(read_create_job, chat_id)
+    return CREATE_JOBS.setdefault(chat_id, job)
+
+async def load_stored_create_jobs():
+    """Загружает все сохраненные задания создания тем (для изменений шаблона по умолчанию)."""
+    for chat_id, job in (await PERSISTENCE.run(read_stored_create_jobs, set(CREATE_JOBS))).items():
+        CREATE_JOBS.setdefault(chat_id, job)
+
+def read_create_job(chat_id):
+    """Читает задание создания тем с диска (в потоке записи)."""
+    job = new_create_job()
+    path = create_job_path(chat_id)
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                job.update(json.load(f))
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке задания создания тем {path}: {e}")
+    return job
+
+def read_stored_create_jobs(loaded):
+    """Читает сохраненные задания чатов, которых нет в loaded (в потоке записи)."""
+    jobs = {}
+    if os.path.isdir(CREATE_JOBS_DIR):
+        for file_name in os.listdir(CREATE_JOBS_DIR):
+            if file_name.endswith(".json") and file_name[:-5].lstrip("-").isdigit():
+                chat_id = int(file_name[:-5])
+                if chat_id not in loaded:
+                    jobs[chat_id] = read_create_job(chat_id)
+    return jobs
+
+def save_create_job(chat_id):
+    """Сохраняет контрольную точку задания создания тем."""
+    PERSISTENCE.submit(write_create_job, chat_id, copy.deepcopy(CREATE_JOBS[chat_id]), key=chat_id)
+
+def write_create_job(chat_id, job):
+    try:
+        os.makedirs(CREATE_JOBS_DIR, exist_ok=True)
+        atomic_write_text(create_job_path(chat_id), json.dumps(job, ensure_ascii=False))
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении задания создания тем для чата {chat_id}: {e}")
+
+def reset_create_job(chat_id):
+    """Забывает созданные в чате темы, чтобы /create создал их заново."""
+    CREATE_JOBS[chat_id] = new_create_job()
+    save_create_job(chat_id)
+
+async def load_affected_create_jobs(chat):
+    """Загружает задания чатов, которые использует шаблон chat; вызывается до изменения шаблона,
+    чтобы переименование в заданиях выполнилось вместе с ним, без ожидания диска."""
+    if chat.type == "private":
+        await load_stored_create_jobs()
+    else:
+        await load_create_job(chat.id)
+
+def rename_theme_in_jobs(old_name, new_name, chat):
+    """Переносит запись о теме на новое название в заданиях чатов, использующих измененный шаблон,
+    чтобы /sync переименовал тему в форуме. Задания должны быть загружены load_affected_create_jobs."""
+    if chat.type == "private":
+        if SHARD_STATE is not None:
+            # Группы других шардов применят переименование вместе с опубликованным шаблоном
+            DEFAULT_TEMPLATE_RENAMES.append((time.time_ns(), old_name, new_name))
+        rename_default_theme_in_jobs(old_name, new_name)
+    else:
+        rename_theme_in_chat_jobs(old_name, new_name, [chat.id])
+
+def rename_default_theme_in_jobs(old_name, new_name):
+    """Переименование в шаблоне по умолчанию - он действует во всех группах без собственного шаблона."""
+    rename_theme_in_chat_jobs(old_name, new_name, [chat_id for chat_id in CREATE_JOBS if chat_id not in CHAT_TEMPLATES])
+
+def rename_theme_in_chat_jobs(old_name, new_name, chat_ids):
+    for chat_id in chat_ids:
+        job = CREATE_JOBS.get(chat_id)
+        if job is None:
+            continue  # Задания нет ни в памяти, ни на диске - переносить нечего
+        topics = job["topics"]
+        if old_name in topics and new_name not in topics:
+            topics[new_name] = topics.pop(old_name)
+            save_create_job(chat_id)
+
+def pending_create_steps(job, themes):
+    """Считает оставшиеся шаги: (сообщений в чат, прочих запросов)."""
+    messages = other = 0
+    for theme_name in themes:
+        topic = job["topics"].get(theme_name)
+        if topic is None:
+            other += 1
+            topic = {"hello_message_id": None, "pinned": False}
+        if topic["hello_message_id"] is None:
+            messages += 1
+        if not topic["pinned"]:
+            other += 1
+    return messages, other
+
+async def provision_topics(bot, chat_id, themes, hello_messages, progress, job):
+    """Создает темы конвейером и возвращает (число готовых тем, из них готовых ранее).
+    
+    Темы создаются по очереди (чтобы сохранить их порядок в форуме), а отправка
+    и закрепление приветствия для уже созданных тем идут параллельно, не более
+    CREATE_PIPELINE_DEPTH тем одновременно. Темп запросов задает API_SCHEDULER.
+    После каждого шага задание сохраняется, поэтому повторный запуск продолжает
+    с места остановки и не создает дубликаты.
+    """
+    pipeline_slots = asyncio.Semaphore(CREATE_PIPELINE_DEPTH)
+    successful_topics = 0
+    already_done = 0
+    
+    async def report_error(theme_name, e):
+        logger.error(f"Ошибка при создании темы {theme_name}: {e}")
+        try:
+            await safe_api_call(
+                bot.send_message,
+                3, 2,
+                chat_id=chat_id,
+                text=f"⚠️ Ошибка при создании темы {theme_name}: {e}",
+                api_priority=PRIORITY_BULK
+            )
+        except Exception as send_error:
+            logger.error(f"Не удалось сообщить об ошибке создания темы: {send_error}")
+    
+    async def finish_topic(theme_name, hello_message, topic):
+        nonlocal successful_topics
+        try:
+            if topic["hello_message_id"] is None:
+                # Отправляем сообщение в тему
+                sent_message = await safe_api_call(
+                    bot.send_message,
+                    3, 2,
+                    chat_id=chat_id,
+                    message_thread_id=topic["thread_id"],
+                    text=hello_message,
+                    api_priority=PRIORITY_BULK
+                )
+                topic["hello_message_id"] = sent_message.message_id
+                topic["hello"] = hello_message
+                save_create_job(chat_id)
+            if not topic["pinned"]:
+                # Закрепляем сообщение
+                await safe_api_call(
+                    bot.pin_chat_message,
+                    3, 2,
+                    chat_id=chat_id,
+                    message_id=topic["hello_message_id"],
+                    disable_notification=True,
+                    api_priority=PRIORITY_BULK
+                )
+                topic["pinned"] = True
+                save_create_job(chat_id)
+            successful_topics += 1
+            await progress.update(successful_topics)
+        except Exception as e:
+            await report_error(theme_name, e)
+        finally:
+            pipeline_slots.release()
+    
+    tasks = []
+    for i, theme_name in enumerate(themes):
+        topic = job["topics"].get(theme_name)
+        if topic is not None and topic["pinned"]:
+            # Тема полностью готова с прошлого запуска
+            successful_topics += 1
+            already_done += 1
+            continue
+        
+        # Выбираем сообщение в зависимости от индекса темы
+        hello_message = hello_messages[i] if i < len(hello_messages) else f"Добро пожаловать в тему '{theme_name}'"
+        await pipeline_slots.acquire()
+        if topic is None:
+            try:
+                # Создаем тему с защищенным вызовом API
+                new_topic = await safe_api_call(
+                    bot.create_forum_topic,
+                    3, 3,
+                    chat_id=chat_id,
+                    name=theme_name,
+                    api_priority=PRIORITY_BULK
+                )
+            except Exception as e:
+                pipeline_slots.release()
+                await report_error(theme_name, e)
+                continue
+            topic = {
+                "thread_id": new_topic.message_thread_id,
+                "name": theme_name,
+                "hello": hello_message,
+                "hello_message_id": None,
+                "pinned": False,
+            }
+            job["topics"][theme_name] = topic
+            save_create_job(chat_id)
+        tasks.append(asyncio.create_task(finish_topic(theme_name, hello_message, topic)))
+    
+    await asyncio.gather(*tasks)
+    return successful_topics, already_done
+
+async def create_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Создает темы обсуждения по шаблону, продолжая прерванное создание."""
+    # Проверяем, что команда отправлена в группе
+    if update.effective_chat.type not in ['group', 'supergroup']:
+        await reply_text(update.message, "⚠️ Эта команда работает только в группах.")
+        return
+    
+    # Проверяем, есть ли темы для создания
+    if not get_chat_template(update.effective_chat.id).themes:
+        await reply_text(update.message, "⚠️ Нет тем для создания. Добавьте темы с помощью команды /add")
+        return
+    
+    chat_id = update.effective_chat.id
+    if chat_id in ACTIVE_CREATE_CHATS:
+        await reply_text(update.message, "⏳ Создание тем в этой группе уже выполняется.")
+        return
+    
+    if context.args and context.args[0].lower() in ("reset", "заново"):
+        # Забываем ранее созданные темы: они будут созданы заново
+        reset_create_job(chat_id)
+    
+    ACTIVE_CREATE_CHATS.add(chat_id)
+    try:
+        await run_create_job(update, context, chat_id)
+    finally:
+        ACTIVE_CREATE_CHATS.discard(chat_id)
+
+async def provision_chat(bot, chat_id, themes, hello_messages, main_name, status_message_id=None):
+    """Применяет шаблон тем к чату (или продолжает прерванное применение).
+    
+    Возвращает словарь с итогом: status ("ok", "not_forum" или "error"),
+    created, already_done, total, seconds и error.
+    """
+    started = time.monotonic()
+    result = {"chat_id": chat_id, "status": "ok", "created": 0, "already_done": 0,
+              "total": len(themes), "seconds": 0.0, "error": None}
+    job = await load_create_job(chat_id)
+    job["completed"] = False
+    
+    try:
+        # Проверяем, является ли группа форумом
+        if not await chat_is_forum(bot, chat_id):
+            result["status"] = "not_forum"
+            return result
+        
+        # Пытаемся переименовать General (ID=1), если это еще не сделано
+        if not job["general_renamed"]:
+            try:
+                await safe_api_call(
+                    bot.edit_forum_topic,
+                    3, 2,
+                    chat_id=chat_id,
+                    message_thread_id=1,
+                    name=main_name
+                )
+                job["general_renamed"] = True
+                job["main_name"] = main_name
+                save_create_job(chat_id)
+                await safe_api_call(
+                    bot.send_message,
+                    3, 2,
+                    chat_id=chat_id,
+                    text=f"✅ Тема 'General' переименована в '{main_name}'"
+                )
+            except Exception as e:
+                logger.error(f"Ошибка при переименовании General: {e}")
+                await safe_api_call(
+                    bot.send_message,
+                    3, 2,
+                    chat_id=chat_id,
+                    text=f"⚠️ Не удалось переименовать тему 'General'. Возможно, она не существует или у бота недостаточно прав."
+                )
+        
+        # Сообщаем ожидаемое время по оставшимся шагам: приветствия расходуют лимит чата,
+        # создание тем и закрепление - глобальный лимит
+        messages, other_calls = pending_create_steps(job, themes)
+        expected = API_SCHEDULER.estimate_seconds(chat_id, messages, other_calls)
+        progress = CreateProgress(bot, chat_id, status_message_id, len(themes), expected)
+        await progress.update(0, force=True)
+        
+        # Создаем новые темы
+        result["created"], result["already_done"] = await provision_topics(
+            bot, chat_id, themes, hello_messages, progress, job
+        )
+        job["completed"] = result["created"] == len(themes)
+        save_create_job(chat_id)
+    except Exception as e:
+        logger.error(f"Ошибка при создании тем обсуждения в чате {chat_id}: {e}")
+        result["status"] = "error"
+        result["error"] = str(e)
+    finally:
+        result["seconds"] = time.monotonic() - started
+    return result
+
+async def run_create_job(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id) -> None:
+    """Выполняет (или продолжает) задание создания тем в чате и сообщает итог."""
+    status_message = await reply_text(update.message, "Создаю темы обсуждения...")
+    # Работаем со снимком шаблона, чтобы правки тем во время создания не влияли на процесс
+    template = get_chat_template(chat_id)
+    result = await provision_chat(
+        context.bot, chat_id, list(template.themes), list(template.hello_messages), template.main_name,
+        status_message.message_id
+    )
+    
+    if result["status"] == "not_forum":
+        text = "⚠️ Эта группа не является форумом. Включите темы обсуждения в настройках группы."
+    elif result["status"] == "error":
+        text = f"⚠️ Произошла ошибка: {result['error']}"
+    else:
+        # Финальное сообщение
+        text = f"✅ Создание тем завершено! Успешно создано: {result['created']}/{result['total']}"
+        if result["already_done"]:
+            text += f"\n♻️ Из них созданы ранее: {result['already_done']} (используйте /create reset, чтобы создать заново)"
+    await safe_api_call(
+        context.bot.edit_message_text,
+        3, 2,
+        chat_id=chat_id,
+        message_id=status_message.message_id,
+        text=text
+    )
+
+# ==================== МАССОВОЕ СОЗДАНИЕ ТЕМ ====================
+
+BULK_PROVISION_CONCURRENCY = 10  # Сколько чатов обрабатываются одновременно
+
+async def bulk_provision(bot, chat_ids, concurrency=BULK_PROVISION_CONCURRENCY):
+    """Применяет шаблоны чатов к списку чатов параллельно; общий темп задает API_SCHEDULER."""
+    slots = asyncio.Semaphore(concurrency)
+    
+    async def run(chat_id):
+        template = get_chat_template(chat_id)
+        async with slots:
+            result = await provision_chat(bot, chat_id, list(template.themes), list(template.hello_messages),
+                                          template.main_name)
+        logger.info(f"Чат {chat_id}: {result['status']}, тем {result['created']}/{result['total']} "
+                    f"за {result['seconds']:.1f} сек")
+        return result
     
-    await update.message.reply_text(message)
+    return await asyncio.gather(*(run(chat_id) for chat_id in chat_ids))
 
-async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показывает статистику активности пользователей."""
-    chat_id = str(update.effective_chat.id)
+def print_bulk_summary(results, elapsed):
+    """Печатает итоги массового создания тем по чатам и общую пропускную способность."""
+    status_titles = {"ok": "готово", "not_forum": "не форум", "error": "ошибка"}
+    print(f"{'Чат':>16}  {'Итог':10} {'Темы':>9} {'Ранее':>6} {'Время':>8}")
+    for result in results:
+        line = (f"{result['chat_id']:>16}  {status_titles[result['status']]:10} "
+                f"{result['created']:>4}/{result['total']:<4} {result['already_done']:>6} {result['seconds']:>7.1f}с")
+        if result["error"]:
+            line += f"  {result['error']}"
+        print(line)
     
-    if chat_id not in USER_STATS or not USER_STATS[chat_id]:
-        await update.message.reply_text("📊 Статистика пока отсутствует для этого чата.")
+    done_chats = sum(1 for result in results if result["status"] == "ok" and result["created"] == result["total"])
+    new_topics = sum(result["created"] - result["already_done"] for result in results)
+    print(f"\nЧатов: {len(results)}, полностью готово: {done_chats}, создано тем: {new_topics}")
+    if elapsed > 0:
+        print(f"Время: {elapsed:.1f} сек, {len(results) / elapsed * 60:.1f} чатов/мин, "
+              f"{new_topics / elapsed:.2f} тем/сек")
+
+def provision_main(argv):
+    """Точка входа для массового создания тем: python botver2.py provision <chat_id> ..."""
+    parser = argparse.ArgumentParser(prog="botver2.py provision",
+                                     description="Создает темы по текущему шаблону в нескольких группах")
+    parser.add_argument("chat_ids", nargs="*", type=int, help="ID групп")
+    parser.add_argument("--file", help="файл со списком ID групп, по одному на строку")
+    parser.add_argument("--concurrency", type=int, default=BULK_PROVISION_CONCURRENCY,
+                        help="сколько групп обрабатывать одновременно")
+    args = parser.parse_args(argv)
+    
+    chat_ids = list(args.chat_ids)
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f:
+            chat_ids.extend(int(line.strip()) for line in f if line.strip() and not line.startswith("#"))
+    if not chat_ids:
+        parser.error("не указано ни одной группы")
+    
+    init_config()
+    if not BOT_TOKEN:
+        print("⚠️ Токен бота не настроен. Укажите его командой /settings set bot_token или в bot_config.json")
         return
     
-    message = "📊 Статистика активности пользователей:\n\n"
+    async def run():
+        async with Bot(BOT_TOKEN) as bot:
+            started = time.monotonic()
+            results = await bulk_provision(bot, chat_ids, args.concurrency)
+            return results, time.monotonic() - started
     
-    # Получаем список пользователей с их статистикой
-    user_stats_list = []
-    for user_id, stats in USER_STATS[chat_id].items():
-        try:
-            # Пытаемся получить информацию о пользователе
-            chat_member = await context.bot.get_chat_member(update.effective_chat.id, int(user_id))
-            user_name = chat_member.user.full_name
-        except Exception:
-            # Если не удалось, используем ID
-            user_name = f"Пользователь {user_id}"
-        
-        total_messages = sum(stats.values())
-        user_stats_list.append((user_name, total_messages, stats))
+    results, elapsed = asyncio.run(run())
+    print_bulk_summary(results, elapsed)
+
+def export_stats_main(argv):
+    """Точка входа для выгрузки статистики в JSON: python botver2.py export_stats [файл]"""
+    parser = argparse.ArgumentParser(prog="botver2.py export_stats",
+                                     description="Выгружает статистику пользователей в JSON (формат прежнего user_stats.json)")
+    parser.add_argument("output", nargs="?", help="файл для выгрузки (по умолчанию user_stats_export.json в директории данных)")
+    args = parser.parse_args(argv)
     
-    # Сортируем по общему количеству сообщений
-    user_stats_list.sort(key=lambda x: x[1], reverse=True)
+    init_config()
+    if STORAGE_BACKEND == "sqlite":
+        print(f"⚠️ Статистика хранится в базе данных {DATABASE_FILE}, выгрузка в JSON для нее не нужна")
+        return
+    output = args.output or os.path.join(DATA_DIR, "user_stats_export.json")
+    fragments = [
+        f'"{chat_id}":' + json.dumps(chat_stats.to_dict(), ensure_ascii=False, separators=(",", ":"))
+        for chat_id, chat_stats in USER_STATS.items()
+    ]
+    atomic_write_text(output, "{" + ",".join(fragments) + "}")
+    print(f"✅ Статистика {len(fragments)} чатов выгружена в {output}")
+
+def plan_theme_sync(job, themes, hello_messages, main_name):
+    """Сравнивает шаблон с темами форума и возвращает минимальный список действий.
     
-    # Формируем сообщение
-    for i, (user_name, total, stats) in enumerate(user_stats_list[:10], 1):  # Показываем только топ-10
-        message += f"{i}. {user_name}: {total} сообщений\n"
-        message += f"   📝 Текст: {stats.get('text', 0)}, 🖼 Фото: {stats.get('photo', 0)}, "
-        message += f"🎞 Видео: {stats.get('video', 0)}, 🎭 Стикеры: {stats.get('sticker', 0)}, "
-        message += f"📊 GIF: {stats.get('animation', 0)}\n"
+    Действия - кортежи (вид, название темы, данные): "general", "reopen", "rename",
+    "hello", "close" и "create" (создание выполняет provision_topics).
+    """
+    actions = []
+    if job["general_renamed"] and job.get("main_name") != main_name:
+        actions.append(("general", None, main_name))
     
-    if len(user_stats_list) > 10:
-        message += f"\n...и еще {len(user_stats_list) - 10} пользователей"
+    topics = job["topics"]
+    for i, theme_name in enumerate(themes):
+        hello_message = hello_messages[i] if i < len(hello_messages) else f"Добро пожаловать в тему '{theme_name}'"
+        topic = topics.get(theme_name)
+        if topic is None or not topic["pinned"]:
+            actions.append(("create", theme_name, hello_message))
+            continue
+        if topic.get("closed"):
+            actions.append(("reopen", theme_name, None))
+        if topic["name"] != theme_name:
+            actions.append(("rename", theme_name, theme_name))
+        if topic["hello"] != hello_message:
+            actions.append(("hello", theme_name, hello_message))
     
-    await update.message.reply_text(message)
+    current = set(themes)
+    for theme_name, topic in topics.items():
+        if theme_name not in current and not topic.get("closed"):
+            actions.append(("close", theme_name, None))
+    return actions
 
-async def create_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Создает темы обсуждения по шаблону."""
-    # Проверяем, что команда отправлена в группе
+async def apply_sync_action(bot, chat_id, job, action):
+    """Выполняет одно действие синхронизации (кроме создания) и сохраняет задание."""
+    kind, theme_name, value = action
+    topic = job["topics"].get(theme_name)
+    if kind == "general":
+        await safe_api_call(bot.edit_forum_topic, 3, 2, chat_id=chat_id, message_thread_id=1, name=value,
+                            api_priority=PRIORITY_BULK)
+        job["main_name"] = value
+    elif kind == "rename":
+        await safe_api_call(bot.edit_forum_topic, 3, 2, chat_id=chat_id, message_thread_id=topic["thread_id"],
+                            name=value, api_priority=PRIORITY_BULK)
+        topic["name"] = value
+    elif kind == "hello":
+        await safe_api_call(bot.edit_message_text, 3, 2, chat_id=chat_id, message_id=topic["hello_message_id"],
+                            text=value, api_priority=PRIORITY_BULK)
+        topic["hello"] = value
+    elif kind == "close":
+        await safe_api_call(bot.close_forum_topic, 3, 2, chat_id=chat_id, message_thread_id=topic["thread_id"],
+                            api_priority=PRIORITY_BULK)
+        topic["closed"] = True
+    elif kind == "reopen":
+        await safe_api_call(bot.reopen_forum_topic, 3, 2, chat_id=chat_id, message_thread_id=topic["thread_id"],
+                            api_priority=PRIORITY_BULK)
+        topic["closed"] = False
+    save_create_job(chat_id)
+
+SYNC_ACTION_TITLES = {
+    "general": "переименование General",
+    "create": "создание",
+    "reopen": "открытие",
+    "rename": "переименование",
+    "hello": "обновление приветствия",
+    "close": "закрытие",
+}
+
+async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Приводит темы форума в соответствие с текущим шаблоном, выполняя только нужные изменения."""
     if update.effective_chat.type not in ['group', 'supergroup']:
-        await update.message.reply_text("⚠️ Эта команда работает только в группах.")
+        await reply_text(update.message, "⚠️ Эта команда работает только в группах.")
         return
     
-    # Проверяем, есть ли темы для создания
-    if not THEMES:
-        await update.message.reply_text("⚠️ Нет тем для создания. Добавьте темы с помощью команды /add")
+    chat_id = update.effective_chat.id
+    job = await load_create_job(chat_id)
+    if chat_id in ACTIVE_CREATE_CHATS:
+        await reply_text(update.message, "⏳ Создание или синхронизация тем в этой группе уже выполняется.")
         return
-        
-    status_message = await update.message.reply_text("Создаю темы обсуждения...")
     
+    if not job["topics"]:
+        await reply_text(update.message, "⚠️ Темы в этой группе еще не создавались. Используйте /create")
+        return
+    
+    template = get_chat_template(chat_id)
+    themes = list(template.themes)
+    hello_messages = list(template.hello_messages)
+    actions = plan_theme_sync(job, themes, hello_messages, template.main_name)
+    if not actions:
+        await reply_text(update.message, "✅ Темы форума уже соответствуют шаблону.")
+        return
+    
+    ACTIVE_CREATE_CHATS.add(chat_id)
     try:
-        chat = await safe_api_call(context.bot.get_chat, 3, 2, update.effective_chat.id)
-        
-        # Проверяем, является ли группа форумом
-        if not chat.is_forum:
-            await safe_api_call(
-                context.bot.edit_message_text,
-                3, 2,
-                chat_id=update.effective_chat.id,
-                message_id=status_message.message_id,
-                text="⚠️ Эта группа не является форумом. Включите темы обсуждения в настройках группы."
-            )
-            return
-            
-        # Пытаемся переименовать General (ID=1)
-        try:
-            await safe_api_call(
-                context.bot.edit_forum_topic,
-                3, 2,
-                chat_id=update.effective_chat.id,
-                message_thread_id=1,
-                name=MAIN_NAME
-            )
-            await safe_api_call(
-                context.bot.send_message,
-                3, 2,
-                chat_id=update.effective_chat.id,
-                text=f"✅ Тема 'General' переименована в '{MAIN_NAME}'"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при переименовании General: {e}")
-            await safe_api_call(
-                context.bot.send_message,
-                3, 2,
-                chat_id=update.effective_chat.id,
-                text=f"⚠️ Не удалось переименовать тему 'General'. Возможно, она не существует или у бота недостаточно прав."
-            )
-        
-        # Обновляем статус
-        await safe_api_call(
-            context.bot.edit_message_text,
-            3, 2,
-            chat_id=update.effective_chat.id,
-            message_id=status_message.message_id,
-            text="Создаю темы обсуждения... (0/{})".format(len(THEMES))
+        counts = Counter(kind for kind, _, _ in actions)
+        status_message = await reply_text(
+            update.message,
+            "🔄 Синхронизирую темы: " + ", ".join(f"{SYNC_ACTION_TITLES[kind]} - {n}" for kind, n in counts.items())
         )
         
-        # Создаем новые темы
-        successful_topics = 0
-        for i, theme_name in enumerate(THEMES, 1):
+        failed = 0
+        for action in actions:
+            if action[0] == "create":
+                continue
             try:
-                # Создаем тему с защищенным вызовом API
-                new_topic = await safe_api_call(
-                    context.bot.create_forum_topic,
-                    3, 3,
-                    chat_id=update.effective_chat.id,
-                    name=theme_name
-                )
-                
-                # Выбираем сообщение в зависимости от индекса темы
-                hello_message = HELLO_MESSAGES[i-1] if i <= len(HELLO_MESSAGES) else f"Добро пожаловать в тему '{theme_name}'"
-                
-                # Получаем ID темы из результата создания
-                topic_id = new_topic.message_thread_id
-                
-                # Отправляем сообщение в тему
-                await asyncio.sleep(1)
-                sent_message = await safe_api_call(
-                    context.bot.send_message,
-                    3, 2,
-                    chat_id=update.effective_chat.id,
-                    message_thread_id=topic_id,
-                    text=hello_message
-                )
-                
-                # Закрепляем сообщение
-                await asyncio.sleep(1)
-                await safe_api_call(
-                    context.bot.pin_chat_message,
-                    3, 2,
-                    chat_id=update.effective_chat.id,
-                    message_id=sent_message.message_id,
-                    disable_notification=True
-                )
-                
-                successful_topics += 1
-                
-                # Обновляем статус
-                await safe_api_call(
-                    context.bot.edit_message_text,
-                    3, 2,
-                    chat_id=update.effective_chat.id,
-                    message_id=status_message.message_id,
-                    text=f"Создаю темы обсуждения... ({successful_topics}/{len(THEMES)})"
-                )
-                
-                # Задержка между созданием тем
-                await asyncio.sleep(3)
-                
+                await apply_sync_action(context.bot, chat_id, job, action)
             except Exception as e:
-                logger.error(f"Ошибка при создании темы {theme_name}: {e}")
-                await safe_api_call(
-                    context.bot.send_message,
-                    3, 2,
-                    chat_id=update.effective_chat.id,
-                    text=f"⚠️ Ошибка при создании темы {theme_name}: {e}"
-                )
-                await asyncio.sleep(5)  # Пауза после ошибки
+                failed += 1
+                logger.error(f"Ошибка синхронизации ({SYNC_ACTION_TITLES[action[0]]} '{action[1]}'): {e}")
+        
+        if counts["create"]:
+            # Новые и недосозданные темы создаем тем же конвейером, что и /create
+            create_themes = [theme_name for kind, theme_name, _ in actions if kind == "create"]
+            create_hellos = [hello for kind, _, hello in actions if kind == "create"]
+            messages, other_calls = pending_create_steps(job, create_themes)
+            progress = CreateProgress(context.bot, chat_id, status_message.message_id, len(create_themes),
+                                      API_SCHEDULER.estimate_seconds(chat_id, messages, other_calls))
+            created, _ = await provision_topics(context.bot, chat_id, create_themes, create_hellos, progress, job)
+            failed += len(create_themes) - created
+        
+        job["completed"] = all(theme_name in job["topics"] and job["topics"][theme_name]["pinned"] for theme_name in themes)
+        save_create_job(chat_id)
         
-        # Финальное сообщение
-        await safe_api_call(
-            context.bot.edit_message_text,
-            3, 2,
-            chat_id=update.effective_chat.id,
-            message_id=status_message.message_id,
-            text=f"✅ Создание тем завершено! Успешно создано: {successful_topics}/{len(THEMES)}"
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при создании тем обсуждения: {e}")
         await safe_api_call(
             context.bot.edit_message_text,
             3, 2,
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             message_id=status_message.message_id,
-            text=f"⚠️ Произошла ошибка: {e}"
+            text=f"✅ Синхронизация завершена. Изменений: {len(actions) - failed}/{len(actions)}"
         )
+    finally:
+        ACTIVE_CREATE_CHATS.discard(chat_id)
+
+# ==================== КЭШ СВЕДЕНИЙ О ЧАТАХ ====================
+
+CHAT_INFO_TTL = 3600  # Сколько секунд доверяем признаку форума, полученному от API
+CHAT_INFO_NEGATIVE_TTL = 300  # Сколько секунд помним ошибку get_chat (чат не найден, бот удален)
+CHAT_INFO_MAX = 50000  # Максимум чатов в кэше; давно не использованные вытесняются
+CHAT_INFO = OrderedDict()  # chat_id -> (срок действия по time.monotonic(), is_forum или ошибка API)
+METADATA_CACHE_STATS = Counter()  # hits, negative_hits, misses, invalidations
+
+BOT_USER = None  # Пользователь бота; запрашивается один раз при запуске
+
+def remember_chat_info(chat_id, value, ttl=CHAT_INFO_TTL):
+    """Запоминает признак форума (или ошибку get_chat) для чата."""
+    CHAT_INFO[chat_id] = (time.monotonic() + ttl, value)
+    CHAT_INFO.move_to_end(chat_id)
+    while len(CHAT_INFO) > CHAT_INFO_MAX:
+        CHAT_INFO.popitem(last=False)
+
+def forget_chat_info(chat_id):
+    """Удаляет сведения о чате из кэша."""
+    if CHAT_INFO.pop(chat_id, None) is not None:
+        METADATA_CACHE_STATS["invalidations"] += 1
+
+async def chat_is_forum(bot, chat_id):
+    """Возвращает, включены ли в чате темы; get_chat вызывается только при промахе кэша."""
+    entry = CHAT_INFO.get(chat_id)
+    if entry is not None and entry[0] > time.monotonic():
+        CHAT_INFO.move_to_end(chat_id)
+        if isinstance(entry[1], Exception):
+            METADATA_CACHE_STATS["negative_hits"] += 1
+            # Новый экземпляр: повторный raise сохраненного накапливал бы кадры в его __traceback__
+            raise copy.copy(entry[1])
+        METADATA_CACHE_STATS["hits"] += 1
+        return entry[1]
+    
+    METADATA_CACHE_STATS["misses"] += 1
+    try:
+        chat = await safe_api_call(bot.get_chat, 3, 2, chat_id)
+    except (BadRequest, Forbidden) as e:
+        remember_chat_info(chat_id, e, CHAT_INFO_NEGATIVE_TTL)
+        raise
+    remember_chat_info(chat_id, bool(chat.is_forum))
+    return bool(chat.is_forum)
+
+async def get_bot_user(bot):
+    """Возвращает пользователя бота, запрашивая его у API только при первом обращении."""
+    global BOT_USER
+    if BOT_USER is None:
+        METADATA_CACHE_STATS["misses"] += 1
+        BOT_USER = await safe_api_call(bot.get_me, 3, 2)
+    else:
+        METADATA_CACHE_STATS["hits"] += 1
+    return BOT_USER
+
+async def track_chat_metadata(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обновляет кэш сведений о чатах по входящим обновлениям (без запросов к API)."""
+    message = update.effective_message
+    if message is not None and (message.migrate_to_chat_id or message.migrate_from_chat_id):
+        # Группа преобразована в супергруппу: у нее новый идентификатор и другие свойства
+        forget_chat_info(message.chat.id)
+        forget_chat_info(message.migrate_to_chat_id or message.migrate_from_chat_id)
+        return
+    
+    chat = update.effective_chat
+    if chat is None:
+        return
+    # В объекте чата из обновления is_forum указан только для форумов
+    is_forum = bool(chat.is_forum)
+    entry = CHAT_INFO.get(chat.id)
+    if entry is not None and entry[1] is not is_forum:
+        # Темы включили или выключили, либо чат снова доступен после ошибки
+        METADATA_CACHE_STATS["invalidations"] += 1
+    remember_chat_info(chat.id, is_forum)
 
 async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Реагирует на добавление бота в новую группу."""
     # Проверяем, есть ли бот среди новых участников
     new_members = update.message.new_chat_members
-    bot_user = await context.bot.get_me()
+    bot_user = await get_bot_user(context.bot)
     
     if not any(member.id == bot_user.id for member in new_members):
         return
@@ -708,8 +3429,8 @@ async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_
     # Бот был добавлен в группу
     logger.info(f"Бот добавлен в группу: {update.effective_chat.title}")
     
-    # Отправляем шаблонные сообщения с задержками
-    for i, message in enumerate(TEMPLATE_MESSAGES):
+    # Отправляем шаблонные сообщения; темп отправки задает планировщик API_SCHEDULER
+    for message in get_chat_template(update.effective_chat.id).template_messages:
         try:
             await safe_api_call(
                 context.bot.send_message,
@@ -717,18 +3438,12 @@ async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_
                 chat_id=update.effective_chat.id,
                 text=message
             )
-            # Добавляем задержку между сообщениями
-            if i < len(TEMPLATE_MESSAGES) - 1:
-                await asyncio.sleep(1)
         except Exception as e:
             logger.error(f"Ошибка при отправке приветственного сообщения: {e}")
         
     # Проверяем, является ли группа форумом и предлагаем создать темы
     try:
-        await asyncio.sleep(1)  # Задержка перед следующим запросом
-        chat = await safe_api_call(context.bot.get_chat, 3, 2, update.effective_chat.id)
-        
-        if chat.is_forum:
+        if await chat_is_forum(context.bot, update.effective_chat.id):
             await safe_api_call(
                 context.bot.send_message,
                 3, 2,
@@ -745,45 +3460,116 @@ async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_
     except Exception as e:
         logger.error(f"Ошибка при проверке типа группы: {e}")
 
+# ==================== ПРИВЕТСТВИЕ НОВЫХ УЧАСТНИКОВ ====================
+
+WELCOME_DEBOUNCE_SECONDS = 5.0  # Окно, в котором вступления в чат объединяются в одно приветствие
+WELCOME_MAX_PER_MINUTE = 3  # Не больше стольких приветствий в чат за минуту
+
+class WelcomeBatch:
+    """Ожидающие приветствия участники чата и время отправки последних приветствий."""
+    __slots__ = ("names", "sent_times", "task")
+
+    def __init__(self):
+        self.names = []
+        self.sent_times = deque()
+        self.task = None
+
+WELCOME_BATCHES = {}  # chat_id -> WelcomeBatch
+
+def format_welcome_messages(names):
+    """Собирает приветствие для списка участников, разбивая его по ограничению длины сообщения."""
+    if len(names) == 1:
+        return [f"Привет {names[0]} в группе, расскажи про себя и чем ты занимаешься! 👋"]
+    
+    prefix = "Привет "
+    suffix = " в группе, расскажите про себя и чем вы занимаетесь! 👋"
+    limit = MESSAGE_MAX_LENGTH - len(prefix) - len(suffix)
+    messages = []
+    chunk = []
+    length = 0
+    for name in names:
+        name = name[:limit]
+        if chunk and length + 2 + len(name) > limit:
+            messages.append(prefix + ", ".join(chunk) + suffix)
+            chunk, length = [], 0
+        length += len(name) + (2 if chunk else 0)
+        chunk.append(name)
+    if chunk:
+        messages.append(prefix + ", ".join(chunk) + suffix)
+    return messages
+
+async def wait_welcome_slot(batch):
+    """Ждет, пока в чат можно будет отправить очередное приветствие без превышения лимита."""
+    while True:
+        now = time.monotonic()
+        while batch.sent_times and now - batch.sent_times[0] >= 60:
+            batch.sent_times.popleft()
+        if len(batch.sent_times) < WELCOME_MAX_PER_MINUTE:
+            batch.sent_times.append(now)
+            return
+        await asyncio.sleep(60 - (now - batch.sent_times[0]))
+
+async def send_welcome_batch(bot, chat_id, batch):
+    """Через окно объединения отправляет одно приветствие всем, кто вступил за это время."""
+    try:
+        await asyncio.sleep(WELCOME_DEBOUNCE_SECONDS)
+        while batch.names:
+            await wait_welcome_slot(batch)
+            # Участники, вступившие во время ожидания лимита, попадают в это же приветствие
+            names = batch.names
+            batch.names = []
+            messages = format_welcome_messages(names)
+            for i, text in enumerate(messages):
+                if i:
+                    await wait_welcome_slot(batch)
+                try:
+                    await safe_api_call(bot.send_message, 3, 2, chat_id=chat_id, text=text)
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке приветствия в чат {chat_id}: {e}")
+            logger.info(f"Отправлено приветствие новым участникам ({len(names)}) в чате {chat_id}")
+    finally:
+        batch.task = None
+        # Запись чата нужна, пока ее sent_times ограничивают следующие приветствия
+        keep = 60 - (time.monotonic() - batch.sent_times[-1]) if batch.sent_times else 0
+        if keep > 0:
+            asyncio.get_running_loop().call_later(keep, drop_welcome_batch, chat_id, batch)
+        else:
+            drop_welcome_batch(chat_id, batch)
+
+def drop_welcome_batch(chat_id, batch):
+    """Удаляет запись чата, если в нее не попали новые участники."""
+    if batch.task is None and not batch.names and WELCOME_BATCHES.get(chat_id) is batch:
+        del WELCOME_BATCHES[chat_id]
+
 async def handle_new_user_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Приветствует новых участников группы."""
+    """Ставит новых участников группы в очередь на общее приветствие."""
     # Проверяем, что это сообщение о новых участниках
     if not update.message.new_chat_members:
         return
     
     # Получаем информацию о боте, чтобы его исключить
-    bot_user = await context.bot.get_me()
+    bot_user = await get_bot_user(context.bot)
     
-    # Приветствуем каждого нового участника (кроме бота)
+    names = []
     for new_member in update.message.new_chat_members:
-        # Пропускаем бота
-        if new_member.id == bot_user.id:
-            continue
-            
-        # Пропускаем других ботов
-        if new_member.is_bot:
+        # Пропускаем бота и других ботов
+        if new_member.id == bot_user.id or new_member.is_bot:
             continue
         
-        # Формируем приветственное сообщение
         if new_member.username:
-            username = f"@{new_member.username}"
+            names.append(f"@{new_member.username}")
         else:
-            username = new_member.full_name or "друг"
-        
-        welcome_message = f"Привет {username} в группе, расскажи про себя и чем ты занимаешься! 👋"
-        
-        try:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=welcome_message
-            )
-            logger.info(f"Отправлено приветствие новому участнику: {username} в группе {update.effective_chat.title}")
-            
-            # Небольшая задержка между приветствиями, если много людей
-            await asyncio.sleep(0.5)
-            
-        except Exception as e:
-            logger.error(f"Ошибка при отправке приветствия: {e}")
+            names.append(new_member.full_name or "друг")
+    if not names:
+        return
+    
+    chat_id = update.effective_chat.id
+    batch = WELCOME_BATCHES.get(chat_id)
+    if batch is None:
+        batch = WELCOME_BATCHES[chat_id] = WelcomeBatch()
+    batch.names.extend(names)
+    if batch.task is None:
+        batch.task = asyncio.create_task(send_welcome_batch(context.bot, chat_id, batch))
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает все сообщения и обновляет статистику."""
@@ -793,51 +3579,628 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
-    # Определяем тип контента
-    if update.message.text:
-        update_user_stats(chat_id, user_id, "text")
+    # Пополняем справочник имен без дополнительных запросов к API
+    remember_user_name(user_id, update.effective_user.full_name)
+    
+    # Определяем типы контента (animation - GIF); в одном сообщении их может быть несколько
+    content_types = [content_type for content_type in CONTENT_TYPES if getattr(update.message, content_type)]
+    if not content_types:
+        return
+    
+    # Активность считается по сообщениям, а не по типам контента в них
+    record_activity(chat_id, user_id)
+    for content_type in content_types:
+        update_user_stats(chat_id, user_id, content_type)
+
+# ==================== ПРИЕМ ОБНОВЛЕНИЙ ЧЕРЕЗ WEBHOOK ====================
+
+# Режим получения обновлений задается ключом "mode" в настройках: "polling" или "webhook".
+# Для webhook нужен "webhook_url" - публичный адрес (например, балансировщика), с которого
+# запросы приходят на webhook_listen:webhook_port
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_MAX_CONNECTIONS = 40  # Одновременных соединений от Telegram (и предел на стороне сервера)
+WEBHOOK_MAX_BODY = 4 * 1024 * 1024  # Максимальный размер тела запроса, байт
+WEBHOOK_IDLE_TIMEOUT = 75  # Сколько секунд держим неактивное keep-alive соединение
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+                503: "Service Unavailable"}
+
+class WebhookServer:
+    """Минимальный асинхронный HTTP-сервер, принимающий обновления Telegram (POST с JSON).
+    
+    on_update(data) получает разобранный JSON обновления. Запросы без верного
+    секретного токена отклоняются, число одновременных соединений ограничено.
+    """
+
+    def __init__(self, on_update, path=WEBHOOK_PATH, secret_token=None, max_connections=WEBHOOK_MAX_CONNECTIONS):
+        self.on_update = on_update
+        self.path = path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.connections = 0
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def respond(self, writer, status, keep_alive):
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+
+    async def process(self, method, target, headers, body):
+        """Проверяет запрос и передает обновление обработчику; возвращает HTTP-статус."""
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret_token and not hmac.compare_digest(
+                headers.get(SECRET_TOKEN_HEADER, "").encode(), self.secret_token.encode()):
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        try:
+            await self.on_update(data)
+        except Exception as e:
+            logger.error(f"Ошибка при приеме обновления через webhook: {e}")
+            return 500
+        return 200
+
+    async def handle_connection(self, reader, writer):
+        if self.connections >= self.max_connections:
+            await self.respond(writer, 503, False)
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), WEBHOOK_IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                    headers = {}
+                    for line in lines[1:]:
+                        if ":" in line:
+                            name, value = line.split(":", 1)
+                            headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    await self.respond(writer, 400, False)
+                    break
+                if length > WEBHOOK_MAX_BODY:
+                    await self.respond(writer, 413, False)
+                    break
+                try:
+                    body = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                status = await self.process(method, target, headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+def webhook_settings(config):
+    """Параметры webhook из настроек для run_webhook и start_webhook."""
+    return {
+        "url": config["webhook_url"],
+        "listen": config.get("webhook_listen", WEBHOOK_LISTEN),
+        "port": config.get("webhook_port", WEBHOOK_PORT),
+        "path": config.get("webhook_path", WEBHOOK_PATH),
+        "secret_token": config.get("webhook_secret"),
+        "max_connections": config.get("webhook_max_connections", WEBHOOK_MAX_CONNECTIONS),
+    }
+
+async def start_webhook(bot, on_update, url, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                        secret_token=None, max_connections=WEBHOOK_MAX_CONNECTIONS):
+    """Запускает WebhookServer и регистрирует его адрес в Telegram; возвращает сервер."""
+    # Секрет меняется при каждом запуске: Telegram получает его вместе с адресом в set_webhook
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    server = WebhookServer(on_update, path, secret_token, max_connections)
+    await server.start(listen, port)
+    try:
+        await safe_api_call(
+            bot.set_webhook,
+            3, 2,
+            url=url.rstrip("/") + path,
+            secret_token=secret_token,
+            max_connections=max_connections,
+            allowed_updates=Update.ALL_TYPES
+        )
+    except Exception:
+        await server.stop()
+        raise
+    logger.info(f"Webhook установлен: {url.rstrip('/') + path}, прием на {listen}:{port}")
+    return server
+
+async def run_webhook(application, **settings):
+    """Запускает приложение с приемом обновлений через webhook вместо run_polling."""
+    async def queue_update(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
     
-    if update.message.photo:
-        update_user_stats(chat_id, user_id, "photo")
+    try:
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            server = None
+            try:
+                server = await start_webhook(application.bot, queue_update, **settings)
+                await asyncio.Event().wait()
+            finally:
+                if server is not None:
+                    await server.stop()
+                await application.stop()
+    finally:
+        # Как и run_polling, сохраняем данные и при остановке по Ctrl+C
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# ==================== ШАРДИРОВАНИЕ ПО ЧАТАМ ====================
+
+# При "shards": N > 1 в настройках процесс-приемник (polling или webhook) распределяет
+# обновления по N процессам-обработчикам по chat_id. Каждый обработчик хранит статистику,
+# настройки и задания своих чатов в DATA_DIR/shard_<номер>. Личные чаты (в том числе
+# настройку шаблона по умолчанию) обрабатывает шард 0, он же рассылает шаблон по умолчанию
+# остальным через общий словарь Manager
+SHARD_ID = None  # Номер шарда в процессе-обработчике
+SHARD_COUNT = 1
+SHARD_STATE = None  # Общий словарь Manager: {номер шарда: сводка, "default_template": (версия, шаблон, переименования)}
+SHARD_PUBLISH_INTERVAL = 5  # Как часто шард публикует сводку и сверяет шаблон по умолчанию, сек
+SHARD_POLL_TIMEOUT = 30  # Таймаут длинного опроса getUpdates в процессе-приемнике
+SHARD_UPDATES_PROCESSED = 0
+_default_template_stamp = 0  # Метка последнего изменения шаблона по умолчанию
+SHARED_RENAMES_MAX = 1000
+# Переименования тем шаблона по умолчанию в шарде 0: (метка, старое название, новое название).
+# Остальные шарды переносят их в свои задания создания тем, иначе /sync закрыл бы тему и создал новую
+DEFAULT_TEMPLATE_RENAMES = deque(maxlen=SHARED_RENAMES_MAX)
+
+# Поля обновления, содержащие объект с чатом, в порядке проверки
+UPDATE_CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                      "business_message", "edited_business_message", "my_chat_member",
+                      "chat_member", "chat_join_request", "message_reaction", "message_reaction_count",
+                      "chat_boost", "removed_chat_boost")
+
+def update_chat_id(data):
+    """chat_id обновления по его JSON без построения объекта Update (None, если чата нет)."""
+    for field in UPDATE_CHAT_FIELDS:
+        obj = data.get(field)
+        if obj is not None:
+            return obj["chat"]["id"]
+    callback_query = data.get("callback_query")
+    if callback_query is not None and callback_query.get("message"):
+        return callback_query["message"]["chat"]["id"]
+    return None
+
+def shard_for_chat(chat_id, shard_count):
+    """Номер шарда для чата: группы распределяются по chat_id, личные чаты и прочее - шард 0."""
+    if chat_id is None or chat_id > 0:
+        return 0
+    return chat_id % shard_count
+
+def set_data_dir(path):
+    """Переносит все файлы данных процесса в другую директорию."""
+    global DATA_DIR, CONFIG_FILE, STATS_FILE, STATS_SNAPSHOT_FILE, STATS_JOURNAL_FILE, DATABASE_FILE
+    global ACTIVITY_FILE, USER_NAMES_FILE, CREATE_JOBS_DIR, TRACE_FILE
+    DATA_DIR = path
+    CONFIG_FILE = os.path.join(path, os.path.basename(CONFIG_FILE))
+    STATS_FILE = os.path.join(path, os.path.basename(STATS_FILE))
+    STATS_SNAPSHOT_FILE = os.path.join(path, os.path.basename(STATS_SNAPSHOT_FILE))
+    STATS_JOURNAL_FILE = os.path.join(path, os.path.basename(STATS_JOURNAL_FILE))
+    DATABASE_FILE = os.path.join(path, os.path.basename(DATABASE_FILE))
+    ACTIVITY_FILE = os.path.join(path, os.path.basename(ACTIVITY_FILE))
+    USER_NAMES_FILE = os.path.join(path, os.path.basename(USER_NAMES_FILE))
+    CREATE_JOBS_DIR = os.path.join(path, os.path.basename(CREATE_JOBS_DIR))
+    TRACE_FILE = os.path.join(path, os.path.basename(TRACE_FILE))
+
+def shard_data_dir(shard_id):
+    return os.path.join(DATA_DIR, f"shard_{shard_id}")
+
+def seed_shard(shard_id, shard_count):
+    """Создает данные шарда из общих данных: настройки, статистику, активность и задания его чатов.
     
-    if update.message.sticker:
-        update_user_stats(chat_id, user_id, "sticker")
+    Выполняется один раз, когда у шарда еще нет файла настроек; общие данные не изменяются.
+    """
+    shard_dir = shard_data_dir(shard_id)
+    os.makedirs(shard_dir, exist_ok=True)
     
-    if update.message.video:
-        update_user_stats(chat_id, user_id, "video")
+    def own(chat_id):
+        return shard_for_chat(int(chat_id), shard_count) == shard_id
     
-    if update.message.animation:  # GIFs
-        update_user_stats(chat_id, user_id, "animation")
+    if STORAGE_BACKEND == "sqlite":
+        stats = defaultdict(lambda: defaultdict(dict))
+        for chat_id, user_id, content_type, count in get_db().execute(
+                "SELECT chat_id, user_id, content_type, count FROM user_stats"):
+            if own(chat_id):
+                stats[chat_id][user_id][content_type] = count
+    else:
+        stats = {chat_id: chat_stats.to_dict() for chat_id, chat_stats in USER_STATS.items() if own(chat_id)}
+    atomic_write_text(os.path.join(shard_dir, os.path.basename(STATS_FILE)),
+                      json.dumps(stats, separators=(",", ":")))
     
-    if update.message.document:
-        update_user_stats(chat_id, user_id, "document")
+    hour = current_hour()
+    activity = {}
+    for chat_id, chat_activity in CHAT_ACTIVITY.items():
+        if own(chat_id):
+            chat_activity.advance(hour)
+            activity[str(chat_id)] = chat_activity.to_dict()
+    atomic_write_text(os.path.join(shard_dir, os.path.basename(ACTIVITY_FILE)),
+                      json.dumps(activity, separators=(",", ":")))
     
-    if update.message.voice:
-        update_user_stats(chat_id, user_id, "voice")
+    if os.path.exists(USER_NAMES_FILE):
+        shutil.copy(USER_NAMES_FILE, os.path.join(shard_dir, os.path.basename(USER_NAMES_FILE)))
+    if os.path.isdir(CREATE_JOBS_DIR):
+        jobs_dir = os.path.join(shard_dir, os.path.basename(CREATE_JOBS_DIR))
+        os.makedirs(jobs_dir, exist_ok=True)
+        for file_name in os.listdir(CREATE_JOBS_DIR):
+            if file_name.endswith(".json") and file_name[:-5].lstrip("-").isdigit() and own(file_name[:-5]):
+                shutil.copy(os.path.join(CREATE_JOBS_DIR, file_name), os.path.join(jobs_dir, file_name))
     
-    if update.message.audio:
-        update_user_stats(chat_id, user_id, "audio")
+    # Настройки записываются в JSON; при хранилище sqlite шард перенесет их в свою базу при запуске
+    config = dict(CONFIG)
+    config.pop("database_file", None)
+    config["storage"] = STORAGE_BACKEND
+    config["shard_count"] = shard_count  # Разбиение, по которому отобраны чаты шарда
+    config["chat_templates"] = {
+        chat_id: template for chat_id, template in CONFIG.get("chat_templates", {}).items() if own(chat_id)
+    }
+    atomic_write_text(os.path.join(shard_dir, os.path.basename(CONFIG_FILE)),
+                      json.dumps(config, ensure_ascii=False, indent=4))
+    logger.info(f"Созданы данные шарда {shard_id}: чатов со статистикой {len(stats)}")
 
-def main():
-    """Запускает бота."""
-    # Инициализируем конфигурацию
-    config = init_config()
+def check_shard_layout(shard_count):
+    """Проверяет, что данные шардов в DATA_DIR созданы для того же числа шардов.
     
-    # Если токен не настроен, запрашиваем его
-    global BOT_TOKEN
-    if not BOT_TOKEN:
-        print("⚠️ Токен бота не настроен. Введите токен бота:")
-        BOT_TOKEN = input().strip()
-        config["bot_token"] = BOT_TOKEN
-        save_config(config)
+    Возвращает текст ошибки или None. При другом числе шардов чаты попали бы не в тот шард,
+    где лежат их статистика и задания, поэтому запуск нужно остановить.
+    """
+    if not os.path.isdir(DATA_DIR):
+        return None
+    existing = {}
+    for name in os.listdir(DATA_DIR):
+        config_path = os.path.join(DATA_DIR, name, os.path.basename(CONFIG_FILE))
+        if name.startswith("shard_") and name[6:].isdigit() and os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                existing[int(name[6:])] = json.load(f).get("shard_count")
+    if not existing:
+        return None
+    # Шарды, созданные до появления ключа shard_count, сверяем по числу директорий
+    counts = {count if count is not None else len(existing) for count in existing.values()}
+    if counts == {shard_count} and max(existing) < shard_count:
+        return None
+    return (f"Данные в {DATA_DIR} разбиты на шарды: {', '.join(map(str, sorted(counts)))}, а в настройках "
+            f"shards = {shard_count}. Верните прежнее значение или перенесите данные шардов вручную")
+
+def shard_summary():
+    """Сводка шарда для /status в других шардах."""
+    if STORAGE_BACKEND == "sqlite":
+        chats, users = get_db().execute("SELECT COUNT(DISTINCT chat_id), COUNT(*) FROM user_totals").fetchone()
+    else:
+        chats = len(USER_STATS)
+        users = USER_STATS.user_count()
+    return {
+        "pid": os.getpid(),
+        "chats": chats,
+        "users": users,
+        "templates": len(CHAT_TEMPLATES),
+        "updates": SHARD_UPDATES_PROCESSED,
+        "updated_at": time.time(),
+    }
+
+async def current_shard_summary():
+    """Сводка своего шарда; запрос к базе выполняется в потоке записи, а не в цикле событий."""
+    return await PERSISTENCE.run(shard_summary) if STORAGE_BACKEND == "sqlite" else shard_summary()
+
+async def apply_shared_renames(renames):
+    """Переносит в задания шарда переименования тем, опубликованные шардом 0 после уже примененных."""
+    if renames and renames[-1][0] > CONFIG.get("shared_renames_stamp", 0):
+        await load_stored_create_jobs()
+    applied = CONFIG.get("shared_renames_stamp", 0)
+    for stamp, old_name, new_name in renames:
+        if stamp > applied:
+            rename_default_theme_in_jobs(old_name, new_name)
+            applied = stamp
+    if applied != CONFIG.get("shared_renames_stamp", 0):
+        # Метка хранится в настройках шарда, чтобы после перезапуска не применять переименования повторно
+        CONFIG["shared_renames_stamp"] = applied
+        schedule_config_save()
+
+def apply_shared_default_template(data):
+    """Применяет шаблон по умолчанию, опубликованный шардом 0."""
+    global DEFAULT_TEMPLATE
+    DEFAULT_TEMPLATE = ThemeTemplate.from_dict(data, DEFAULT_TEMPLATE)
+    CONFIG.update(DEFAULT_TEMPLATE.to_dict())
+    schedule_config_save()
+    logger.info(f"Получен шаблон по умолчанию от шарда 0: тем {len(DEFAULT_TEMPLATE)}")
+
+async def shard_publisher():
+    """Фоновая задача шарда: публикует сводку и синхронизирует шаблон по умолчанию."""
+    published_stamp = applied_stamp = None
+    while True:
+        try:
+            if SHARD_ID == 0:
+                version = (_default_template_stamp, DEFAULT_TEMPLATE_RENAMES[-1][0] if DEFAULT_TEMPLATE_RENAMES else 0)
+                if published_stamp != version:
+                    await asyncio.to_thread(SHARD_STATE.__setitem__, "default_template",
+                                            (version, DEFAULT_TEMPLATE.to_dict(), list(DEFAULT_TEMPLATE_RENAMES)))
+                    published_stamp = version
+            else:
+                shared = await asyncio.to_thread(SHARD_STATE.get, "default_template")
+                if shared is not None and shared[0] != applied_stamp:
+                    # Сначала задания, затем шаблон: иначе переименованная тема выглядела бы новой
+                    await apply_shared_renames(shared[2])
+                    if applied_stamp is not None or shared[1] != DEFAULT_TEMPLATE.to_dict():
+                        apply_shared_default_template(shared[1])
+                    applied_stamp = shared[0]
+            summary = await current_shard_summary()
+            await asyncio.to_thread(SHARD_STATE.__setitem__, SHARD_ID, summary)
+        except Exception as e:
+            logger.error(f"Ошибка при обмене данными шарда {SHARD_ID}: {e}")
+        await asyncio.sleep(SHARD_PUBLISH_INTERVAL)
+
+async def run_shard_worker(application, updates):
+    """Передает приложению обновления, полученные от процесса-приемника."""
+    global SHARD_UPDATES_PROCESSED
+    loop = asyncio.get_running_loop()
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    def next_update():
+        # Ожидание с таймаутом, чтобы поток пула завершился при остановке
+        try:
+            return updates.get(timeout=1)
+        except queue.Empty:
+            return False
+    
+    try:
+        async with application:
+            await application.post_init(application)
+            await application.start()
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, next_update)
+                    if data is False:
+                        continue
+                    if data is None:
+                        break
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                    SHARD_UPDATES_PROCESSED += 1
+            finally:
+                await application.stop()
+    finally:
+        await application.post_shutdown(application)
+
+def shard_worker_main(shard_id, shard_count, updates, shared_state, data_dir):
+    """Точка входа процесса-обработчика шарда."""
+    global SHARD_ID, SHARD_COUNT, SHARD_STATE
+    SHARD_ID, SHARD_COUNT, SHARD_STATE = shard_id, shard_count, shared_state
+    set_data_dir(os.path.join(data_dir, f"shard_{shard_id}"))
+    init_config()
+    
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .updater(None)
+        .concurrent_updates(update_processor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    register_handlers(application)
+    logger.info(f"Шард {shard_id}/{shard_count} запущен, данные в {DATA_DIR}")
+    try:
+        asyncio.run(run_shard_worker(application, updates))
+    except KeyboardInterrupt:
+        pass
+
+async def run_shard_front(config, queues):
+    """Процесс-приемник: получает обновления и передает их шардам по chat_id."""
+    def route(data):
+        queues[shard_for_chat(update_chat_id(data), len(queues))].put(data)
+    
+    async with Bot(BOT_TOKEN) as bot:
+        if config.get("mode") == "webhook":
+            async def on_update(data):
+                route(data)
+            
+            server = await start_webhook(bot, on_update, **webhook_settings(config))
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+            return
+        
+        await safe_api_call(bot.delete_webhook, 3, 2)
+        offset = None
+        while True:
+            try:
+                # Через планировщик: после RetryAfter следующий запрос ждет указанное Telegram время,
+                # таймауты повторяются с экспоненциальной паузой
+                updates = await safe_api_call(bot.get_updates, 3, 2, offset=offset, timeout=SHARD_POLL_TIMEOUT,
+                                              allowed_updates=Update.ALL_TYPES)
+            except (RetryAfter, TimedOut, NetworkError) as e:
+                logger.warning(f"Ошибка при получении обновлений: {e}")
+                continue
+            for update in updates:
+                route(update.to_dict())
+                offset = update.update_id + 1
+
+def run_sharded(config, shard_count):
+    """Запускает процессы-обработчики шардов и процесс-приемник в текущем процессе."""
+    for shard_id in range(shard_count):
+        if not os.path.exists(os.path.join(shard_data_dir(shard_id), os.path.basename(CONFIG_FILE))):
+            seed_shard(shard_id, shard_count)
+    # Общие данные нужны только для создания шардов
+    USER_STATS.clear()
+    CHAT_ACTIVITY.clear()
+    close_stats_journal()
+    close_db()
+    
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    shared_state = manager.dict()
+    queues = [context.Queue() for _ in range(shard_count)]
+    processes = [
+        context.Process(target=shard_worker_main, name=f"shard-{shard_id}",
+                        args=(shard_id, shard_count, queues[shard_id], shared_state, DATA_DIR))
+        for shard_id in range(shard_count)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(run_shard_front(config, queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for shard_queue in queues:
+            shard_queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+        manager.shutdown()
+
+# ==================== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ====================
+
+# По умолчанию обновления обрабатываются по одному. При "concurrent_updates" > 1 в настройках
+# обновления разных чатов обрабатываются параллельно, а обновления одного чата - строго по порядку.
+# Общие данные (USER_STATS, шаблоны тем) обработчики меняют без ожиданий внутри изменения,
+# поэтому однопоточный цикл событий не требует для них дополнительных блокировок
+CONCURRENT_UPDATES = 1  # Сколько обновлений разных чатов обрабатывается одновременно
+CONCURRENT_UPDATES_PENDING = 1024  # Сколько обновлений одновременно ждут своей очереди в чатах
+
+def update_order_key(update):
+    """Ключ, в пределах которого сохраняется порядок обработки: чат, а без чата - пользователь."""
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    if chat is not None:
+        return chat.id
+    user = update.effective_user
+    return user.id if user is not None else None
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов с сохранением порядка внутри чата.
+    
+    Семафор базового класса ограничивает число обновлений, ожидающих очереди своего чата,
+    собственный семафор running - число обрабатываемых одновременно.
+    """
+    __slots__ = ("running", "chat_locks")
+
+    def __init__(self, max_running, max_pending):
+        super().__init__(max(max_pending, max_running))
+        self.running = asyncio.BoundedSemaphore(max_running)
+        self.chat_locks = {}  # ключ порядка -> [asyncio.Lock, число обновлений в очереди чата]
 
-    # Добавляем обработчики команд
+    async def do_process_update(self, update, coroutine):
+        key = update_order_key(update)
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+        entry = self.chat_locks.get(key)
+        if entry is None:
+            entry = self.chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock пропускает ожидающих в порядке очереди, а задачи обновлений
+            # доходят до блокировки в порядке получения обновлений
+            async with entry[0]:
+                async with self.running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def update_processor():
+    """Значение для Application.builder().concurrent_updates() по настройкам."""
+    if CONCURRENT_UPDATES > 1:
+        return ChatOrderedUpdateProcessor(CONCURRENT_UPDATES, CONCURRENT_UPDATES_PENDING)
+    return False
+
+async def post_init(application: Application) -> None:
+    """Запускает фоновые задачи после инициализации приложения."""
+    global _stats_flush_event, _config_save_event, _config_stamp, BOT_USER, _metrics_application, _metrics_server
+    _stats_flush_event = asyncio.Event()
+    _config_save_event = asyncio.Event()
+    PERSISTENCE.start()
+    if STORAGE_BACKEND == "sqlite":
+        # data_version своя у каждого соединения: отметку для config_watcher берем у соединения потока записи
+        _config_stamp = await PERSISTENCE.run(config_stamp)
+    _background_tasks.append(asyncio.create_task(stats_flusher()))
+    _background_tasks.append(asyncio.create_task(config_writer()))
+    _background_tasks.append(asyncio.create_task(config_watcher()))
+    if SHARD_STATE is not None:
+        _background_tasks.append(asyncio.create_task(shard_publisher()))
+    _metrics_application = application
+    if PROFILING_ENABLED:
+        start_profiling(application)
+    if METRICS_PORT:
+        port = METRICS_PORT + (SHARD_ID or 0)
+        _metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, port)
+        logger.info(f"Метрики доступны на http://{METRICS_LISTEN}:{port}/metrics")
+    # Бот уже инициализирован (get_me выполнен), запоминаем его пользователя
+    BOT_USER = application.bot.bot
+
+async def post_shutdown(application: Application) -> None:
+    """Останавливает фоновые задачи и сохраняет несохраненную статистику."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    if _metrics_server is not None:
+        _metrics_server.close()
+    stop_profiling()
+    for batch in WELCOME_BATCHES.values():
+        if batch.task is not None:
+            batch.task.cancel()
+    flush_config()
+    compact_user_stats()
+    save_activity_stats()
+    save_user_names()
+    PERSISTENCE.submit(close_db_connection)
+    # Дожидаемся записи всего поставленного в очередь; дальше запись выполняется сразу
+    await asyncio.to_thread(PERSISTENCE.stop)
+    close_stats_journal()
+    close_db()
+
+def register_handlers(application):
+    """Регистрирует обработчики команд и сообщений бота."""
+    # Сведения о чатах из каждого обновления (группа -1 выполняется раньше остальных обработчиков)
+    application.add_handler(TypeHandler(Update, track_chat_metadata), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("create", create_command))
+    # При параллельной обработке долгие команды не задерживают следующие обновления своего чата
+    # (повторный запуск в том же чате отклоняется по ACTIVE_CREATE_CHATS)
+    long_running_block = CONCURRENT_UPDATES <= 1
+    application.add_handler(CommandHandler("create", create_command, block=long_running_block))
     application.add_handler(CommandHandler("settings", settings_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("stats", stats_command))
@@ -848,27 +4211,94 @@ def main():
     application.add_handler(CommandHandler("list_themes", list_themes_command))
     application.add_handler(CommandHandler("edit_theme", edit_theme_command))
     application.add_handler(CommandHandler("edit_hello", edit_hello_command))
+    application.add_handler(CommandHandler("sync", sync_command, block=long_running_block))
+    application.add_handler(CommandHandler("import_themes", import_themes_command))
+    application.add_handler(CommandHandler("export_themes", export_themes_command))
+    # Файл с подписью /import_themes (подписи не разбираются CommandHandler)
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import_themes(@\w+)?(\s|$)"), import_themes_command))
     
     # Добавляем обработчик для интерактивных кнопок настроек
     application.add_handler(CallbackQueryHandler(settings_callback))
     
-    # Добавляем обработчик для новых участников в группе
+    # Добавляем обработчики для новых участников в группе. В одной группе срабатывает только первый
+    # подходящий обработчик, поэтому реакция на добавление бота - в своей группе
     application.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_user_welcome))
-    application.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_chat_members))
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_chat_members), group=1)
     
     # Добавляем обработчик для всех сообщений (для сбора статистики)
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
+    
+    # Замеряем длительность каждого обработчика для метрик
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+    if PROFILING_ENABLED:
+        application.add_handler(TypeHandler(Update, trace_update_start), group=PROFILE_HANDLER_GROUPS[0])
+        application.add_handler(TypeHandler(Update, trace_update_end), group=PROFILE_HANDLER_GROUPS[1])
 
-    # Запускаем бота
-    print(f"🚀 Бот запускается...")
+def main():
+    """Запускает бота."""
+    # Инициализируем конфигурацию
+    config = init_config()
+    
+    # Если токен не настроен, запрашиваем его
+    global BOT_TOKEN
+    if not BOT_TOKEN:
+        print("⚠️ Токен бота не настроен. Введите токен бота:")
+        BOT_TOKEN = input().strip()
+        config["bot_token"] = BOT_TOKEN
+        schedule_config_save()
+    
+    mode = config.get("mode", "polling")
+    if mode == "webhook" and not config.get("webhook_url"):
+        print("⚠️ Для режима webhook укажите webhook_url в настройках")
+        return
+    print(f"🚀 Бот запускается ({mode})...")
     print(f"📁 Файлы сохраняются в директорию: {DATA_DIR}")
-    print(f"📋 Доступных тем: {len(THEMES)}")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    
+    shard_count = config.get("shards", 1)
+    layout_error = check_shard_layout(shard_count)
+    if layout_error:
+        logger.error(layout_error)
+        print(f"⚠️ {layout_error}")
+        return
+    if shard_count > 1:
+        # Обработчики и данные живут в процессах шардов
+        print(f"🧩 Обновления распределяются по шардам: {shard_count}")
+        run_sharded(config, shard_count)
+        return
+    
+    # Создаем приложение
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    register_handlers(application)
+
+    # Запускаем бота
+    print(f"📋 Тем в шаблоне по умолчанию: {len(DEFAULT_TEMPLATE)}, групп со своим шаблоном: {len(CHAT_TEMPLATES)}")
+    if mode == "webhook":
+        asyncio.run(run_webhook(application, **webhook_settings(config)))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "provision":
+        provision_main(sys.argv[2:])
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "export_stats":
+        export_stats_main(sys.argv[2:])
+        sys.exit()
     try:
         main()
     except KeyboardInterrupt:
         print("\n🛑 Бот остановлен")
         # Сохраняем статистику перед выходом
-        save_user_stats()
\ No newline at end of file
+        compact_user_stats()
+        close_stats_journal()
+        save_activity_stats()
+        save_user_names()
\ No newline at end of file
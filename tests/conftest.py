@@ -0,0 +1,14 @@
+import pytest
+
+import botver2
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    previous = botver2.DATA_DIR
+    botver2.set_data_dir(str(tmp_path))
+    botver2.init_config()
+    yield tmp_path
+    botver2.close_stats_journal()
+    botver2.USER_STATS.snapshot.close()
+    botver2.set_data_dir(previous)
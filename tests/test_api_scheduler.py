@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import botver2
+from botver2 import PRIORITY_BULK, PRIORITY_INTERACTIVE, ApiScheduler
+
+GROUP = -100
+OTHER_GROUP = -200
+
+
+def scheduler(global_per_sec=1000, group_per_min=60000, group_burst=100, private_per_sec=1000):
+    api_scheduler = ApiScheduler()
+    api_scheduler.configure(global_per_sec, group_per_min, group_burst, private_per_sec)
+    return api_scheduler
+
+
+def test_interactive_requests_overtake_bulk():
+    async def run():
+        api_scheduler = scheduler(global_per_sec=50)
+        api_scheduler.global_bucket.tokens = 0
+        order = []
+        
+        async def request(name, priority):
+            await api_scheduler.acquire(GROUP, priority)
+            order.append(name)
+        
+        bulk = [asyncio.create_task(request(f"bulk{i}", PRIORITY_BULK)) for i in range(3)]
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(request("interactive", PRIORITY_INTERACTIVE))
+        await asyncio.gather(*bulk, interactive)
+        return order
+    
+    assert asyncio.run(run()) == ["interactive", "bulk0", "bulk1", "bulk2"]
+
+
+def test_group_burst_then_group_rate():
+    async def run():
+        api_scheduler = scheduler(group_per_min=600, group_burst=2)
+        started = time.monotonic()
+        for _ in range(3):
+            await api_scheduler.acquire(GROUP)
+        return time.monotonic() - started
+    
+    # Два запроса без ожидания, третий - через 1/10 секунды
+    assert 0.08 <= asyncio.run(run()) < 0.5
+
+
+def test_retry_after_blocks_only_its_chat():
+    async def run():
+        api_scheduler = scheduler()
+        api_scheduler.penalize(GROUP, 0.2)
+        started = time.monotonic()
+        await api_scheduler.acquire(OTHER_GROUP)
+        other = time.monotonic() - started
+        await api_scheduler.acquire(GROUP)
+        return other, time.monotonic() - started
+    
+    other, blocked = asyncio.run(run())
+    assert other < 0.1
+    assert blocked >= 0.18
+
+
+def test_safe_api_call_waits_retry_after_and_retries(monkeypatch):
+    monkeypatch.setattr(botver2, "API_SCHEDULER", scheduler())
+    calls = []
+    
+    async def send_message(chat_id, text):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(0.2)
+        return text
+    
+    assert asyncio.run(botver2.safe_api_call(send_message, 3, 2, chat_id=GROUP, text="ok")) == "ok"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.18
+    assert botver2.API_SCHEDULER.chat_bucket(GROUP).blocked_until > 0
+
+
+def test_safe_api_call_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(botver2, "API_SCHEDULER", scheduler())
+    
+    async def send_message(chat_id, text):
+        raise RetryAfter(0.01)
+    
+    with pytest.raises(RetryAfter):
+        asyncio.run(botver2.safe_api_call(send_message, 2, 0, chat_id=GROUP, text="x"))
+
+
+def test_reconfigure_keeps_pending_waiters():
+    async def run():
+        api_scheduler = scheduler(global_per_sec=1)
+        await api_scheduler.acquire(GROUP)
+        waiter = asyncio.create_task(api_scheduler.acquire(GROUP))
+        await asyncio.sleep(0.01)
+        api_scheduler.configure(1000, 60000, 100, 1000)
+        await asyncio.wait_for(waiter, 0.5)
+    
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+from array import array
+
+import botver2
+from botver2 import CONTENT_TYPE_INDEX, ChatStats
+
+TEXT = CONTENT_TYPE_INDEX["text"]
+PHOTO = CONTENT_TYPE_INDEX["photo"]
+
+
+def test_increment_counts_per_type_and_total():
+    stats = ChatStats()
+    assert stats.increment(1, TEXT) == 1
+    assert stats.increment(1, TEXT) == 2
+    assert stats.increment(1, PHOTO) == 1
+    stats.increment(2, PHOTO)
+    
+    assert len(stats) == 2
+    assert stats.get(1) == {"text": 2, "photo": 1}
+    assert stats.get(2) == {"photo": 1}
+    assert stats.total(1) == 3
+    assert stats.to_dict() == {"1": {"text": 2, "photo": 1}, "2": {"photo": 1}}
+
+
+def test_set_max_never_decreases_counter():
+    stats = ChatStats()
+    stats.set_max(1, TEXT, 5)
+    stats.set_max(1, TEXT, 3)
+    assert stats.get(1) == {"text": 5}
+    assert stats.total(1) == 5
+    stats.set_max(1, PHOTO, 2)
+    assert stats.total(1) == 7
+
+
+def test_copy_is_independent():
+    stats = ChatStats()
+    stats.increment(1, TEXT)
+    copy = stats.copy()
+    stats.increment(1, TEXT)
+    stats.increment(2, TEXT)
+    assert copy.to_dict() == {"1": {"text": 1}}
+
+
+def test_block_round_trip():
+    stats = ChatStats()
+    for user_id in (10, -3, 2**40):
+        for _ in range(user_id % 5 + 1):
+            stats.increment(user_id, TEXT)
+        stats.increment(user_id, PHOTO)
+    block = stats.to_block()
+    assert len(block) == botver2.stats_block_size(len(stats))
+    
+    restored = ChatStats.from_block(block, len(stats))
+    assert restored.to_dict() == stats.to_dict()
+    assert [restored.total(user_id) for user_id in (10, -3, 2**40)] == [stats.total(user_id) for user_id in (10, -3, 2**40)]
+
+
+def test_block_with_other_content_types_keeps_known_columns():
+    content_types = ("photo", "poll", "text")
+    data = b"".join([
+        array("q", [7]).tobytes(),
+        array("I", [2, 9, 4]).tobytes(),
+        array("I", [15]).tobytes(),
+    ])
+    restored = ChatStats.from_block(data, 1, content_types)
+    assert restored.get(7) == {"text": 4, "photo": 2}
+    assert restored.total(7) == 6
@@ -0,0 +1,78 @@
+import random
+
+import botver2
+from botver2 import CONTENT_TYPE_INDEX, ChatStats, Leaderboard
+
+TEXT = CONTENT_TYPE_INDEX["text"]
+
+
+def test_initial_order_is_by_total_then_user_id():
+    board = Leaderboard(3, [(5, 1), (7, 2), (5, 3), (1, 4)])
+    assert board.top() == [(2, 7), (1, 5), (3, 5)]
+
+
+def test_update_reorders_existing_member():
+    board = Leaderboard(3, [(5, 1), (7, 2), (6, 3)])
+    assert board.update(1, 8)
+    assert board.top() == [(1, 8), (2, 7), (3, 6)]
+
+
+def test_update_evicts_lowest_member():
+    board = Leaderboard(2, [(5, 1), (7, 2)])
+    assert board.update(3, 6)
+    assert board.top() == [(2, 7), (3, 6)]
+    assert 1 not in board.members
+
+
+def test_update_below_full_board_is_ignored():
+    board = Leaderboard(2, [(5, 1), (7, 2)])
+    assert not board.update(3, 4)
+    # При равенстве выше тот, у кого меньше user_id, поэтому 3 не вытесняет 1
+    assert not board.update(3, 5)
+    assert board.top() == [(2, 7), (1, 5)]
+
+
+def test_tie_with_smaller_user_id_enters_board():
+    board = Leaderboard(2, [(5, 4), (7, 2)])
+    assert board.update(3, 5)
+    assert board.top() == [(2, 7), (3, 5)]
+
+
+def test_chat_top_matches_full_sort():
+    rnd = random.Random(7)
+    stats = ChatStats()
+    stats.top(5)  # Индекс строится сразу и дальше обновляется инкрементально
+    for _ in range(3000):
+        stats.increment(rnd.randrange(60), TEXT)
+    expected = sorted(((user_id, stats.total(user_id)) for user_id in stats.user_slots),
+                      key=lambda entry: (-entry[1], entry[0]))
+    assert stats.top(5) == expected[:5]
+    assert stats.top(botver2.LEADERBOARD_SIZE + 5) == expected[:botver2.LEADERBOARD_SIZE + 5]
+
+
+def test_initial_board_and_updates_agree_on_ties():
+    stats = ChatStats()
+    for user_id in range(botver2.LEADERBOARD_SIZE + 1, 0, -1):
+        stats.increment(user_id, TEXT)
+    # Все равны: в топ попадают меньшие user_id, как и при инкрементальном обновлении
+    assert [user_id for user_id, _ in stats.top(botver2.LEADERBOARD_SIZE)] == list(range(1, botver2.LEADERBOARD_SIZE + 1))
+
+
+def test_version_changes_only_when_visible_stats_change():
+    stats = ChatStats()
+    for user_id in range(botver2.LEADERBOARD_SIZE):
+        for _ in range(10):
+            stats.increment(user_id, TEXT)
+    outsider = botver2.LEADERBOARD_SIZE
+    stats.increment(outsider, TEXT)
+    stats.top(3)
+    version = stats.version
+    
+    # Пользователь вне топа не меняет ни состав топа, ни число пользователей
+    stats.increment(outsider, TEXT)
+    assert outsider not in stats.leaderboard.members
+    assert stats.version == version
+    stats.increment(outsider - 1, TEXT)
+    assert stats.version == version + 1
+    stats.increment(100, TEXT)
+    assert stats.version == version + 2
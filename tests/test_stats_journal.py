@@ -0,0 +1,69 @@
+import botver2
+
+CHAT_ID = -1001
+USER_ID = 42
+
+
+def count_messages(times, content_type="text", user_id=USER_ID):
+    for _ in range(times):
+        botver2.update_user_stats(CHAT_ID, user_id, content_type)
+
+
+def journal_lines():
+    with open(botver2.STATS_JOURNAL_FILE, "r", encoding="utf-8") as f:
+        return f.readlines()
+
+
+def test_journal_is_replayed_after_restart(data_dir):
+    count_messages(3)
+    count_messages(2, "photo", USER_ID + 1)
+    botver2.flush_user_stats()
+    
+    botver2.init_config()
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID) == {"text": 3}
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID + 1) == {"photo": 2}
+    assert botver2._journal_records == 5
+
+
+def test_journal_stores_final_counter_values(data_dir):
+    count_messages(3)
+    botver2.flush_user_stats()
+    assert journal_lines()[-1] == f"{CHAT_ID}\t{USER_ID}\ttext\t3\n"
+
+
+def test_truncated_last_record_is_skipped(data_dir):
+    count_messages(2)
+    botver2.flush_user_stats()
+    botver2.close_stats_journal()
+    with open(botver2.STATS_JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write(f"{CHAT_ID}\t{USER_ID}\tte")
+    
+    botver2.init_config()
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID) == {"text": 2}
+    assert botver2._journal_records == 2
+
+
+def test_replaying_records_already_in_snapshot_is_harmless(data_dir):
+    count_messages(4)
+    botver2.flush_user_stats()
+    botver2.close_stats_journal()
+    stale = journal_lines()
+    assert botver2.compact_user_stats().result()
+    # Журнал, обнуленный после снимка, снова содержит записи, уже вошедшие в снимок
+    botver2.close_stats_journal()
+    with open(botver2.STATS_JOURNAL_FILE, "w", encoding="utf-8") as f:
+        f.writelines(stale)
+    
+    botver2.init_config()
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID) == {"text": 4}
+
+
+def test_compaction_truncates_journal(data_dir):
+    count_messages(5)
+    assert botver2.compact_user_stats().result()
+    botver2.close_stats_journal()
+    assert journal_lines() == []
+    assert botver2._journal_records == 0
+    
+    botver2.init_config()
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID) == {"text": 5}
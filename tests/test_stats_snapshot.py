@@ -0,0 +1,49 @@
+import errno
+
+import botver2
+
+CHAT_ID = -1001
+USER_ID = 42
+
+
+def count_messages(times):
+    for _ in range(times):
+        botver2.update_user_stats(CHAT_ID, USER_ID, "text")
+
+
+def test_failed_compaction_keeps_changes_for_next_snapshot(data_dir, monkeypatch):
+    count_messages(5)
+    assert botver2.compact_user_stats().result()
+    count_messages(7)
+    
+    def no_space(self):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    
+    with monkeypatch.context() as patch:
+        patch.setattr(botver2.ChatStats, "to_block", no_space)
+        assert not botver2.compact_user_stats().result()
+    assert botver2.compact_user_stats().result()
+    
+    botver2.init_config()
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID) == {"text": 12}
+
+
+def test_failed_snapshot_replace_keeps_previous_snapshot(data_dir, monkeypatch):
+    count_messages(5)
+    assert botver2.compact_user_stats().result()
+    botver2.init_config()
+    assert CHAT_ID in botver2.USER_STATS.lazy
+    botver2.update_user_stats(CHAT_ID - 1, USER_ID, "photo")
+    
+    def read_only(src, dst):
+        raise OSError(errno.EROFS, "Read-only file system")
+    
+    with monkeypatch.context() as patch:
+        patch.setattr(botver2.os, "replace", read_only)
+        assert not botver2.compact_user_stats().result()
+    assert botver2.USER_STATS.user_count() == 2
+    assert botver2.USER_STATS[CHAT_ID].get(USER_ID) == {"text": 5}
+    
+    assert botver2.compact_user_stats().result()
+    botver2.init_config()
+    assert botver2.USER_STATS[CHAT_ID - 1].get(USER_ID) == {"photo": 1}
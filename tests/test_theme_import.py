@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from botver2 import DEFAULT_TEMPLATE, THEME_NAME_MAX_LENGTH, parse_themes_document, validate_themes_batch
+
+
+def test_export_format_round_trips():
+    data = json.dumps(DEFAULT_TEMPLATE.to_dict(), ensure_ascii=False).encode("utf-8")
+    themes, hello_messages, extra = parse_themes_document("themes.json", data)
+    assert themes == list(DEFAULT_TEMPLATE.themes)
+    assert hello_messages == list(DEFAULT_TEMPLATE.hello_messages)
+    assert extra["main_name"] == DEFAULT_TEMPLATE.main_name
+
+
+def test_json_list_of_strings_and_objects():
+    data = json.dumps(["Доска", {"name": "Класс", "hello": "Привет"}], ensure_ascii=False).encode("utf-8")
+    assert parse_themes_document("themes.JSON", data) == (["Доска", "Класс"], [None, "Привет"], {})
+
+
+def test_json_short_hello_messages_are_padded():
+    data = json.dumps({"themes": ["Доска", "Класс"], "hello_messages": ["Привет"]}).encode("utf-8")
+    themes, hello_messages, _ = parse_themes_document("themes.json", data)
+    assert hello_messages == ["Привет", None]
+
+
+@pytest.mark.parametrize("content", [{"hello_messages": []}, {"themes": "Доска"}, "Доска"])
+def test_json_without_theme_list_is_rejected(content):
+    with pytest.raises(ValueError):
+        parse_themes_document("themes.json", json.dumps(content).encode("utf-8"))
+
+
+def test_csv_with_bom_header_and_blank_rows():
+    data = "name,hello\nДоска,Привет\n\n, \nКласс\n".encode("utf-8-sig")
+    assert parse_themes_document("themes.csv", data) == (["Доска", "Класс"], ["Привет", None], {})
+
+
+def test_valid_batch_is_normalized():
+    themes, hello_messages, errors = validate_themes_batch([" Доска ", "Класс"], [" Привет ", None])
+    assert errors == []
+    assert themes == ["Доска", "Класс"]
+    assert hello_messages == ["Привет", "Добро пожаловать в тему 'Класс'"]
+
+
+def test_batch_reports_every_error():
+    themes = ["", "Доска", "Доска", "x" * (THEME_NAME_MAX_LENGTH + 1), "Класс", None]
+    hello_messages = [None, None, None, None, 42, None]
+    _, _, errors = validate_themes_batch(themes, hello_messages)
+    assert [error.split(":")[0] for error in errors] == ["#1", "#3", "#4", "#5", "#6"]
+
+
+def test_batch_rejects_existing_themes_when_appending():
+    _, _, errors = validate_themes_batch(["Новости"], [None], existing=["Доска", "Новости"])
+    assert errors == ["#1: тема 'Новости' повторяется"]
@@ -0,0 +1,71 @@
+from botver2 import new_create_job, plan_theme_sync
+
+
+def synced_job(themes, main_name="Форум"):
+    job = new_create_job()
+    job["general_renamed"] = True
+    job["main_name"] = main_name
+    for i, theme_name in enumerate(themes):
+        job["topics"][theme_name] = {
+            "thread_id": 100 + i,
+            "name": theme_name,
+            "hello": f"Привет, {theme_name}",
+            "hello_message_id": 200 + i,
+            "pinned": True,
+            "closed": False,
+        }
+    return job
+
+
+def hello(themes):
+    return [f"Привет, {theme_name}" for theme_name in themes]
+
+
+def test_synced_chat_needs_no_actions():
+    themes = ["Доска", "Новости"]
+    assert plan_theme_sync(synced_job(themes), themes, hello(themes), "Форум") == []
+
+
+def test_new_and_unpinned_topics_are_created():
+    job = synced_job(["Доска", "Новости"])
+    job["topics"]["Новости"]["pinned"] = False
+    themes = ["Доска", "Новости", "Класс"]
+    assert plan_theme_sync(job, themes, hello(themes), "Форум") == [
+        ("create", "Новости", "Привет, Новости"),
+        ("create", "Класс", "Привет, Класс"),
+    ]
+
+
+def test_missing_hello_message_gets_default():
+    job = synced_job([])
+    assert plan_theme_sync(job, ["Доска"], [], "Форум") == [
+        ("create", "Доска", "Добро пожаловать в тему 'Доска'"),
+    ]
+
+
+def test_changed_topic_is_reopened_renamed_and_updated():
+    themes = ["Доска"]
+    job = synced_job(themes)
+    topic = job["topics"]["Доска"]
+    topic["closed"] = True
+    topic["name"] = "Старая доска"
+    topic["hello"] = "Старое приветствие"
+    assert plan_theme_sync(job, themes, hello(themes), "Форум") == [
+        ("reopen", "Доска", None),
+        ("rename", "Доска", "Доска"),
+        ("hello", "Доска", "Привет, Доска"),
+    ]
+
+
+def test_removed_topics_are_closed_once():
+    job = synced_job(["Доска", "Новости", "Класс"])
+    job["topics"]["Класс"]["closed"] = True
+    assert plan_theme_sync(job, ["Доска"], hello(["Доска"]), "Форум") == [("close", "Новости", None)]
+
+
+def test_general_is_renamed_only_after_create():
+    themes = ["Доска"]
+    job = synced_job(themes)
+    assert plan_theme_sync(job, themes, hello(themes), "Новый форум") == [("general", None, "Новый форум")]
+    job["general_renamed"] = False
+    assert plan_theme_sync(job, themes, hello(themes), "Новый форум") == []
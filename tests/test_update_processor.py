@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+
+from telegram import Chat, InlineQuery, Message, Update, User
+
+from botver2 import ChatOrderedUpdateProcessor, update_order_key
+
+
+def make_update(update_id, chat_id=None, user_id=None):
+    """Сообщение в чате chat_id, inline-запрос пользователя user_id или пустое обновление."""
+    user = User(user_id, "user", False) if user_id is not None else None
+    if chat_id is not None:
+        date = datetime.datetime.now(datetime.timezone.utc)
+        return Update(update_id, message=Message(update_id, date, Chat(chat_id, Chat.SUPERGROUP), from_user=user))
+    if user is not None:
+        return Update(update_id, inline_query=InlineQuery(str(update_id), user, "", ""))
+    return Update(update_id)
+
+
+def test_order_key_is_chat_then_user():
+    assert update_order_key(make_update(1, chat_id=-100, user_id=5)) == -100
+    assert update_order_key(make_update(2, user_id=5)) == 5
+    assert update_order_key(make_update(3)) is None
+    assert update_order_key(object()) is None
+
+
+async def process_all(processor, updates, delays):
+    """Обрабатывает обновления как Application: по задаче на обновление в порядке получения."""
+    log, running, peak = [], [0], [0]
+
+    async def handle(update, delay):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        log.append(("start", update.update_id))
+        await asyncio.sleep(delay)
+        log.append(("end", update.update_id))
+        running[0] -= 1
+
+    tasks = [asyncio.create_task(processor.process_update(update, handle(update, delay)))
+             for update, delay in zip(updates, delays)]
+    await asyncio.gather(*tasks)
+    return log, peak[0]
+
+
+def test_updates_of_one_chat_run_in_order():
+    processor = ChatOrderedUpdateProcessor(4, 16)
+    updates = [make_update(i, chat_id=-100) for i in range(5)]
+    # Первые обновления дольше последующих: без блокировки чата они завершились бы позже
+    log, peak = asyncio.run(process_all(processor, updates, [0.05, 0.04, 0.03, 0.02, 0.01]))
+    assert peak == 1
+    assert log == [(event, i) for i in range(5) for event in ("start", "end")]
+    assert processor.chat_locks == {}
+
+
+def test_different_chats_run_concurrently_up_to_limit():
+    processor = ChatOrderedUpdateProcessor(2, 16)
+    updates = [make_update(i, chat_id=-100 - i % 3) for i in range(9)]
+    log, peak = asyncio.run(process_all(processor, updates, [0.01] * 9))
+    assert peak == 2
+    for chat in range(3):
+        ids = [update_id for event, update_id in log if event == "start" and update_id % 3 == chat]
+        assert ids == sorted(ids)
+    assert processor.chat_locks == {}
+
+
+def test_updates_without_key_are_not_serialized():
+    processor = ChatOrderedUpdateProcessor(3, 16)
+    updates = [make_update(i) for i in range(3)]
+    log, peak = asyncio.run(process_all(processor, updates, [0.01] * 3))
+    assert peak == 3
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import botver2
+from botver2 import SECRET_TOKEN_HEADER, WebhookServer
+
+SECRET = "s3cret"
+
+
+def request(body=b"{}", method="POST", path="/telegram", secret=SECRET):
+    head = f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+    if secret is not None:
+        head += f"{SECRET_TOKEN_HEADER}: {secret}\r\n"
+    return head.encode("latin-1") + b"\r\n" + body
+
+
+async def exchange(server, *requests):
+    """Отправляет запросы в одном соединении и возвращает коды ответов."""
+    port = await server.start("127.0.0.1", 0)
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        statuses = []
+        for data in requests:
+            writer.write(data)
+            await writer.drain()
+            status_line = await reader.readuntil(b"\r\n\r\n")
+            statuses.append(int(status_line.split(b" ", 2)[1]))
+        writer.close()
+        return statuses
+    finally:
+        await server.stop()
+
+
+def run(*requests, secret_token=SECRET, on_update=None, max_connections=4):
+    received = []
+
+    async def collect(data):
+        received.append(data)
+
+    server = WebhookServer(on_update or collect, "/telegram", secret_token, max_connections)
+    return asyncio.run(exchange(server, *requests)), received
+
+
+def test_update_is_passed_to_callback():
+    statuses, received = run(request(json.dumps({"update_id": 7}).encode()))
+    assert statuses == [200]
+    assert received == [{"update_id": 7}]
+
+
+def test_keep_alive_serves_several_updates():
+    updates = [json.dumps({"update_id": i}).encode() for i in range(3)]
+    statuses, received = run(*(request(body) for body in updates))
+    assert statuses == [200, 200, 200]
+    assert [data["update_id"] for data in received] == [0, 1, 2]
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    statuses, received = run(request(secret="wrong"), request(secret=None))
+    assert statuses == [403, 403]
+    assert received == []
+
+
+def test_secret_is_optional_without_token():
+    statuses, _ = run(request(secret=None), secret_token=None)
+    assert statuses == [200]
+
+
+def test_path_method_and_body_are_checked():
+    statuses, received = run(request(path="/other"), request(method="GET"), request(b"not json"),
+                             request(path="/telegram?x=1"))
+    assert statuses == [404, 405, 400, 200]
+    assert len(received) == 1
+
+
+def test_oversized_body_is_refused_without_reading_it(monkeypatch):
+    monkeypatch.setattr(botver2, "WEBHOOK_MAX_BODY", 10)
+    statuses, received = run(b"POST /telegram HTTP/1.1\r\nContent-Length: 100\r\n\r\n")
+    assert statuses == [413]
+    assert received == []
+
+
+def test_callback_error_returns_500():
+    async def fail(data):
+        raise RuntimeError("boom")
+
+    statuses, _ = run(request(), request(), on_update=fail)
+    assert statuses == [500, 500]
+
+
+def test_connections_over_limit_get_503():
+    statuses, received = run(request(), max_connections=0)
+    assert statuses == [503]
+    assert received == []